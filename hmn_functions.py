@@ -1,45 +1,324 @@
 import pandas as pd
 import numpy as np
 import os
+import hashlib
+import io
+import pickle
 import glob
-import matplotlib.pyplot as plt
+import json
+import re
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pandas.api.types import union_categoricals
+
+
+class _LazyPyplot:
+  # matplotlib is only imported the first time a plotting function runs, so computing
+  # (hmn_metrics, scheduled jobs) doesn't pay for it
+  def __getattr__(self, name):
+    import matplotlib.pyplot
+    return getattr(matplotlib.pyplot, name)
+
+
+plt = _LazyPyplot()
+
+
+# Layout of every Pentaho export: position of the useful columns, their definitive
+# names and how many banner rows come after the header.
+EXPORT_LAYOUTS = {
+  'emergencias': {
+    'usecols': [1, 2, 3, 4, 5, 6, 8, 9, 11, 12, 13, 14, 15, 16, 17],
+    'columns': ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_INGRESO',
+                'SERVICIO', 'SECCION', 'ALTA_MEDICA', 'MOTIVO_ALTA', 'ALTA_ADMIN',
+                'PROFESIONAL', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10'],
+    'banner_rows': 6,
+  },
+  'hospitalizacion': {
+    'usecols': list(range(1, 16)),
+    'columns': ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_INGRESO',
+                'SERVICIO', 'SECCION', 'ALTA_MEDICA', 'MOTIVO_ALTA', 'ALTA_ADMIN',
+                'PROFESIONAL', 'DIAGNOSTICO_LIBRE', 'CIE10', 'DESC_CIE10'],
+    'banner_rows': 6,
+  },
+  'ambulatorio': {
+    'usecols': list(range(0, 15)),
+    'columns': ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_TURNO',
+                'HORA_TURNO', 'SERVICIO', 'SECCION', 'PRESTACION', 'AGENDA',
+                'MOTIVO_ALTA', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10'],
+    'banner_rows': 4,
+  },
+  'lab': {
+    'usecols': list(range(0, 7)),
+    'columns': ['PETICION', 'PRUEBA', 'FECHA', 'HC', 'DNI', 'PACIENTE', 'AMBITO'],
+    'banner_rows': 6,
+  },
+}
+
+
+def as_source(path):
+  """
+  Function that turns bytes into something pd.read_csv can read, without copying them.
 
+  Args:
+    path: path, file-like object, bytes or memoryview
 
-def preprocess_emergencias(path):
+  Returns:
+    path or file-like object. File-like objects are rewound, so they can be read again.
   """
-  Function that preprocesses 'emergencias' csv from Pentaho.
-  
+  if isinstance(path, (bytes, bytearray, memoryview)):
+    return io.BytesIO(path)
+  if hasattr(path, 'seek'):
+    path.seek(0)
+  return path
+
+
+def read_export(path, kind, engine=None):
+  """
+  Function that reads a Pentaho csv export keeping only the columns listed in EXPORT_LAYOUTS.
+
+  Every column is read as str, so pandas doesn't have to infer types and the padding
+  'Unnamed: N' columns are never materialised.
+
   Args:
-    path (str): Path to csv to preprocess
+    path: Path to csv to read, file-like object or bytes (e.g. an upload)
+    kind (str): one of 'emergencias', 'hospitalizacion', 'ambulatorio' or 'lab'
+    engine (str): csv parser engine passed to pd.read_csv. 'pyarrow' is used only if installed.
 
   Returns:
-    Preprocessed pandas dataframe
+    pandas dataframe with definitive column names and without banner rows
   """
-  # Read csv
-  df_temp = pd.read_csv(path)
+  layout = EXPORT_LAYOUTS[kind]
+
+  # Fall back to the default parser if pyarrow is not available
+  if engine == 'pyarrow':
+    try:
+      import pyarrow
+    except ImportError:
+      engine = None
+
+  # Read only useful columns, everything as str
+  df = pd.read_csv(as_source(path), usecols=layout['usecols'], dtype=str, engine=engine)
+
+  # Get rid of banner rows and set definitive columns
+  df = df.drop(index=df.index[:layout['banner_rows']])
+  df.columns = layout['columns']
+  return df
 
-  # Get rid of unnecessary columns
-  df_temp.drop(columns=[f'Unnamed: {i}' for i in range(18,27,1)], inplace=True)
-  df_temp.drop(columns=['Unnamed: 0','Unnamed: 7','Unnamed: 10'], inplace=True)
 
-  # Get rid of unnecessary rows
-  df_temp.drop(range(0,6), inplace=True)
+# Known formats of every date column, most frequent first. Anything else goes to the
+# (slow) fallback parser.
+DATE_FORMATS = {
+  'FECHA_HORA_INGRESO': ['%Y-%m-%d %H:%M:%S', '%d-%m-%Y %H:%M'],
+  'ALTA_MEDICA': ['%d-%m-%Y %H:%M', '%Y-%m-%d %H:%M:%S'],
+  'ALTA_ADMIN': ['%d-%m-%Y %H:%M', '%Y-%m-%d %H:%M:%S'],
+  'FECHA_HORA_TURNO': ['%d/%m/%Y %H:%M', '%d-%m-%Y %H:%M'],
+  'FECHA': ['%d/%m/%Y %H:%M', '%d-%m-%Y %H:%M'],
+}
 
-  # Set definitive columns
-  columns = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_INGRESO', 
-          'SERVICIO', 'SECCION', 'ALTA_MEDICA', 'MOTIVO_ALTA', 'ALTA_ADMIN', 
-          'PROFESIONAL', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10']
-  df_temp.columns=columns
+# Strings already solved by the fallback parser, shared between calls
+_fallback_dates = {}
+_FALLBACK_DATES_MAX = 100000
+
+
+def parse_dates(series, formats=()):
+  """
+  Function that converts a str series to datetime trying the known formats first.
+
+  Every distinct string is parsed only once. Values that match none of the formats are
+  parsed one by one with dayfirst=True, as pd.to_datetime used to do.
+
+  Args:
+    series: pandas series of str
+    formats (list): strftime formats to try, in order
+
+  Returns:
+    (datetime series, number of rows that needed the fallback parser)
+  """
+  # Parse every distinct string only once
+  codes, uniques = pd.factorize(series)
+  uniques = pd.Series(uniques)
+
+  # Fast path, one vectorized pass per known format over the still unparsed strings
+  formats = list(formats)
+  if formats:
+    parsed = pd.to_datetime(uniques, format=formats[0], errors='coerce')
+  else:
+    parsed = pd.to_datetime(pd.Series(pd.NaT, index=uniques.index))
+  pending = parsed.isna()
+  for fmt in formats[1:]:
+    if not pending.any():
+      break
+    parsed[pending] = pd.to_datetime(uniques[pending], format=fmt, errors='coerce')
+    pending = parsed.isna()
+
+  # Fallback for strings in any other format
+  for i in uniques.index[pending]:
+    value = uniques[i]
+    if value not in _fallback_dates:
+      if len(_fallback_dates) >= _FALLBACK_DATES_MAX:
+        _fallback_dates.clear()
+      _fallback_dates[value] = pd.to_datetime(value, dayfirst=True)
+    parsed[i] = _fallback_dates[value]
+  n_fallback = int(np.isin(codes, np.flatnonzero(pending.to_numpy())).sum())
+
+  # Back to one value per row, NaN rows (code -1) stay NaT
+  result = parsed.reindex(codes)
+  result.index = series.index
+  result.name = series.name
+  return result, n_fallback
+
+
+def parse_date_columns(df, columns):
+  """
+  Function that converts date columns of a dataframe in place, using DATE_FORMATS.
+
+  Args:
+    df: pandas dataframe
+    columns (list): columns to convert
+
+  Returns:
+    dict with the number of rows that needed the fallback parser per column. It's also
+    stored in df.attrs['fechas_fallback'].
+  """
+  fallback = df.attrs.get('fechas_fallback', {})
+  for column in columns:
+    df[column], fallback[column] = parse_dates(df[column], DATE_FORMATS.get(column, ()))
+  df.attrs['fechas_fallback'] = fallback
+  return fallback
+
+
+def read_export_chunks(path, kind, chunksize=100000):
+  """
+  Function that reads a Pentaho csv export in chunks, same as read_export.
+
+  Args:
+    path: Path to csv to read, file-like object or bytes
+    kind (str): one of 'emergencias', 'hospitalizacion', 'ambulatorio' or 'lab'
+    chunksize (int): rows per chunk
+
+  Returns:
+    generator of pandas dataframes with definitive column names and without banner rows
+  """
+  layout = EXPORT_LAYOUTS[kind]
+  banner_rows = layout['banner_rows']
+  # The pyarrow engine can't read in chunks, default parser only
+  with pd.read_csv(as_source(path), usecols=layout['usecols'], dtype=str, chunksize=chunksize) as reader:
+    for chunk in reader:
+      # Banner rows may span more than one chunk if chunksize is tiny
+      if banner_rows:
+        n = min(banner_rows, len(chunk))
+        chunk = chunk.drop(index=chunk.index[:n])
+        banner_rows -= n
+      if len(chunk):
+        chunk.columns = layout['columns']
+        yield chunk
+
+
+# Date columns of every kind of export
+DATE_COLUMNS = {
+  'emergencias': ['ALTA_ADMIN', 'ALTA_MEDICA', 'FECHA_HORA_INGRESO'],
+  'hospitalizacion': ['ALTA_ADMIN', 'ALTA_MEDICA', 'FECHA_HORA_INGRESO'],
+  'ambulatorio': ['FECHA_HORA_TURNO'],
+  'lab': ['FECHA'],
+}
+AMBULATORIO_COLUMNS = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_TURNO',
+                       'SERVICIO', 'SECCION', 'PRESTACION', 'AGENDA',
+                       'MOTIVO_ALTA', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10']
+
+
+def clean_export(df, kind):
+  """
+  Function that applies the row by row steps of preprocess_*: dates and derived columns.
+
+  No step looks at other rows, so it gives the same result on a whole export or on chunks.
+
+  Args:
+    df: pandas dataframe from read_export or read_export_chunks
+    kind (str): one of 'emergencias', 'hospitalizacion', 'ambulatorio' or 'lab'
+
+  Returns:
+    Cleaned pandas dataframe, not sorted
+  """
+  # Merge 'FECHA_TURNO' and 'HORA_TURNO', so as to convert to datetime
+  if kind == 'ambulatorio':
+    df['FECHA_HORA_TURNO'] = df['FECHA_TURNO'] + ' ' + df['HORA_TURNO']
 
   # Convert dates to datetype format
-  df_temp['ALTA_ADMIN'] = pd.to_datetime(df_temp['ALTA_ADMIN'], dayfirst=True)
-  df_temp['ALTA_MEDICA'] = pd.to_datetime(df_temp['ALTA_MEDICA'], dayfirst=True)
-  df_temp['FECHA_HORA_INGRESO'] = pd.to_datetime(df_temp['FECHA_HORA_INGRESO'], dayfirst=True)
+  parse_date_columns(df, DATE_COLUMNS[kind])
+
+  # Drop 'FECHA_TURNO' and 'HORA_TURNO' and reorder columns
+  if kind == 'ambulatorio':
+    df = df.drop(columns=['FECHA_TURNO','HORA_TURNO'])
+    df = df[AMBULATORIO_COLUMNS]
 
   # Create time difference columns
-  df_temp['DIF_ALTA_ADMIN_MEDICA'] = df_temp['ALTA_ADMIN'] - df_temp['ALTA_MEDICA']
-  df_temp['DIF_ALTA_MEDICA_INGRESO'] = df_temp['ALTA_MEDICA'] - df_temp['FECHA_HORA_INGRESO']
-  df_temp['ESTADIA_TOTAL'] = df_temp['ALTA_ADMIN'] - df_temp['FECHA_HORA_INGRESO']
+  if kind in ('emergencias', 'hospitalizacion'):
+    df['DIF_ALTA_ADMIN_MEDICA'] = df['ALTA_ADMIN'] - df['ALTA_MEDICA']
+    df['DIF_ALTA_MEDICA_INGRESO'] = df['ALTA_MEDICA'] - df['FECHA_HORA_INGRESO']
+    df['ESTADIA_TOTAL'] = df['ALTA_ADMIN'] - df['FECHA_HORA_INGRESO']
+  return df
+
+
+# Low cardinality text columns stored as category in compact mode
+CATEGORY_COLUMNS = ['SEXO', 'SERVICIO', 'SECCION', 'MOTIVO_ALTA', 'PROFESIONAL', 'CIE10',
+                    'DESC_CIE10', 'AGENDA', 'PRESTACION', 'PRUEBA', 'AMBITO']
+
+
+def compact_df(df, categories=None):
+  """
+  Function that converts low cardinality text columns to category and EDAD to int16.
+
+  Args:
+    df: pandas dataframe
+    categories (dict): {column: categories} to use instead of the values found in df, so
+      several dfs share the same categories
+
+  Returns:
+    Compacted copy of df
+  """
+  categories = categories or {}
+  dtypes = {column: pd.CategoricalDtype(categories.get(column))
+            for column in CATEGORY_COLUMNS if column in df.columns}
+  if 'EDAD' in df.columns:
+    dtypes['EDAD'] = 'int16'
+  return df.astype(dtypes)
+
+
+def union_categories(df_list):
+  """
+  Function that collects the categories of every CATEGORY_COLUMNS column over a list of dfs.
+
+  Args:
+    df_list (list): list of dataframes
+
+  Returns:
+    dict {column: sorted categories}, ready to be passed to compact_df
+  """
+  categories = {}
+  for column in CATEGORY_COLUMNS:
+    series = [df[column].astype('category') for df in df_list if column in df.columns]
+    if series:
+      categories[column] = union_categoricals(series, sort_categories=True).categories
+  return categories
+
+
+def preprocess_emergencias(path, engine=None, compact=False):
+  """
+  Function that preprocesses 'emergencias' csv from Pentaho.
+  
+  Args:
+    path: Path to csv to preprocess, file-like object or bytes
+    engine (str): csv parser engine, e.g. 'pyarrow'. Default parser if None.
+    compact (bool): store low cardinality columns as category, see compact_df
+
+  Returns:
+    Preprocessed pandas dataframe
+  """
+  # Read only useful columns and rows, with definitive column names
+  df_temp = read_export(path, 'emergencias', engine=engine)
+
+  # Dates and time difference columns
+  df_temp = clean_export(df_temp, 'emergencias')
 
   # Sort by 'FECHA_HORA_INGRESO'
   df_temp.sort_values('FECHA_HORA_INGRESO', inplace=True)
@@ -51,32 +330,545 @@ def preprocess_emergencias(path):
 
   # Reset index
   df_temp.reset_index(drop=True, inplace=True)
+  if compact:
+    df_temp = compact_df(df_temp)
   return df_temp
 
 
-def concatenate_dfs(df_list):
+def concatenate_dfs(df_list, compact=False):
   """
   Function that merges all preprocessed dfs in a directory, filtered by keyword
 
   Args:
     df_list (list): list of dataframes to be concatenated.
+    compact (bool): unify categories of every df first, so category columns survive the
+      concatenation instead of falling back to object
   
   Returns:
     Concatenation of all pandas dataframes in lis.
   """
+  if compact:
+    categories = union_categories(df_list)
+    df_list = [compact_df(df, categories) for df in df_list]
   df = pd.concat(df_list)
-  df['EDAD'] = df['EDAD'].astype(int)
+  if not compact:
+    df['EDAD'] = df['EDAD'].astype(int)
 #  df['DNI'] = df['DNI'].astype(int)
 #  df['NHC'] = df['NHC'].astype(int)
   df.reset_index(drop=True, inplace=True)
   return df
 
-def atenciones_por_seccion(dataframe):
+
+# Lower edge of every age group, last group has no upper edge
+EDAD_BINS = [0, 1, 14, 22, 41, 61]
+EDAD_LABELS = ['0 años', '1 a 13', '14 a 21', '22 a 40', '41 a 60', '+61']
+
+
+def _grupo_etareo(edad, bins=EDAD_BINS):
+  # Age group of every row, -1 if out of range or missing
+  edades = pd.to_numeric(edad, errors='coerce').to_numpy(dtype=float)
+  grupo = np.searchsorted(np.asarray(bins), edades, side='right') - 1
+  grupo[np.isnan(edades)] = -1
+  return grupo
+
+
+def grupos_etareos(dataframe, por=None, bins=EDAD_BINS, labels=EDAD_LABELS):
+  """
+  Function that counts attentions by age group, optionally for every value of a column, in one pass.
+
+  An age belongs to group i if bins[i] <= EDAD < bins[i+1]. Ages below bins[0] or missing are not counted.
+
+  Args:
+    dataframe: pandas dataframe
+    por (str): column to split counts by, e.g. 'SECCION' or 'SERVICIO'. Totals only if None.
+    bins (list): lower edge of every age group, ascending
+    labels (list): name of every age group
+
+  Returns:
+    pandas series with counts per age group if por is None, else pandas dataframe with one
+    row per value of por (in order of appearance) and one column per age group
+  """
+  grupo = _grupo_etareo(dataframe['EDAD'], bins)
+  n_grupos = len(bins)
+
+  if por is None:
+    counts = np.bincount(grupo[grupo >= 0], minlength=n_grupos)
+    return pd.Series(counts, index=labels, name='CANTIDADES')
+
+  # One combined code per (por, age group), counted at once
+  codes, uniques = pd.factorize(dataframe[por])
+  valid = (grupo >= 0) & (codes >= 0)
+  counts = np.bincount(codes[valid] * n_grupos + grupo[valid], minlength=len(uniques) * n_grupos)
+  return pd.DataFrame(counts.reshape(len(uniques), n_grupos),
+                      index=pd.Index(uniques, name=por),
+                      columns=labels)
+
+
+def conteos_por_grupo(dataframe, por, valores, dropna=True):
+  """
+  Function that computes value counts of a column for every value of another one, in a single groupby.
+
+  Replaces the 'for secc in dataframe[por].unique(): dataframe[dataframe[por]==secc]' loops, which
+  scan and copy the whole dataframe once per group.
+
+  Args:
+    dataframe: pandas dataframe
+    por (str): column to group by, e.g. 'SECCION' or 'SERVICIO'
+    valores: column name or pandas series (aligned with dataframe) to count, e.g. 'CIE10' or
+      dataframe.FECHA_HORA_INGRESO.dt.hour
+    dropna (bool): same as in value_counts
+
+  Returns:
+    dict {group: pandas series of counts}, groups in order of appearance and counts in value_counts
+    order (descending). Groups with nothing to count are left out.
+  """
+  if isinstance(valores, str):
+    valores = dataframe[valores]
+
+  # Every (group, value) pair counted at once
+  counts = valores.groupby([dataframe[por], valores], sort=False, dropna=dropna, observed=True).size()
+  counts = counts.sort_values(ascending=False, kind='stable')
+
+  # Hand each group its own slice of the (small) counts table
+  conteos = {}
+  for grupo, serie in counts.groupby(level=0, sort=False, dropna=False, observed=True):
+    conteos[grupo] = serie.droplevel(0).rename_axis(None).rename(valores.name)
+  return {grupo: conteos[grupo] for grupo in dataframe[por].unique() if grupo in conteos}
+
+
+def codificacion_por_grupo(dataframe, por, columna='CIE10'):
+  """
+  Function that counts uncoded and total rows for every value of a column, in a single groupby.
+
+  Args:
+    dataframe: pandas dataframe
+    por (str): column to group by, e.g. 'SECCION' or 'SERVICIO'
+    columna (str): coded column
+
+  Returns:
+    pandas dataframe with columns 'SIN_COD' and 'TOTAL', one row per group in order of appearance
+  """
+  codificacion = dataframe[columna].isna().groupby(dataframe[por], sort=False, observed=True).agg(['sum', 'size'])
+  codificacion.columns = ['SIN_COD', 'TOTAL']
+  return codificacion
+
+# Dimensions of the cube, in grain order. FECHA, HORA and DIA_SEMANA come from the date
+# column of the kind and GRUPO_ETAREO from EDAD.
+CUBE_DIMENSIONS = ['FECHA', 'HORA', 'DIA_SEMANA', 'SERVICIO', 'SECCION', 'GRUPO_ETAREO', 'SEXO', 'MOTIVO_ALTA']
+
+
+def build_cube(dataframe, kind):
+  """
+  Function that pre-aggregates attentions at the grain of CUBE_DIMENSIONS.
+
+  Built once after preprocessing, it is orders of magnitude smaller than the rows and every
+  count by hour, weekday, section, age group, etc. can be answered with cube_rollup.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    kind (str): 'emergencias', 'ambulatorio', 'hospitalizacion' or 'lab'
+
+  Returns:
+    pandas dataframe with one row per observed combination, category/small int dimensions
+    and a 'CANTIDAD' column
+  """
+  fechas = dataframe[DATE_KEYS[kind]]
+  dimensiones = {
+    'FECHA': fechas.dt.normalize(),
+    'HORA': fechas.dt.hour.astype('Int8'),
+    'DIA_SEMANA': fechas.dt.dayofweek.astype('Int8'),
+  }
+  for column in ['SERVICIO', 'SECCION']:
+    if column in dataframe.columns:
+      dimensiones[column] = dataframe[column].astype('category')
+  if 'EDAD' in dataframe.columns:
+    dimensiones['GRUPO_ETAREO'] = pd.Categorical.from_codes(_grupo_etareo(dataframe['EDAD']),
+                                                            categories=EDAD_LABELS, ordered=True)
+  for column in ['SEXO', 'MOTIVO_ALTA']:
+    if column in dataframe.columns:
+      dimensiones[column] = dataframe[column].astype('category')
+
+  keys = pd.DataFrame(dimensiones, index=dataframe.index)
+  cube = keys.groupby(list(keys.columns), observed=True, dropna=False).size()
+  cube = cube.rename('CANTIDAD').astype(np.int32).reset_index()
+  cube.attrs['kind'] = kind
+  return cube
+
+
+def cube_rollup(cube, by=None, dropna=False, **filters):
+  """
+  Function that sums a cube over every dimension not in by, optionally on a slice of it.
+
+  Args:
+    cube: pandas dataframe from build_cube
+    by (str or list): dimension(s) to keep. Grand total if None.
+    dropna (bool): leave out missing values of the by dimensions, as value_counts does
+    filters: dimension=value or dimension=[values] to slice the cube first,
+      e.g. SECCION='UTIN' or SERVICIO=['Tocoginecología', 'Neonatología']
+
+  Returns:
+    pandas series of counts indexed by the by dimensions (int if by is None).
+    GRUPO_ETAREO keeps every group, in EDAD_LABELS order.
+  """
+  for dimension, value in filters.items():
+    if isinstance(value, (list, tuple, set, pd.Index, np.ndarray)):
+      cube = cube[cube[dimension].isin(value)]
+    else:
+      cube = cube[cube[dimension] == value]
+  if by is None:
+    return int(cube['CANTIDAD'].sum())
+
+  observed = by != 'GRUPO_ETAREO'
+  return cube.groupby(by, observed=observed, dropna=dropna)['CANTIDAD'].sum()
+
+
+def cube_conteos_por_grupo(cube, por, dimension, **filters):
+  """
+  Function that returns the same dict as conteos_por_grupo, answered from a cube.
+
+  Args:
+    cube: pandas dataframe from build_cube
+    por (str): dimension to split counts by, e.g. 'SECCION'
+    dimension (str): dimension to count, e.g. 'HORA'
+    filters: same as in cube_rollup
+
+  Returns:
+    dict {group: pandas series of counts}
+  """
+  counts = cube_rollup(cube, [por, dimension], dropna=True, **filters)
+  return {grupo: serie.droplevel(0) for grupo, serie in counts.groupby(level=0, sort=False, observed=True)}
+
+
+def add_cubes(left, right):
+  """
+  Function that adds two cubes, e.g. of different months.
+
+  Args:
+    left: pandas dataframe from build_cube
+    right: pandas dataframe from build_cube
+
+  Returns:
+    pandas dataframe with the same columns, one row per combination of both
+  """
+  dimensiones = [column for column in left.columns if column != 'CANTIDAD']
+  cube = pd.concat([left, right], ignore_index=True)
+  cube = cube.groupby(dimensiones, observed=True, dropna=False, sort=False)['CANTIDAD'].sum()
+  cube = cube.astype(np.int32).reset_index()
+  # Categories of both sides are different, concat leaves them as plain values
+  for column in ['SERVICIO', 'SECCION', 'SEXO', 'MOTIVO_ALTA']:
+    if column in cube.columns:
+      cube[column] = cube[column].astype('category')
+  cube.attrs['kind'] = left.attrs.get('kind')
+  return cube
+
+
+# Look shared by every chart drawn with draw_chart
+CHART_STYLE = {
+  'figsize': (10, 7),
+  'fontsize': 10,
+  'title_fontsize': None,
+  'label_fontsize': 10,
+  'label_color': 'dimgrey',
+  'autopct': '%1.2f%%',
+}
+
+# Figures reused by chart_canvas, one per figsize. Not registered in pyplot.
+_CANVASES = {}
+
+
+def _valor(value):
+  # Counts without decimals, anything else with two
+  if pd.isna(value):
+    return ''
+  return f'{value:.0f}' if float(value).is_integer() else f'{value:.2f}'
+
+
+def label_bars(ax, fontsize=13, color='dimgrey', **kwargs):
+  """
+  Function that writes the value of every bar of an axes, one bar_label call per bar container.
+
+  Replaces the 'for i in ax.patches: ax.text(...)' loops with hand tuned offsets.
+
+  Args:
+    ax: matplotlib axes with bar or barh charts
+    fontsize (int), color (str): text style
+    kwargs: passed to ax.bar_label, e.g. padding
+  """
+  for container in ax.containers:
+    ax.bar_label(container, labels=[_valor(value) for value in container.datavalues],
+                 fontsize=fontsize, color=color, **kwargs)
+
+
+def chart_canvas(figsize):
+  """
+  Function that returns a cleared figure, the same one on every call with the same figsize.
+
+  Meant for batch rendering: the figure has to be saved before the next call and not kept.
+
+  Args:
+    figsize (tuple): figure size in inches
+
+  Returns:
+    matplotlib figure, outside pyplot (no need to close it)
+  """
+  from matplotlib.figure import Figure
+
+  figsize = tuple(figsize)
+  fig = _CANVASES.get(figsize)
+  if fig is None:
+    fig = _CANVASES[figsize] = Figure(figsize=figsize)
+  else:
+    fig.clear()
+  return fig
+
+
+def draw_chart(data, kind='bar', title='', x_label=None, y_label=None, rotation=90, column=None, ax=None,
+               canvas=False, style=None, **kwargs):
+  """
+  Function that draws a bar, barh or pie chart with CHART_STYLE and value labels.
+
+  Args:
+    data: pandas series or dataframe
+    kind (str): 'bar', 'barh' or 'pie'
+    title (str), x_label (str), y_label (str): texts. Labels are left as pandas sets them if None.
+    rotation (int): tick label rotation of bar charts
+    column (str): column of data with the slice sizes, pies of dataframes only
+    ax: axes to draw on. New figure if None.
+    canvas (bool): draw on the reusable figure of chart_canvas instead of a new one
+    style (dict): overrides of CHART_STYLE
+    kwargs: passed to the pandas plot method, e.g. color
+
+  Returns:
+    fig, ax
+  """
+  style = {**CHART_STYLE, **(style or {})}
+  if ax is None:
+    if canvas:
+      ax = chart_canvas(style['figsize']).add_subplot()
+    else:
+      ax = plt.subplots(figsize=style['figsize'])[1]
+
+  if kind == 'pie':
+    if column is not None:
+      kwargs['y'] = column
+    data.plot.pie(autopct=style['autopct'], labels=None, ax=ax, **kwargs)
+    ax.legend(bbox_to_anchor=(1,1), loc='upper right', labels=data.index)
+  else:
+    getattr(data.plot, kind)(fontsize=style['fontsize'], ax=ax, rot=rotation, **kwargs)
+    label_bars(ax, fontsize=style['label_fontsize'], color=style['label_color'])
+  ax.set_title(title, fontsize=style['title_fontsize'])
+  if x_label is not None:
+    ax.set_xlabel(x_label)
+  if y_label is not None:
+    ax.set_ylabel(y_label)
+  return ax.figure, ax
+
+
+# Formats charts can be saved in: file extension and dpi (None keeps the caller's dpi).
+# 'json' saves the plotted data for client side charting instead of an image.
+OUTPUT_FORMATS = {
+  'png': ('png', None),
+  'preview': ('png', 72),
+  'svg': ('svg', None),
+  'json': ('json', None),
+}
+# Default for every save_figure/plot_bar/plot_pie call, e.g. hmn_functions.OUTPUT_FORMAT = 'svg'
+OUTPUT_FORMAT = 'png'
+
+
+def output_format(fmt=None):
+  """
+  Function that resolves an output format, OUTPUT_FORMAT if none is given.
+
+  Args:
+    fmt (str): one of OUTPUT_FORMATS keys or None
+
+  Returns:
+    fmt (str)
+  """
+  fmt = fmt or OUTPUT_FORMAT
+  if fmt not in OUTPUT_FORMATS:
+    raise ValueError(f'Unknown output format {fmt!r}, expected one of {list(OUTPUT_FORMATS)}')
+  return fmt
+
+
+def output_path(base, fmt=None):
+  """
+  Function that adds the extension of an output format to a file name.
+
+  Previews get a '_preview' suffix, so they don't overwrite full resolution pngs.
+
+  Args:
+    base (str): path without extension
+    fmt (str): one of OUTPUT_FORMATS keys. OUTPUT_FORMAT if None.
+
+  Returns:
+    path (str)
+  """
+  fmt = output_format(fmt)
+  suffix = '_preview' if fmt == 'preview' else ''
+  return f'{base}{suffix}.{OUTPUT_FORMATS[fmt][0]}'
+
+
+def save_figure(fig, base, fmt=None, dpi=300):
+  """
+  Function that saves a figure as png, preview png or svg.
+
+  Args:
+    fig: matplotlib figure
+    base (str): path without extension
+    fmt (str): 'png', 'preview' or 'svg'. OUTPUT_FORMAT if None.
+    dpi (int): resolution for 'png'
+
+  Returns:
+    path of the saved file (str)
+  """
+  fmt = output_format(fmt)
+  if fmt == 'json':
+    raise ValueError("'json' needs the plotted data, see save_chart_data")
+  path = output_path(base, fmt)
+  fig.savefig(path, dpi=OUTPUT_FORMATS[fmt][1] or dpi, bbox_inches='tight')
+  return path
+
+
+def save_chart_data(data, base, **meta):
+  """
+  Function that saves the data of a chart as json, for client side charting.
+
+  Args:
+    data: pandas series or dataframe that would be plotted
+    base (str): path without extension
+    meta: other keys of the json, e.g. tipo='barra', titulo='...'
+
+  Returns:
+    path of the saved file (str)
+  """
+  frame = data.to_frame() if isinstance(data, pd.Series) else data
+  chart = dict(meta)
+  chart['etiquetas'] = [None if pd.isna(label) else str(label) for label in frame.index]
+  chart['series'] = {str(column): frame[column].astype(object).where(frame[column].notna(), None).tolist()
+                     for column in frame.columns}
+  path = output_path(base, 'json')
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(chart, f, ensure_ascii=False, default=str)
+  return path
+
+
+# Active FigureManagers, innermost last
+_FIGURE_MANAGERS = []
+
+
+def _figure_title(fig):
+  # First non empty title of the figure, for file names
+  titles = [fig._suptitle.get_text()] if fig._suptitle is not None else []
+  titles += [ax.get_title() for ax in fig.axes]
+  return next((title for title in titles if title), 'figura')
+
+
+class FigureManager:
+  """
+  Class that owns the figures drawn by the report functions while it is active.
+
+  Report functions call flush_figures before starting a new figure. Inside a
+  'with FigureManager(...)' block that hands every finished figure to sink (and/or saves it)
+  and closes it right away, so a report over many sections keeps one figure alive instead of
+  all of them. Figures still open when the block ends are handed over on exit. Empty figures
+  are closed without being handed over.
+
+  Outside a manager flush_figures does nothing and notebooks display figures as before.
+
+  Args:
+    sink: callable receiving each finished figure, e.g. display or st.pyplot
+    save_path (str): directory where each figure is saved as '<n>_<title>'. Not saved if None.
+    fmt (str): 'png', 'preview' or 'svg', see save_figure. OUTPUT_FORMAT if None.
+    dpi (int): resolution for 'png'
+    trace_memory (bool): measure the peak Python memory of the block with tracemalloc (slower)
+
+  Attributes:
+    stats (dict): 'figuras' handed over, 'vacias' discarded, 'pico_figuras' open at once,
+      'pico_canvas' bytes of their RGBA canvases, 'pico_memoria' (trace_memory only) and
+      'archivos' saved
+  """
+  def __init__(self, sink=None, save_path=None, fmt=None, dpi=100, trace_memory=False):
+    self.sink = sink
+    self.save_path = save_path
+    self.fmt = fmt
+    self.dpi = dpi
+    self.trace_memory = trace_memory
+    self.stats = {'figuras': 0, 'vacias': 0, 'pico_figuras': 0, 'pico_canvas': 0, 'pico_memoria': None, 'archivos': []}
+
+  def __enter__(self):
+    self._previas = set(plt.get_fignums())
+    self._tracing = False
+    if self.trace_memory:
+      if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+      else:
+        tracemalloc.start()
+        self._tracing = True
+    if self.save_path:
+      os.makedirs(self.save_path, exist_ok=True)
+    _FIGURE_MANAGERS.append(self)
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    _FIGURE_MANAGERS.remove(self)
+    if exc_type is None:
+      self.flush()
+    else:
+      # Free figures anyway, without handing them over
+      for num in self._abiertas():
+        plt.close(num)
+    if self.trace_memory:
+      self.stats['pico_memoria'] = tracemalloc.get_traced_memory()[1]
+      if self._tracing:
+        tracemalloc.stop()
+    return False
+
+  def _abiertas(self):
+    # Figures created inside the block, in creation order
+    return sorted(set(plt.get_fignums()) - self._previas)
+
+  def flush(self):
+    """
+    Method that hands over and closes every figure created inside the block so far.
+    """
+    abiertas = [plt.figure(num) for num in self._abiertas()]
+    self.stats['pico_figuras'] = max(self.stats['pico_figuras'], len(abiertas))
+    canvas = sum(int(np.prod(fig.get_size_inches() * fig.dpi)) * 4 for fig in abiertas)
+    self.stats['pico_canvas'] = max(self.stats['pico_canvas'], canvas)
+
+    for fig in abiertas:
+      if not any(ax.has_data() for ax in fig.axes):
+        self.stats['vacias'] += 1
+      else:
+        self.stats['figuras'] += 1
+        if self.save_path:
+          name = re.sub(r'[^\w\-]+', '_', _figure_title(fig)).strip('_')[:80]
+          path = save_figure(fig, os.path.join(self.save_path, f"{self.stats['figuras']:03d}_{name}"), self.fmt, self.dpi)
+          self.stats['archivos'].append(path)
+        if self.sink is not None:
+          self.sink(fig)
+      plt.close(fig)
+
+
+def flush_figures():
+  """
+  Function that hands finished figures to the active FigureManager, if any.
+
+  Called by the report functions before they start a new figure.
+  """
+  if _FIGURE_MANAGERS:
+    _FIGURE_MANAGERS[-1].flush()
+
+
+def atenciones_por_seccion(dataframe, cube=None):
   """
   Function that processes previously generated dataframe and shows attentions divided by section criteria.
 
   Args:
     dataframe: pandas dataframe
+    cube: pandas dataframe from build_cube. Counts are taken from it instead of dataframe rows.
 
   Returns: nothing because it's done for google colab. Could return processed dataframe and plots.
 
@@ -84,9 +876,14 @@ def atenciones_por_seccion(dataframe):
   ### Atenciones por sección
 
   # Dataframe
-  seccion_vc = dataframe['SECCION'].value_counts(dropna=False)
-  seccion = pd.DataFrame(dataframe['SECCION'].value_counts(dropna=False))
-  seccion['%'] = dataframe['SECCION'].value_counts(normalize=True)*100
+  if cube is not None:
+    seccion_vc = cube_rollup(cube, 'SECCION').sort_values(ascending=False)
+  else:
+    seccion_vc = dataframe['SECCION'].value_counts(dropna=False)
+  seccion = pd.DataFrame(seccion_vc)
+  # % over coded secciones only
+  codificadas = seccion_vc[seccion_vc.index.notna()]
+  seccion['%'] = codificadas/codificadas.sum()*100
   seccion = seccion.reset_index()
   seccion.columns=['SECCION','CANTIDADES','% DEL TOTAL']
   print(f"          Atenciones por sección (Total = {seccion['CANTIDADES'].sum()})\n")
@@ -96,50 +893,45 @@ def atenciones_por_seccion(dataframe):
   # Plot pie
   explode_values = np.arange(0,len(seccion)/10,0.1)
   explode = explode_values
+  flush_figures()
   plt.figure()
   ax = seccion_vc.plot(kind='pie', figsize=(15,10), fontsize=13, autopct="%1.1f%%", explode=explode)
   ax.set_title(f"Atenciones por sección (Total = {seccion['CANTIDADES'].sum()})",fontsize=20)
   ax.set_ylabel("")
   
   # Plot bar
+  flush_figures()
   plt.figure(figsize=(20,15))
   seccion_vc.plot(kind='bar',rot=45)
   plt.title(f"Atenciones por sección (Total = {seccion['CANTIDADES'].sum()})", fontsize=20)
   
 def top_20_professionals(dataframe, por_seccion=False):
   # Prepare df
-  df = pd.DataFrame(dataframe['PROFESIONAL'].value_counts(dropna=False)[:20])
-  df['% TOTAL'] = dataframe['PROFESIONAL'].value_counts(dropna=False, normalize=True) *100
-  df = df.reset_index()
-  df.columns=['PROFESIONAL','ATENCIONES','% TOTAL']
+  df = top_k(dataframe, 'PROFESIONAL', dropna=False).reset_index()
   print(f'Top 20 profesionales con mayoeres atenciones en todos los servicios')
   display (df)
   print('\n')
   
   # Plot bar
+  flush_figures()
   ax = df.plot.bar('PROFESIONAL', 'ATENCIONES', rot=45, figsize=(20,15))
   plt.title(f'Top 20 profesionales con mayores atenciones en todos los servicios')
   ax.set_ylabel("Cantidad de atenciones")
   ax.set_xlabel("Profesionales")
 
   # Write totals
-  for i in ax.patches:
-    ax.text(i.get_x(), i.get_height()*1.02, str(i.get_height()), fontsize=13, color='dimgrey')
+  label_bars(ax)
 
   if por_seccion:
-    secciones = dataframe['SECCION'].unique()
     # Dataframe loop
-    for i, secc in enumerate(secciones):
-      secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-      professional = pd.DataFrame(secc_temp['PROFESIONAL'].value_counts(dropna=False))[:20]
-      professional['% TOTAL'] = secc_temp['PROFESIONAL'].value_counts(dropna=False, normalize=True)*100
+    for secc, professional in top_k(dataframe, 'PROFESIONAL', por='SECCION', dropna=False).items():
       professional = professional.reset_index()
-      professional.columns=['PROFESIONAL','ATENCIONES', '% TOTAL']
       print(f'Top 20 profesionales en atenciones de {secc}')
       display(professional)
       print('\n')
       
       # Plot bar
+      flush_figures()
       ax = professional.plot.bar('PROFESIONAL', 'ATENCIONES', figsize=(20,10), fontsize=12)
       ax.set_title(f"Top 20 profesionales en atenciones de {secc}")
       ax.set_ylabel("Cantidad de atenciones")
@@ -147,73 +939,76 @@ def top_20_professionals(dataframe, por_seccion=False):
       plt.xticks(rotation=45)
 
       # Write totals
-      for i in ax.patches:
-        ax.text(i.get_x(), i.get_height()*1.02, str(i.get_height()), fontsize=13, color='dimgrey')
+      label_bars(ax)
   
-def atenciones_por_hora(dataframe, por_servicio=False):
+def atenciones_por_hora(dataframe, por_servicio=False, cube=None):
   """
   Function that processes previously generated dataframe and shows attentions divided by hours in dataframe's period of time.
 
   Args:
     dataframe: pandas dataframe
+    cube: pandas dataframe from build_cube. Counts are taken from it instead of dataframe rows.
 
   Returns: nothing because it's done for google colab. Could return processed dataframe and plots.
 
   """
-  df_horas = dataframe.FECHA_HORA_INGRESO.dt.hour.value_counts()
+  if cube is not None:
+    df_horas = cube_rollup(cube, 'HORA', dropna=True)
+  else:
+    df_horas = dataframe.FECHA_HORA_INGRESO.dt.hour.value_counts()
   df_horas = df_horas.sort_index()
 
   # Plot total
+  flush_figures()
   plt.figure()
   ax = df_horas.plot(kind='bar', fontsize=13, figsize=(15,10), color="orange")
   ax.set_title("Cantidad de atenciones según la hora | TOTAL | GUARDIA | 2021")
   ax.set_ylabel("Atenciones")
   plt.xticks(rotation=0)
 
-  for i in ax.patches:
-    if i.get_height() < 1000:
-      ax.text(i.get_x()-i.get_width()/4, i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
-    else:
-      ax.text(i.get_x()-i.get_width()/2, i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax)
 
   if por_servicio:
-    secciones = dataframe['SECCION'].unique()
+    if cube is not None:
+      conteos = cube_conteos_por_grupo(cube, 'SECCION', 'HORA')
+    else:
+      conteos = conteos_por_grupo(dataframe, 'SECCION', dataframe.FECHA_HORA_INGRESO.dt.hour)
 
     # Loop plot by seccion
-    for i, secc in enumerate(secciones):
-      secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-      df_horas_temp = secc_temp.FECHA_HORA_INGRESO.dt.hour.value_counts()
+    for secc, df_horas_temp in conteos.items():
       df_horas_temp = df_horas_temp.sort_index()
 
       # Plot
+      flush_figures()
       plt.figure()
       ax = df_horas_temp.plot(kind='bar', fontsize=13, figsize=(15,10), color="orange")
       ax.set_title(f"Cantidad de atenciones según la hora | {secc} | GUARDIA | 2021")
       ax.set_ylabel("Atenciones")
       plt.xticks(rotation=0)
 
-      for i in ax.patches:
-        if i.get_height() < 1000:
-          ax.text(i.get_x()-i.get_width()/4, i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
-        else:
-          ax.text(i.get_x()-i.get_width()/2, i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+      label_bars(ax)
 
-def atenciones_por_dia_semana(dataframe, por_seccion):
+def atenciones_por_dia_semana(dataframe, por_seccion, cube=None):
   """
   Function that processes previously generated dataframe and shows attentions divided weekdays in dataframe's period of time.
 
   Args:
     dataframe: pandas dataframe
+    cube: pandas dataframe from build_cube. Counts are taken from it instead of dataframe rows.
 
   Returns: nothing because it's done for google colab. Could return processed dataframe and plots.
 
   """
   # Df prepare
-  df_dias = dataframe['FECHA_HORA_INGRESO'].dt.dayofweek.value_counts()
-  df_dias.sort_index(inplace=True)
+  if cube is not None:
+    df_dias = cube_rollup(cube, 'DIA_SEMANA', dropna=True)
+  else:
+    df_dias = dataframe['FECHA_HORA_INGRESO'].dt.dayofweek.value_counts()
+  df_dias = df_dias.sort_index()
   df_dias = df_dias.rename({0:'Lunes', 1:'Martes', 2:'Miércoles', 3:'Jueves', 4:'Viernes', 5:'Sábado', 6:'Domingo'})
 
   # Plot
+  flush_figures()
   plt.figure()
   ax = df_dias.plot(kind='bar', fontsize=13, figsize=(15,10), colormap="jet")
   ax.set_title("Cantidad de atenciones en todos los servicios por día de la semana")
@@ -221,20 +1016,21 @@ def atenciones_por_dia_semana(dataframe, por_seccion):
   plt.xticks(rotation=0)
 
   # Write totals
-  for i in ax.patches:
-    ax.text(i.get_x() + 0.1, i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax)
 
   if por_seccion:
     # Df by seccion
-    secciones = dataframe['SECCION'].unique()
+    if cube is not None:
+      conteos = cube_conteos_por_grupo(cube, 'SECCION', 'DIA_SEMANA')
+    else:
+      conteos = conteos_por_grupo(dataframe, 'SECCION', dataframe['FECHA_HORA_INGRESO'].dt.dayofweek)
 
-    for i, secc in enumerate(secciones):
-      secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-      df_dias = secc_temp['FECHA_HORA_INGRESO'].dt.dayofweek.value_counts()
-      df_dias.sort_index(inplace=True)
+    for secc, df_dias in conteos.items():
+      df_dias = df_dias.sort_index()
       df_dias = df_dias.rename({0:'Lunes', 1:'Martes', 2:'Miércoles', 3:'Jueves', 4:'Viernes', 5:'Sábado', 6:'Domingo'})
 
       # Plot
+      flush_figures()
       plt.figure(figsize=(15,15))
       ax = df_dias.plot(kind='bar', fontsize=13, figsize=(15,10), colormap="jet")
       ax.set_title(f"Cantidad de atenciones en {secc} por día de la semana")
@@ -242,67 +1038,44 @@ def atenciones_por_dia_semana(dataframe, por_seccion):
       plt.xticks(rotation=0)
 
       # Write totals
-      for i in ax.patches:
-        ax.text(i.get_x() + 0.1, i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
+      label_bars(ax)
 
-def atenciones_grupo_etareo(dataframe):
+def atenciones_grupo_etareo(dataframe, cube=None):
   """
   Function that processes previously generated dataframe and shows attentions divided by ages in dataframe's period of time.
 
   Args:
     dataframe: pandas dataframe
+    cube: pandas dataframe from build_cube. Counts are taken from it instead of dataframe rows.
 
   Returns: nothing because it's done for google colab. Could return processed dataframe and plots.
 
   """
   # Group classifier
-  grupos = [0,0,0,0,0,0]
-  for i in range(len(dataframe.EDAD)):
-    if dataframe.EDAD[i] == 0:
-      grupos[0] = grupos[0] + 1
-    elif dataframe.EDAD[i] > 0 and dataframe.EDAD[i] < 14:
-      grupos[1] = grupos[1] + 1
-    elif dataframe.EDAD[i] > 14 and dataframe.EDAD[i] < 22:
-      grupos[2] = grupos[2] + 1
-    elif dataframe.EDAD[i] > 22 and dataframe.EDAD[i] < 41:
-      grupos[3] = grupos[3] + 1
-    elif dataframe.EDAD[i] > 41 and dataframe.EDAD[i] < 61:
-      grupos[4] = grupos[4] + 1
-    else:
-      grupos[5] = grupos[5] + 1
+  if cube is not None:
+    grupos = cube_rollup(cube, 'GRUPO_ETAREO', dropna=True)
+  else:
+    grupos = grupos_etareos(dataframe)
 
   # Plot  
-  plt.figure()  
-  labels=['0 años', '1 a 13', '14 a 21', '22 a 40', '41 a 60', '+61']
+  flush_figures()
+  labels=EDAD_LABELS
   fig = plt.figure(figsize=(15,10))
   explode=[0.1,0.1,0.1,0,0.1,0.1]
   plt.pie(grupos, labels=labels, autopct='%1.2f%%', explode=explode)
   plt.title("Atenciones según grupo etáreo | EMERGENCIAS");
 
   # By section
-  secciones = dataframe['SECCION'].unique()
-
-  for j, secc in enumerate(secciones):
-    secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[j]])
-    secc_temp.reset_index(drop=True, inplace=True)
-    grupos = [0,0,0,0,0,0]
-    for k in range(len(secc_temp.EDAD)):
-      if secc_temp.EDAD[k] == 0:
-        grupos[0] = grupos[0] + 1
-      elif secc_temp.EDAD[k] > 0 and secc_temp.EDAD[k] < 14:
-        grupos[1] = grupos[1] + 1
-      elif secc_temp.EDAD[k] > 14 and secc_temp.EDAD[k] < 22:
-        grupos[2] = grupos[2] + 1
-      elif secc_temp.EDAD[k] > 22 and secc_temp.EDAD[k] < 41:
-        grupos[3] = grupos[3] + 1
-      elif secc_temp.EDAD[k] > 41 and secc_temp.EDAD[k] < 61:
-        grupos[4] = grupos[4] + 1
-      else:
-        grupos[5] = grupos[5] + 1
-      
+  if cube is not None:
+    grupos_seccion = cube_rollup(cube, ['SECCION', 'GRUPO_ETAREO'], dropna=True).unstack(fill_value=0)
+    grupos_seccion = grupos_seccion.reindex(columns=EDAD_LABELS, fill_value=0)
+  else:
+    grupos_seccion = grupos_etareos(dataframe, por='SECCION')
+
+  for secc, grupos in grupos_seccion.iterrows():
     # Plot 
-    plt.figure()   
-    labels=['0 años', '1 a 13', '14 a 21', '22 a 40', '41 a 60', '+61']
+    flush_figures()
+    labels=EDAD_LABELS
     fig = plt.figure(figsize=(15,10))
     explode=[0.1,0.1,0.1,0,0.1,0.1]
     plt.pie(grupos, labels=labels, autopct='%1.2f%%', explode=explode)
@@ -323,15 +1096,13 @@ def motivo_alta(dataframe):
   df_display.columns=['MOTIVO_ALTA', 'CANTIDAD']
   display(df_display)
   print('\n')
+  flush_figures()
+  plt.figure()
   ax = dataframe['MOTIVO_ALTA'].value_counts(dropna=False).plot(kind='barh', figsize=(15,10))
   ax.set_title("Motivo de alta")
 
   # print labels
-  for i in ax.patches:
-    if i.get_width() > 1000:
-      ax.text(i.get_width() - 600, i.get_y() + 0.20, str(i.get_width()), fontsize=13, color='white')
-    else:
-      ax.text(i.get_width() + 20, i.get_y() + .20, str(i.get_width()), fontsize=13, color='black')
+  label_bars(ax)
 
 
 def top_20_cod_diagnostics(dataframe, por_seccion):
@@ -349,47 +1120,41 @@ def top_20_cod_diagnostics(dataframe, por_seccion):
   total_atenciones = len(dataframe.CIE10)
 
   # Plot
+  flush_figures()
   plt.figure()
   ax = dataframe['CIE10'].value_counts()[:20].plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
   ax.set_title(f"Top 20 diagnósticos codificados con CIE10\nDiagnósticos sin codificar: {sin_cod} | Diagnósticos totales: {total_atenciones}", fontsize=20)
   plt.xticks(rotation=20)
 
   # Write totals
-  for i in ax.patches:
-    if i.get_height() < 100:
-      ax.text(i.get_x()*1.01, i.get_height() + 2, str(i.get_height()), fontsize=13, color='grey')
-    else:
-      ax.text(i.get_x()*1.02, i.get_height() + 2, str(i.get_height()), fontsize=13, color='grey')
+  label_bars(ax)
   
   if por_seccion:
     # By section
-    secciones = dataframe['SECCION'].unique()
-    for i, secc in enumerate(secciones):
-      secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-      sin_cod_temp = secc_temp['CIE10'].isna().sum()
-      total_atenciones_temp = len(secc_temp.CIE10)
-
-      if len(secc_temp['CIE10'].value_counts(dropna=False)) > 1:
+    codificacion = codificacion_por_grupo(dataframe, 'SECCION')
+    conteos = conteos_por_grupo(dataframe, 'SECCION', 'CIE10')
+    for secc, (sin_cod_temp, total_atenciones_temp) in codificacion.iterrows():
+      if secc in conteos:
+        flush_figures()
         plt.figure()
-        ax = secc_temp['CIE10'].value_counts()[:20].plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
+        ax = conteos[secc][:20].plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
         ax.set_title(f"Top 20 diagnósticos codificados con CIE10 en {secc}\nDiagnósticos sin codificar: {sin_cod_temp} | Diagnósticos totales: {total_atenciones_temp}", fontsize=20)
         plt.xticks(rotation=20)
       else:
+        # Only uncoded diagnostics in this section
+        flush_figures()
         plt.figure()
-        ax = secc_temp['CIE10'].value_counts(dropna=False).plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
+        ax = pd.Series({np.nan: sin_cod_temp}, name='CIE10').plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
         ax.set_title(f"Top 20 diagnósticos codificados con CIE10 en {secc}\nDiagnósticos sin codificar: {sin_cod_temp} | Diagnósticos totales: {total_atenciones_temp}", fontsize=20)
         plt.xticks(rotation=20);
 
       # Write totals
-      for i in ax.patches:
-        if i.get_height() < 100:
-          ax.text(i.get_x()*1.01, i.get_height()*1.02, str(i.get_height()), fontsize=13, color='grey')
-        else:
-          ax.text(i.get_x()*1.02, i.get_height()*1.02, str(i.get_height()), fontsize=13, color='grey') 
+      label_bars(ax)
 
 def promedios_tiempo(dataframe):
   """
-  Function that processes previously generated dataframe and shows stay time averages dataframe's period of time.
+  Function that processes previously generated dataframe and shows stay time averages, medians and
+  percentiles for dataframe's period of time.
 
   Args:
     dataframe: pandas dataframe
@@ -397,68 +1162,46 @@ def promedios_tiempo(dataframe):
   Returns: nothing because it's done for google colab. Could return processed dataframe and plots.
 
   """
-  print('Medias de tiempo según estado del paciente:')
-  print(f"="*85)
-  print(f"Entre Ingreso y Alta Médica: {dataframe['DIF_ALTA_MEDICA_INGRESO'].mean()}")
-  print(f"Entre Alta Médica y Alta Administrativa: {dataframe['DIF_ALTA_ADMIN_MEDICA'].mean()}")
-  print(f"Entre Ingreso y Alta Administrativa: {dataframe['ESTADIA_TOTAL'].mean()}")
-  print(f"="*85)
-#  print(f"Mediana de tiempo entre Alta Médica e Ingreso: {dataframe['DIF_ALTA_MEDICA_INGRESO'].median()}")
-#  print(f"Mediana de tiempo entre Alta administrativa e Ingreso: {dataframe['ESTADIA_TOTAL'].median()}")
-#  print(f"Mediana de tiempo entre Alta administrativa y Alta médica: {dataframe['DIF_ALTA_ADMIN_MEDICA'].median()}")
-
-  secciones = dataframe['SECCION'].unique()
-  for i, secc in enumerate(secciones):
-    secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-    print(f'\nMedias de tiempo según estado del paciente en {secc}:')
-    print(f"="*85)
-    print(f"Entre Ingreso y Alta Médica en {secc}: {secc_temp['DIF_ALTA_MEDICA_INGRESO'].mean()}")
-    print(f"Entre Alta Médica y Alta Administrativa en {secc}: {secc_temp['DIF_ALTA_ADMIN_MEDICA'].mean()}")
-    print(f"Entre Ingreso y Alta Administrativa en {secc}: {secc_temp['ESTADIA_TOTAL'].mean()}")
-    print(f"="*85)
-#    print(f"Mediana de tiempo entre Alta Médica e Ingreso en {secc}: {secc_temp['DIF_ALTA_MEDICA_INGRESO'].median()}")
-#    print(f"Mediana de tiempo entre Alta administrativa e Ingreso en {secc}: {secc_temp['ESTADIA_TOTAL'].median()}")
-#    print(f"Mediana de tiempo entre Alta administrativa y Alta médica en {secc}: {secc_temp['DIF_ALTA_ADMIN_MEDICA'].median()}")
-
-def preprocess_ambulatorio(path):
+  # Every section in one pass, the whole dataset is the sum of the sections
+  sketch = StaySketch(dataframe, por='SECCION')
+  _mostrar_estadias(sketch.rollup().stats(), '')
+  for secc, secc_stats in sketch.stats().groupby('SECCION', sort=False, dropna=False):
+    _mostrar_estadias(secc_stats, f' en {secc}')
+
+
+# Stay columns and how promedios_tiempo names them
+ESTADIA_NOMBRES = {
+  'DIF_ALTA_MEDICA_INGRESO': 'Entre Ingreso y Alta Médica',
+  'DIF_ALTA_ADMIN_MEDICA': 'Entre Alta Médica y Alta Administrativa',
+  'ESTADIA_TOTAL': 'Entre Ingreso y Alta Administrativa',
+}
+
+
+def _mostrar_estadias(stats, donde, write=print):
+  write(f'\nTiempos según estado del paciente{donde}:')
+  write(f"="*85)
+  for _, fila in stats.iterrows():
+    write(f"{ESTADIA_NOMBRES[fila['COLUMNA']]}{donde}: media {fila['MEDIA']} | mediana {fila['MEDIANA']} | "
+          f"p90 {fila['P90']} | p99 {fila['P99']} | atípicos {fila['ATIPICOS']}")
+  write(f"="*85)
+
+def preprocess_ambulatorio(path, engine=None, compact=False):
   """
   Function that preprocesses 'ambulatorio' csv from Pentaho.
   
   Args:
-    path (str): Path to csv to preprocess
+    path: Path to csv to preprocess, file-like object or bytes
+    engine (str): csv parser engine, e.g. 'pyarrow'. Default parser if None.
+    compact (bool): store low cardinality columns as category, see compact_df
 
   Returns:
     Preprocessed pandas dataframe
   """
-  # Read csv
-  df = pd.read_csv(path)
-
-  # Get rid of unnecessary columns
-  df = df.drop(columns=['Unnamed: 15'])
-
-  # Get rid of unnecessary rows
-  df = df.drop(range(0,4))
+  # Read only useful columns and rows, with definitive column names
+  df = read_export(path, 'ambulatorio', engine=engine)
 
-  # Set definitive columns
-  columns = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_TURNO', 
-             'HORA_TURNO', 'SERVICIO', 'SECCION', 'PRESTACION', 'AGENDA', 
-             'MOTIVO_ALTA', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10']
-  df.columns=columns
-
-  # Merge 'FECHA_TURNO' and 'HORA_TURNO', so as to convert to datetime
-  df['FECHA_HORA_TURNO'] = df['FECHA_TURNO'] + ' ' + df['HORA_TURNO']
-
-  # Convert dates to datetype format
-  df['FECHA_HORA_TURNO'] = pd.to_datetime(df['FECHA_HORA_TURNO'], dayfirst=True)
-
-  # Drop 'FECHA_TURNO' and 'HORA_TURNO'
-  df = df.drop(columns=['FECHA_TURNO','HORA_TURNO'])
-
-  # Reorder columns
-  columns = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_TURNO',
-          'SERVICIO', 'SECCION', 'PRESTACION', 'AGENDA', 
-          'MOTIVO_ALTA', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10']
-  df = df[columns]
+  # Merge 'FECHA_TURNO' and 'HORA_TURNO' into datetime, reorder columns
+  df = clean_export(df, 'ambulatorio')
 
   # Sort by 'AGENDA', then 'FECHA_TURNO', then 'HORA_TURNO'
   df.sort_values(by=['SERVICIO', 'SECCION', 'FECHA_HORA_TURNO'], inplace=True)
@@ -470,6 +1213,8 @@ def preprocess_ambulatorio(path):
 
   # Reset index
   df.reset_index(drop=True, inplace=True)
+  if compact:
+    df = compact_df(df)
   return df
 
 def atenciones(dataframe, por_servicio=True, por_seccion=False, torta=False, barra=True):
@@ -502,31 +1247,28 @@ def atenciones(dataframe, por_servicio=True, por_seccion=False, torta=False, bar
       explode_values = np.arange(0,len(df['SERVICIO'])/10,0.1)
       explode = explode_values
       df_bar = df.set_index('SERVICIO') #change index for plotting SERVICIOS not numbers
-      plt.figure()
+      flush_figures()
       ax = df_bar.plot(kind='pie', y='CANTIDADES', figsize=(15,10), fontsize=13, autopct="%0.2f%%", explode=explode, legend=False)
       ax.set_title(f"Atenciones por servicio (Total = {df_bar['CANTIDADES'].sum()})",fontsize=20)
 
     if barra:
       # Plot bar
-      plt.figure()
+      flush_figures()
       ax = df.plot.bar('SERVICIO','CANTIDADES',rot=45, figsize=(20,15), fontsize=18)
       plt.title(f"Atenciones por servicio (Total = {df['CANTIDADES'].sum()})", fontsize=20)
-      for i in ax.patches:
-        ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+      label_bars(ax)
 
   if por_seccion:
     # Get all servicios
-    servicios = dataframe['SERVICIO'].unique()
-    for i, secc in enumerate(servicios):
-      # Create dataframe with only servicios[i]
-      df = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[i]])
-      # Create dataframe with value counts of servicios[i]
-      df = pd.DataFrame(df['SECCION'].value_counts(dropna=False))
+    conteos = conteos_por_grupo(dataframe, 'SERVICIO', 'SECCION', dropna=False)
+    for servicio, conteo in conteos.items():
+      # Create dataframe with value counts of servicio
+      df = pd.DataFrame(conteo)
       # Reset indexes
       df = df.reset_index()
       # Set columns names
       df.columns=['SECCION','CANTIDADES']
-      print(f"Atenciones en {servicios[i]} (Total = {df['CANTIDADES'].sum()})\n")
+      print(f"Atenciones en {servicio} (Total = {df['CANTIDADES'].sum()})\n")
       display(df)
       print('\n\n')
 
@@ -535,17 +1277,16 @@ def atenciones(dataframe, por_servicio=True, por_seccion=False, torta=False, bar
         explode_values = np.arange(0,len(df['SECCION'])/10,0.1)
         explode = explode_values
         df_bar = df.set_index('SECCION') #change index for plotting SERVICIOS not numbers
-        plt.figure()
+        flush_figures()
         ax = df_bar.plot(kind='pie', y='CANTIDADES', figsize=(15,10), fontsize=13, autopct="%0.2f%%", explode=explode, legend=False)
-        ax.set_title(f"Atenciones en {servicios[i]} (Total = {df_bar['CANTIDADES'].sum()})",fontsize=20)
+        ax.set_title(f"Atenciones en {servicio} (Total = {df_bar['CANTIDADES'].sum()})",fontsize=20)
 
       if barra:
         # Plot bar
-        plt.figure()
+        flush_figures()
         ax = df.plot.bar('SECCION','CANTIDADES', rot=45, figsize=(20,15), fontsize=18)
-        plt.title(f"Atenciones en {servicios[i]} (Total = {df['CANTIDADES'].sum()})", fontsize=20)
-        for i in ax.patches:
-          ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+        plt.title(f"Atenciones en {servicio} (Total = {df['CANTIDADES'].sum()})", fontsize=20)
+        label_bars(ax)
     
 def top_20_cod_diagnostics_ambulatorio(dataframe, por_servicio=False, por_seccion=False):
   """
@@ -564,67 +1305,63 @@ def top_20_cod_diagnostics_ambulatorio(dataframe, por_servicio=False, por_seccio
   sin_cod = dataframe['CIE10'].isna().sum()
   total_atenciones = len(dataframe.CIE10)
 
+  flush_figures()
   plt.figure()
   ax = dataframe['CIE10'].value_counts()[:20].plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
   ax.set_title(f"Top 20 diagnósticos codificados con CIE10 en mes(es) {months[0]} a {months[-1]} de {year}\nDiagnósticos sin codificar: {sin_cod} | Diagnósticos totales: {total_atenciones}", fontsize=20)
   plt.xticks(rotation=0)
   
   # Write totals in plot
-  for i in ax.patches:
-    ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax)
   
   if por_seccion:
     # By section
-    secciones = dataframe['SECCION'].unique()
-    for i, secc in enumerate(secciones):
-      secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-      sin_cod_temp = secc_temp['CIE10'].isna().sum()
-      total_atenciones_temp = len(secc_temp.CIE10)
-
-      if len(secc_temp['CIE10'].value_counts(dropna=False)) > 1:
+    codificacion = codificacion_por_grupo(dataframe, 'SECCION')
+    conteos = conteos_por_grupo(dataframe, 'SECCION', 'CIE10')
+    for secc, (sin_cod_temp, total_atenciones_temp) in codificacion.iterrows():
+      if secc in conteos:
+        flush_figures()
         plt.figure()
-        ax = secc_temp['CIE10'].value_counts()[:20].plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
+        ax = conteos[secc][:20].plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
         ax.set_title(f"Top 20 diagnósticos codificados con CIE10 en {secc} en mes(es) {months[0]} a {months[-1]} de {year}\nDiagnósticos sin codificar: {sin_cod_temp} | Diagnósticos totales: {total_atenciones_temp}", fontsize=20)
         plt.xticks(rotation=0)
 
         # Write totals in plot
-        for i in ax.patches:
-          ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+        label_bars(ax)
       
       else:
+        # Only uncoded diagnostics
+        flush_figures()
         plt.figure()
-        ax = secc_temp['CIE10'].value_counts(dropna=False).plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
+        ax = pd.Series({np.nan: sin_cod_temp}, name='CIE10').plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
         ax.set_title(f"Top 20 diagnósticos codificados con CIE10 en {secc} en mes(es) {months[0]} a {months[-1]} de {year}\nDiagnósticos sin codificar: {sin_cod_temp} | Diagnósticos totales: {total_atenciones_temp}", fontsize=20)
         plt.xticks(rotation=0);
         # Write totals in plot
-        for i in ax.patches:
-          ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+        label_bars(ax)
 
   if por_servicio:  
     # By service
-    servicios = dataframe['SERVICIO'].unique()
-    for i, serv in enumerate(servicios):
-      serv_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[i]])
-      sin_cod_temp = serv_temp['CIE10'].isna().sum()
-      total_atenciones_temp = len(serv_temp.CIE10)
-
-      if len(serv_temp['CIE10'].value_counts(dropna=False)) > 1:
+    codificacion = codificacion_por_grupo(dataframe, 'SERVICIO')
+    conteos = conteos_por_grupo(dataframe, 'SERVICIO', 'CIE10')
+    for serv, (sin_cod_temp, total_atenciones_temp) in codificacion.iterrows():
+      if serv in conteos:
+        flush_figures()
         plt.figure()
-        ax = serv_temp['CIE10'].value_counts()[:20].plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
+        ax = conteos[serv][:20].plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
         ax.set_title(f"Top 20 diagnósticos codificados con CIE10 en {serv} en mes(es) {months[0]} a {months[-1]} de {year}\nDiagnósticos sin codificar: {sin_cod_temp} | Diagnósticos totales: {total_atenciones_temp}", fontsize=20)
         plt.xticks(rotation=0)
         # Write totals in plot
-        for i in ax.patches:
-          ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+        label_bars(ax)
 
       else:
+        # Only uncoded diagnostics
+        flush_figures()
         plt.figure()
-        ax = serv_temp['CIE10'].value_counts(dropna=False).plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
+        ax = pd.Series({np.nan: sin_cod_temp}, name='CIE10').plot(kind="bar", figsize=(15,10), fontsize=13, color="brown")
         ax.set_title(f"Top 20 diagnósticos codificados con CIE10 en {serv} en mes(es) {months[0]} a {months[-1]} de {year}\nDiagnósticos sin codificar: {sin_cod_temp} | Diagnósticos totales: {total_atenciones_temp}", fontsize=20)
         plt.xticks(rotation=0)
         # Write totals in plot
-        for i in ax.patches:
-          ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+        label_bars(ax)
           
 def atenciones_por_hora_ambulatorio(dataframe, por_servicio=False):
   """
@@ -644,6 +1381,7 @@ def atenciones_por_hora_ambulatorio(dataframe, por_servicio=False):
   df_horas = df_horas.sort_index()
 
   # Plot total
+  flush_figures()
   plt.figure()
   ax = df_horas.plot(kind='bar', fontsize=13, figsize=(15,10), color="orange")
   ax.set_title(f"Cantidad de atenciones según la hora | TOTAL | AMBULATORIO | mes(es) {months[0]} a {months[-1]} de {year}")
@@ -651,34 +1389,25 @@ def atenciones_por_hora_ambulatorio(dataframe, por_servicio=False):
   plt.xticks(rotation=0)
 
   # plot labels
-  for i in ax.patches:
-    if i.get_height() < 1000:
-      ax.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
-    else:
-      ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax)
 
   # by service processing
   if por_servicio:
-    servicios = dataframe['SERVICIO'].unique()
+    conteos = conteos_por_grupo(dataframe, 'SERVICIO', dataframe.FECHA_HORA_TURNO.dt.hour)
 
     # Loop plot by seccion
-    for i, serv in enumerate(servicios):
-      serv_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[i]])
-      df_horas_temp = serv_temp.FECHA_HORA_TURNO.dt.hour.value_counts()
+    for serv, df_horas_temp in conteos.items():
       df_horas_temp = df_horas_temp.sort_index()
 
       # Plot
+      flush_figures()
       plt.figure()
       ax = df_horas_temp.plot(kind='bar', fontsize=13, figsize=(15,10), color="orange")
       ax.set_title(f"Cantidad de atenciones según la hora | {serv} | AMBULATORIO | mes(es) {months[0]} a {months[-1]} de {year}")
       ax.set_ylabel("Atenciones")
       plt.xticks(rotation=0)
 
-      for i in ax.patches:
-        if i.get_height() < 1000:
-          ax.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
-        else:
-          ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+      label_bars(ax)
           
 def atenciones_por_dia_semana_ambulatorio(dataframe, por_servicio=False):
   """
@@ -700,32 +1429,30 @@ def atenciones_por_dia_semana_ambulatorio(dataframe, por_servicio=False):
   df_dias = df_dias.rename({0:'Lunes', 1:'Martes', 2:'Miércoles', 3:'Jueves', 4:'Viernes', 5:'Sábado', 6:'Domingo'})
 
   # Plot
+  flush_figures()
   plt.figure()
   ax = df_dias.plot(kind='bar', fontsize=13, figsize=(15,10), colormap="jet")
   ax.set_title(f"Cantidad de atenciones en todos los servicios por día de la semana en mes(es) {months[0]} a {months[-1]} de {year}")
   ax.set_ylabel("Atenciones")
   plt.xticks(rotation=0)
-  for i in ax.patches:
-    ax.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax)
 
   # Df by seccion
   if por_servicio:
-    servicios = dataframe['SERVICIO'].unique()
+    conteos = conteos_por_grupo(dataframe, 'SERVICIO', dataframe['FECHA_HORA_TURNO'].dt.dayofweek)
 
-    for i, serv in enumerate(servicios):
-      serv_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[i]])
-      df_dias = serv_temp['FECHA_HORA_TURNO'].dt.dayofweek.value_counts()
-      df_dias.sort_index(inplace=True)
+    for serv, df_dias in conteos.items():
+      df_dias = df_dias.sort_index()
       df_dias = df_dias.rename({0:'Lunes', 1:'Martes', 2:'Miércoles', 3:'Jueves', 4:'Viernes', 5:'Sábado', 6:'Domingo'})
 
       # Plot
+      flush_figures()
       plt.figure(figsize=(15,15))
       ax = df_dias.plot(kind='bar', fontsize=13, figsize=(15,10), colormap="jet")
       ax.set_title(f"Cantidad de atenciones en {serv} por día de la semana en mes(es) {months[0]} a {months[-1]} de {year}")
       ax.set_ylabel("Atenciones")
       plt.xticks(rotation=0)
-      for i in ax.patches:
-        ax.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
+      label_bars(ax)
   
 def atenciones_grupo_etareo_ambulatorio(dataframe, por_servicio=False):
   """
@@ -742,24 +1469,11 @@ def atenciones_grupo_etareo_ambulatorio(dataframe, por_servicio=False):
   months = pd.DatetimeIndex(dataframe['FECHA_HORA_TURNO']).month.unique()
 
   # Group classifier
-  grupos = [0,0,0,0,0,0]
-  for i in range(len(dataframe.EDAD)):
-    if dataframe.EDAD[i] == 0:
-      grupos[0] = grupos[0] + 1
-    elif dataframe.EDAD[i] > 0 and dataframe.EDAD[i] < 14:
-      grupos[1] = grupos[1] + 1
-    elif dataframe.EDAD[i] > 14 and dataframe.EDAD[i] < 22:
-      grupos[2] = grupos[2] + 1
-    elif dataframe.EDAD[i] > 22 and dataframe.EDAD[i] < 41:
-      grupos[3] = grupos[3] + 1
-    elif dataframe.EDAD[i] > 41 and dataframe.EDAD[i] < 61:
-      grupos[4] = grupos[4] + 1
-    else:
-      grupos[5] = grupos[5] + 1
+  grupos = grupos_etareos(dataframe)
 
   # Plot  
-  plt.figure()  
-  labels=['0 años', '1 a 13', '14 a 21', '22 a 40', '41 a 60', '+61']
+  flush_figures()
+  labels=EDAD_LABELS
   fig = plt.figure(figsize=(15,10))
   explode=[0.1,0.1,0.1,0,0.1,0.1]
   plt.pie(grupos, labels=labels, autopct='%1.2f%%', explode=explode)
@@ -768,67 +1482,33 @@ def atenciones_grupo_etareo_ambulatorio(dataframe, por_servicio=False):
   # by service processing
   if por_servicio:
     # By seccion
-    servicios = dataframe['SERVICIO'].unique()
-
-    for j, serv in enumerate(servicios):
-      serv_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[j]])
-      serv_temp.reset_index(drop=True, inplace=True)
-      grupos = [0,0,0,0,0,0]
-      for k in range(len(serv_temp.EDAD)):
-        if serv_temp.EDAD[k] == 0:
-          grupos[0] = grupos[0] + 1
-        elif serv_temp.EDAD[k] > 0 and serv_temp.EDAD[k] < 14:
-          grupos[1] = grupos[1] + 1
-        elif serv_temp.EDAD[k] > 14 and serv_temp.EDAD[k] < 22:
-          grupos[2] = grupos[2] + 1
-        elif serv_temp.EDAD[k] > 22 and serv_temp.EDAD[k] < 41:
-          grupos[3] = grupos[3] + 1
-        elif serv_temp.EDAD[k] > 41 and serv_temp.EDAD[k] < 61:
-          grupos[4] = grupos[4] + 1
-        else:
-          grupos[5] = grupos[5] + 1
-        
+    grupos_servicio = grupos_etareos(dataframe, por='SERVICIO')
+
+    for serv, grupos in grupos_servicio.iterrows():
       # Plot  
-      labels=['0 años', '1 a 13', '14 a 21', '22 a 40', '41 a 60', '+61']
+      labels=EDAD_LABELS
+      flush_figures()
       fig = plt.figure(figsize=(15,10))
       explode=[0.1,0.1,0.1,0,0.1,0.1]
       plt.pie(grupos, labels=labels, autopct='%1.2f%%', explode=explode)
       plt.title(f"Atenciones según grupo etáreo | {serv.upper()} | mes(es) {months[0]} a {months[-1]} de {year}")
       
-def preprocess_hospitalizacion(path):
+def preprocess_hospitalizacion(path, engine=None, compact=False):
   """
   Function that preprocesses 'hospitalizacion' csv from Pentaho.
   
   Args:
-    path (str): Path to csv to preprocess
+    path: Path to csv to preprocess, file-like object or bytes
+    engine (str): csv parser engine, e.g. 'pyarrow'. Default parser if None.
+    compact (bool): store low cardinality columns as category, see compact_df
   Returns:
     Preprocessed pandas dataframe
   """
-  # Read csv
-  df = pd.read_csv(path)
-
-  # Get rid of unnecessary columns
-  df.drop(columns=[f'Unnamed: {i}' for i in range(16,24,1)], inplace=True)
-  df.drop(columns=['Unnamed: 0'], inplace=True)
-
-  # Get rid of unnecessary rows
-  df.drop(range(0,6), inplace=True)
-
-  # Set definitive columns
-  columns = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_INGRESO', 
-          'SERVICIO', 'SECCION', 'ALTA_MEDICA', 'MOTIVO_ALTA', 'ALTA_ADMIN', 
-          'PROFESIONAL', 'DIAGNOSTICO_LIBRE', 'CIE10', 'DESC_CIE10']
-  df.columns=columns
-
-  # Convert dates to datetype format
-  df['ALTA_ADMIN'] = pd.to_datetime(df['ALTA_ADMIN'], dayfirst=True)
-  df['ALTA_MEDICA'] = pd.to_datetime(df['ALTA_MEDICA'], dayfirst=True)
-  df['FECHA_HORA_INGRESO'] = pd.to_datetime(df['FECHA_HORA_INGRESO'], dayfirst=True)
+  # Read only useful columns and rows, with definitive column names
+  df = read_export(path, 'hospitalizacion', engine=engine)
 
-  # Create time difference columns
-  df['DIF_ALTA_ADMIN_MEDICA'] = df['ALTA_ADMIN'] - df['ALTA_MEDICA']
-  df['DIF_ALTA_MEDICA_INGRESO'] = df['ALTA_MEDICA'] - df['FECHA_HORA_INGRESO']
-  df['ESTADIA_TOTAL'] = df['ALTA_ADMIN'] - df['FECHA_HORA_INGRESO']
+  # Dates and time difference columns
+  df = clean_export(df, 'hospitalizacion')
 
   # Sort by 'FECHA_HORA_INGRESO'
   df.sort_values(by=['FECHA_HORA_INGRESO', 'SERVICIO'], inplace=True)
@@ -840,6 +1520,8 @@ def preprocess_hospitalizacion(path):
 
   # Reset index
   df.reset_index(drop=True, inplace=True)
+  if compact:
+    df = compact_df(df)
   return df
 
 def atenciones_hosp(dataframe):
@@ -853,13 +1535,14 @@ def atenciones_hosp(dataframe):
 
   """
   # Defino los dos servicios principales
-  toco = dataframe[dataframe['SERVICIO']=='Tocoginecología']
-  neo = dataframe[dataframe['SERVICIO']=='Neonatología']
+  conteos = conteos_por_grupo(dataframe, 'SERVICIO', 'SECCION')
+  toco = conteos.get('Tocoginecología', pd.Series(dtype=int))
+  neo = conteos.get('Neonatología', pd.Series(dtype=int))
   # Genero df's con totales
-  toco_df = pd.DataFrame({'ATENCIONES':toco['SECCION'].value_counts(),
-                          '% TOTAL':np.round(toco['SECCION'].value_counts(normalize=True)*100,2)})
-  neo_df = pd.DataFrame({'ATENCIONES':neo['SECCION'].value_counts(),
-                         '% TOTAL':np.round(neo['SECCION'].value_counts(normalize=True)*100,2)})
+  toco_df = pd.DataFrame({'ATENCIONES':toco,
+                          '% TOTAL':np.round(toco/toco.sum()*100,2)})
+  neo_df = pd.DataFrame({'ATENCIONES':neo,
+                         '% TOTAL':np.round(neo/neo.sum()*100,2)})
   print(f'Atenciones en Tocoginecología | HOSPITALIZACIÓN (Total = {toco_df.ATENCIONES.sum()})')
   display(toco_df)
   print('\n')
@@ -868,6 +1551,7 @@ def atenciones_hosp(dataframe):
   print('\n')
 
   # Plot
+  flush_figures()
   fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(20,20))
   toco_df.ATENCIONES.plot.bar(rot=45, ax=ax1)
   neo_df.ATENCIONES.plot.bar(rot=45, ax=ax2)
@@ -881,10 +1565,8 @@ def atenciones_hosp(dataframe):
   ax2.set_title(f'Atenciones en Neonatología | HOSPITALIZACIÓN (Total = {neo_df.ATENCIONES.sum()})')
   ax3.set_title(f'Atenciones en Tocoginecología | HOSPITALIZACIÓN (Total = {toco_df.ATENCIONES.sum()})')
   ax4.set_title(f'Atenciones en Neonatología | HOSPITALIZACIÓN (Total = {neo_df.ATENCIONES.sum()})')
-  for i in ax1.patches:
-    ax1.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
-  for i in ax2.patches:
-    ax2.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax1)
+  label_bars(ax2)
     
 def top_20_professionals_hosp(dataframe):
   """
@@ -901,14 +1583,15 @@ def top_20_professionals_hosp(dataframe):
   months = dataframe.FECHA_HORA_INGRESO.dt.month.unique()
 
   # Defino los dos servicios principales
-  toco = dataframe[dataframe['SERVICIO']=='Tocoginecología']
-  neo = dataframe[dataframe['SERVICIO']=='Neonatología']
+  conteos = conteos_por_grupo(dataframe, 'SERVICIO', 'PROFESIONAL')
+  toco = conteos.get('Tocoginecología', pd.Series(dtype=int))
+  neo = conteos.get('Neonatología', pd.Series(dtype=int))
 
   # Me quedo con las columnas que quiero solamente
-  toco_df = pd.DataFrame({'ATENCIONES':toco['PROFESIONAL'].value_counts(),
-                          '% TOTAL':np.round(toco['PROFESIONAL'].value_counts(normalize=True)*100,2)})
-  neo_df = pd.DataFrame({'ATENCIONES':neo['PROFESIONAL'].value_counts(),
-                          'SECCION':np.round(neo['PROFESIONAL'].value_counts(normalize=True)*100,2)})
+  toco_df = pd.DataFrame({'ATENCIONES':toco,
+                          '% TOTAL':np.round(toco/toco.sum()*100,2)})
+  neo_df = pd.DataFrame({'ATENCIONES':neo,
+                          'SECCION':np.round(neo/neo.sum()*100,2)})
   print(f'Top 20 profesionales con más atenciones en Tocoginecología\nHOSPITALIZACIÓN | mes(es) {months[0]} a {months[-1]} de {year}')
   display(toco_df[:20])
   print('\n\n')
@@ -916,15 +1599,14 @@ def top_20_professionals_hosp(dataframe):
   display(neo_df[:20])
 
   # Graficamos con totales
+  flush_figures()
   fig, ((ax1, ax2)) = plt.subplots(2,1, figsize=(20,20))
   toco_df.ATENCIONES[:20].plot.bar(rot=45, ax=ax1)
   neo_df.ATENCIONES[:20].plot.bar(rot=45, ax=ax2)
   ax1.set_title(f'Top 20 profesionales con más atenciones en Tocoginecología (Total = {toco_df.ATENCIONES.sum()})\nHOSPITALIZACIÓN | mes(es) {months[0]} a {months[-1]} de {year}')
   ax2.set_title(f'Top 20 profesionales con más atenciones en Neonatología (Total = {neo_df.ATENCIONES.sum()})\nHOSPITALIZACIÓN | mes(es) {months[0]} a {months[-1]} de {year}')
-  for i in ax1.patches:
-    ax1.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
-  for i in ax2.patches:
-    ax2.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax1)
+  label_bars(ax2)
     
 def atenciones_por_hora_hosp(dataframe, por_servicio=False):
   """
@@ -946,34 +1628,29 @@ def atenciones_por_hora_hosp(dataframe, por_servicio=False):
   #display(df_horas)
 
   # Plot
+  flush_figures()
   fig, ax = plt.subplots(figsize=(12,12))
   df_horas.plot.bar(rot=0, ax=ax)
   ax.set_title(f'Atenciones por hora | HOSPITALIZACIÓN | mes(es) {months[0]} a {months[-1]} de {year}')
-  for i in ax.patches:
-    ax.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=11, color='dimgrey')
+  label_bars(ax, fontsize=11)
   
   # by service processing
   if por_servicio:
-    secciones = dataframe['SECCION'].unique()
+    conteos = conteos_por_grupo(dataframe, 'SECCION', dataframe.FECHA_HORA_INGRESO.dt.hour)
 
     # Loop plot by seccion
-    for i, secc in enumerate(secciones):
-      secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-      df_horas_temp = secc_temp.FECHA_HORA_INGRESO.dt.hour.value_counts()
+    for secc, df_horas_temp in conteos.items():
       df_horas_temp = df_horas_temp.sort_index()
 
       # Plot
+      flush_figures()
       plt.figure()
       ax = df_horas_temp.plot(kind='bar', fontsize=13, figsize=(12,12), color="orange")
       ax.set_title(f"Cantidad de atenciones según la hora | {secc} | HOSPITALIZACIÓN | mes(es) {months[0]} a {months[-1]} de {year}")
       ax.set_ylabel("Atenciones")
       plt.xticks(rotation=0)
 
-      for i in ax.patches:
-        if i.get_height() < 1000:
-          ax.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
-        else:
-          ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+      label_bars(ax)
    
 def preprocess_cirugias(path):
   """
@@ -1013,26 +1690,26 @@ def cirugias_plot(dataframe):
   # bar
   dataframe.sum().plot.bar(rot=0, ax=ax2)
   ax2.set_title(f'Cirugías en mes(es) {months[0]} a {months[-1]} de {year}')
-  for i in ax2.patches:
-    ax2.text(i.get_x(), i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax2)
 
-def preprocess_lab(path):
+def preprocess_lab(path, engine=None, compact=False):
   """
   Function that processes 'lab' csv export from Pentaho.
 
   Args:
-    path (str): path to .csv
+    path: path to .csv, file-like object or bytes
+    engine (str): csv parser engine, e.g. 'pyarrow'. Default parser if None.
+    compact (bool): store low cardinality columns as category, see compact_df
 
   Returns: pandas dataframe.
 
   """
-  lab = pd.read_csv(path)
-  lab = lab.drop(index=[0,1,2,3,4,5])
-  lab = lab.drop(columns=['Unnamed: 7','Unnamed: 8','Unnamed: 9','Unnamed: 10','Unnamed: 11','Unnamed: 12','Unnamed: 13','Unnamed: 14','Unnamed: 15'])
-  lab.columns=['PETICION','PRUEBA','FECHA','HC','DNI','PACIENTE','AMBITO']
-  lab['FECHA'] = pd.to_datetime(lab['FECHA'], dayfirst=True)
+  lab = read_export(path, 'lab', engine=engine)
+  lab = clean_export(lab, 'lab')
   lab = lab.sort_values(by='FECHA')
   lab = lab.reset_index(drop=True)
+  if compact:
+    lab = compact_df(lab)
   return lab
     
 def labo_all(dataframe):
@@ -1058,11 +1735,7 @@ def labo_all(dataframe):
   ax.set_title(f'Peticiones realizadas en mes(es) {months[0]} a {months[-1]} de {year}\n Total de pruebas: {total_pruebas}\nTotal tipo de pruebas: {total_tipo_pruebas}')
   ax.set_xlabel('Pruebas')
   ax.set_ylabel('Cantidad de peticiones')  
-  for i in ax.patches:
-    if i.get_height() < 1000:
-      ax.text(i.get_x(), i.get_height()*1.03, str(int(i.get_height())), fontsize=10, color='dimgrey')
-    else:
-      ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=10, color='dimgrey')  
+  label_bars(ax, fontsize=10)
 
   # Plot hours
   fig, ax = plt.subplots(figsize=(10,7))
@@ -1072,11 +1745,7 @@ def labo_all(dataframe):
   ax.set_title(f'Peticiones realizadas por hora en mes(es) {months[0]} a {months[-1]} de {year}\n Total de pruebas: {total_pruebas}\nTotal tipo de pruebas: {total_tipo_pruebas}')
   ax.set_xlabel('HORAS')
   ax.set_ylabel('Cantidad de peticiones')  
-  for i in ax.patches:
-    if i.get_height() < 1000:
-      ax.text(i.get_x(), i.get_height()*1.03, str(int(i.get_height())), fontsize=10, color='dimgrey')
-    else:
-      ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=10, color='dimgrey')
+  label_bars(ax, fontsize=10)
 
   # Plot days
   df_days = pd.DataFrame({'DIAS':['Lunes','Martes','Miercoles','Jueves','Viernes','Sabado','Domingo'],
@@ -1087,11 +1756,7 @@ def labo_all(dataframe):
   ax.set_title(f'Peticiones realizadas por día en mes(es) {months[0]} a {months[-1]} de {year}\n Total de pruebas: {total_pruebas}\nTotal tipo de pruebas: {total_tipo_pruebas}')
   ax.set_xlabel('DIAS')
   ax.set_ylabel('Cantidad de peticiones')
-  for i in ax.patches:
-    if i.get_height() < 1000:
-      ax.text(i.get_x(), i.get_height()*1.03, str(int(i.get_height())), fontsize=10, color='dimgrey')
-    else:
-      ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=10, color='dimgrey')
+  label_bars(ax, fontsize=10)
   
   # Plot months
   df_months = pd.Series(dataframe.FECHA.dt.month.value_counts().sort_index(), name='PRUEBAS')
@@ -1100,11 +1765,7 @@ def labo_all(dataframe):
   ax.set_title(f'Peticiones realizadas por mes en mes(es) {months[0]} a {months[-1]} de {year}\n Total de pruebas: {total_pruebas}\nTotal tipo de pruebas: {total_tipo_pruebas}')
   ax.set_xlabel('MESES')
   ax.set_ylabel('Cantidad de peticiones')
-  for i in ax.patches:
-    if i.get_height() < 1000:
-      ax.text(i.get_x(), i.get_height()*1.03, str(int(i.get_height())), fontsize=10, color='dimgrey')
-    else:
-      ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=10, color='dimgrey')  
+  label_bars(ax, fontsize=10)
   
   # Plot ámbito
   fig, ax = plt.subplots(figsize=(10,7))
@@ -1112,11 +1773,7 @@ def labo_all(dataframe):
   ax.set_title(f'Peticiones realizadas por sector en mes(es) {months[0]} a {months[-1]} de {year}\n Total de pruebas: {total_pruebas}\nTotal tipo de pruebas: {total_tipo_pruebas}')
   ax.set_xlabel('SECTORES')
   ax.set_ylabel('Cantidad de peticiones')  
-  for i in ax.patches:
-    if i.get_height() < 1000:
-      ax.text(i.get_x(), i.get_height()*1.03, str(int(i.get_height())), fontsize=10, color='dimgrey')
-    else:
-      ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=10, color='dimgrey')
+  label_bars(ax, fontsize=10)
 
 def lab_totalizado(path):
   """
@@ -1149,7 +1806,8 @@ def lab_totalizado(path):
   ax.set_title('Distribución de los laboratorios')
   ax.set_ylabel('Pruebas')
   
-def ambulatorios_totalizados(path, save_path, year, months, show_plot=False, save_plot=False):
+def ambulatorios_totalizados(path, save_path, year, months, show_plot=False, save_plot=False, fmt=None):
+  # fmt: output format of the saved charts, see OUTPUT_FORMATS
   # Preprocess
   ambulatorio = pd.read_csv(path)
   ambulatorio = ambulatorio.dropna(axis=1, how='all')
@@ -1169,32 +1827,1272 @@ def ambulatorios_totalizados(path, save_path, year, months, show_plot=False, sav
   ambulatorio.drop(columns=['SERVICIO','AGENDA','TOTAL']).sum().plot.bar(rot=0, ax=ax)
   ax.set_title(f'Turnos ambulatorios totales | Mes(es) {months[0]} a {months[-1]} de {year}')
   x_lim = (ax.get_xlim()[0]+ax.get_xlim()[1])/25
-  for j in ax.patches:
-    ax.text(j.get_x()+x_lim, j.get_height()+ax.get_ylim()[1]/100, str(j.get_height()), fontsize=13, color='dimgrey')
-  fig.savefig(f'{save_path}/turnos_ambulatorios_totales.png', dpi=600, bbox_inches='tight')
-  print(f'Guardando \"turnos_ambulatorios_totales.png\" en {save_path}')
+  label_bars(ax)
+  saved = save_figure(fig, f'{save_path}/turnos_ambulatorios_totales', fmt, dpi=600)
+  print(f'Guardando \"{os.path.basename(saved)}\" en {save_path}')
 
   # Plot individuals
-  # Create array of servicios
-  servicios = ambulatorio.SERVICIO.unique()
-  dfs = []
-  # Create one dataframe per servicio
-  for i, servicio in enumerate(servicios):
-    # Fill dataframe array with individual dataframe per servicio
-    dfs.append(ambulatorio[ambulatorio['SERVICIO']==servicio])
+  # Totals of every servicio in one groupby
+  totales = ambulatorio.drop(columns=['AGENDA','TOTAL']).groupby('SERVICIO', sort=False, observed=True).sum()
+  for servicio, total in totales.iterrows():
     fig, ax = plt.subplots(figsize=(10,7))
     # Plot bar
-    dfs[i].drop(columns=['SERVICIO','AGENDA','TOTAL']).sum().plot.bar(rot=0, ax=ax)
-    ax.set_title(f'Turnos ambulatorios | {servicios[i]}');
+    total.plot.bar(rot=0, ax=ax)
+    ax.set_title(f'Turnos ambulatorios | {servicio}');
     # Make average x to write total number after
     x_lim = (ax.get_xlim()[0]+ax.get_xlim()[1])/25
     # Write totals in plot
-    for j in ax.patches:
-      ax.text(j.get_x()+x_lim, j.get_height()+ax.get_ylim()[1]/100, str(j.get_height()), fontsize=13, color='dimgrey')
+    label_bars(ax)
     # Save if chosen
     if save_plot:
-      fig.savefig(f'{save_path}/turnos_ambulatorios_{servicios[i]}.png', dpi=300, bbox_inches='tight')
-      print(f'Guardando \"turnos_ambulatorios_{servicios[i]}.png\" en {save_path}')
+      saved = save_figure(fig, f'{save_path}/turnos_ambulatorios_{servicio}', fmt, dpi=300)
+      print(f'Guardando \"{os.path.basename(saved)}\" en {save_path}')
     # Show if chosen
     if show_plot==0:
       plt.close(fig)
+
+
+# Bump every time a preprocess_* function changes its output, so old cache entries are not used
+PREPROCESS_VERSION = 1
+PREPROCESSORS = {
+  'emergencias': preprocess_emergencias,
+  'ambulatorio': preprocess_ambulatorio,
+  'hospitalizacion': preprocess_hospitalizacion,
+  'lab': preprocess_lab,
+}
+CACHE_DIRNAME = '.hmn_cache'
+CACHE_MAX_BYTES = 512 * 1024**2
+
+
+def file_hash(path, chunk_size=1024**2):
+  """
+  Function that hashes the content of a file.
+
+  Args:
+    path: path to file, or its content as bytes/memoryview (hashed in place)
+    chunk_size (int): bytes read at a time
+
+  Returns:
+    hex digest (str)
+  """
+  digest = hashlib.blake2b(digest_size=16)
+  if isinstance(path, (bytes, bytearray, memoryview)):
+    digest.update(path)
+    return digest.hexdigest()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _cache_format():
+  # Parquet needs pyarrow, pickle otherwise
+  try:
+    import pyarrow
+    return 'parquet'
+  except ImportError:
+    return 'pkl'
+
+
+def _write_frame(df, path):
+  # Write to a temporary file first, so a half written file is never read
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = f'{path}.{os.getpid()}.tmp'
+  if path.endswith('.parquet'):
+    df.to_parquet(tmp_path, engine='pyarrow', index=False)
+  else:
+    df.to_pickle(tmp_path)
+  os.replace(tmp_path, path)
+
+
+def _read_frame(path):
+  if path.endswith('.parquet'):
+    return pd.read_parquet(path, engine='pyarrow', memory_map=True)
+  return pd.read_pickle(path)
+
+
+def _cache_prefix(path, kind):
+  return f'{os.path.basename(path)}.{kind}.'
+
+
+def cache_path(path, kind, compact=False, cache_dir=None):
+  """
+  Function that builds the cache file of a source export.
+
+  The name holds the source name, the kind, PREPROCESS_VERSION, the compact flag and the
+  content hash, so any change in the source or in the preprocessors misses the cache.
+
+  Args:
+    path (str): path to source csv
+    kind (str): one of PREPROCESSORS keys
+    compact (bool): same as in preprocess_*
+    cache_dir (str): cache directory. CACHE_DIRNAME next to the source if None.
+
+  Returns:
+    path to cache file (str)
+  """
+  cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRNAME)
+  name = f"{_cache_prefix(path, kind)}v{PREPROCESS_VERSION}.{'c' if compact else 'f'}.{file_hash(path)}.{_cache_format()}"
+  return os.path.join(cache_dir, name)
+
+
+def cached_preprocess(path, kind, compact=False, cache_dir=None, rebuild=False, max_bytes=CACHE_MAX_BYTES, engine=None):
+  """
+  Function that preprocesses an export, reusing the stored result if the file didn't change.
+
+  Results are stored as Parquet (memory mapped on load) when pyarrow is installed, as pickle
+  otherwise.
+
+  Args:
+    path (str): path to source csv
+    kind (str): 'emergencias', 'ambulatorio', 'hospitalizacion' or 'lab'
+    compact (bool): same as in preprocess_*
+    cache_dir (str): cache directory. CACHE_DIRNAME next to the source if None.
+    rebuild (bool): preprocess again and overwrite the stored result
+    max_bytes (int): size limit of cache_dir, least recently used entries are deleted first
+    engine (str): csv parser engine, only used on a cache miss
+
+  Returns:
+    Preprocessed pandas dataframe
+  """
+  cache_file = cache_path(path, kind, compact=compact, cache_dir=cache_dir)
+
+  if not rebuild and os.path.exists(cache_file):
+    # Mark as recently used
+    os.utime(cache_file)
+    return _read_frame(cache_file)
+
+  df = PREPROCESSORS[kind](path, engine=engine, compact=compact)
+  _write_frame(df, cache_file)
+  evict_cache(os.path.dirname(cache_file), max_bytes)
+  return df
+
+
+def evict_cache(cache_dir, max_bytes=CACHE_MAX_BYTES):
+  """
+  Function that deletes least recently used cache entries until cache_dir fits in max_bytes.
+
+  Args:
+    cache_dir (str): cache directory
+    max_bytes (int): size limit
+
+  Returns:
+    list of deleted files
+  """
+  entries = [entry for entry in os.scandir(cache_dir) if entry.is_file() and not entry.name.endswith('.tmp')]
+  entries.sort(key=lambda entry: entry.stat().st_mtime)
+  total = sum(entry.stat().st_size for entry in entries)
+  deleted = []
+  for entry in entries:
+    if total <= max_bytes:
+      break
+    total -= entry.stat().st_size
+    os.remove(entry.path)
+    deleted.append(entry.path)
+  return deleted
+
+
+def invalidate_cache(path=None, kind=None, cache_dir=None):
+  """
+  Function that deletes cache entries, of every version and content hash.
+
+  Args:
+    path (str): source csv whose entries are deleted. Every entry in cache_dir if None.
+    kind (str): only delete entries of this kind
+    cache_dir (str): cache directory. CACHE_DIRNAME next to path if None.
+
+  Returns:
+    list of deleted files
+  """
+  if cache_dir is None:
+    if path is None:
+      raise ValueError('path or cache_dir is needed')
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRNAME)
+  if not os.path.isdir(cache_dir):
+    return []
+
+  prefix = ''
+  if path is not None:
+    prefix = _cache_prefix(path, kind) if kind else f'{os.path.basename(path)}.'
+  deleted = []
+  for entry in os.scandir(cache_dir):
+    if entry.is_file() and entry.name.startswith(prefix):
+      # Kind filter when no path is given
+      if kind and not path and f'.{kind}.' not in entry.name:
+        continue
+      os.remove(entry.path)
+      deleted.append(entry.path)
+  return deleted
+
+
+def _load_file(path, kind, compact, engine, use_cache):
+  # Runs in a worker process
+  if use_cache:
+    return cached_preprocess(path, kind, compact=compact, engine=engine)
+  return PREPROCESSORS[kind](path, engine=engine, compact=compact)
+
+
+def load_directory(directory, kind, pattern='*.csv', compact=False, processes=None, progress=None,
+                   use_cache=False, engine=None):
+  """
+  Function that preprocesses every export in a directory in parallel and concatenates them.
+
+  Args:
+    directory (str): directory with monthly exports
+    kind (str): 'emergencias', 'ambulatorio', 'hospitalizacion' or 'lab'
+    pattern (str): glob pattern of the exports, e.g. 'emergencias_*.csv'
+    compact (bool): same as in concatenate_dfs
+    processes (int): number of worker processes. All cores if None, no pool if 1.
+    progress (callable): called as progress(done, total, path) after every file
+    use_cache (bool): go through cached_preprocess
+    engine (str): csv parser engine passed to the preprocessor
+
+  Returns:
+    (concatenated pandas dataframe or None if no file could be loaded,
+     dict {path: exception} with the files that failed)
+  """
+  paths = sorted(glob.glob(os.path.join(directory, pattern)))
+  dfs = {}
+  errors = {}
+
+  def report(path):
+    if progress is not None:
+      progress(len(dfs) + len(errors), len(paths), path)
+
+  if processes == 1:
+    for path in paths:
+      try:
+        dfs[path] = _load_file(path, kind, compact, engine, use_cache)
+      except Exception as e:
+        errors[path] = e
+      report(path)
+  else:
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+      futures = {pool.submit(_load_file, path, kind, compact, engine, use_cache): path for path in paths}
+      for future in as_completed(futures):
+        path = futures[future]
+        try:
+          dfs[path] = future.result()
+        except Exception as e:
+          errors[path] = e
+        report(path)
+
+  if not dfs:
+    return None, errors
+  # Keep file order, not completion order
+  df = concatenate_dfs([dfs[path] for path in paths if path in dfs], compact=compact)
+  return df, errors
+
+
+STAY_COLUMNS = ['DIF_ALTA_MEDICA_INGRESO', 'DIF_ALTA_ADMIN_MEDICA', 'ESTADIA_TOTAL']
+
+# Date column every kind of dataset is kept sorted by
+DATE_KEYS = {
+  'emergencias': 'FECHA_HORA_INGRESO',
+  'ambulatorio': 'FECHA_HORA_TURNO',
+  'hospitalizacion': 'FECHA_HORA_INGRESO',
+  'lab': 'FECHA',
+}
+
+# Quantile sketch of stay times: log spaced buckets, so every estimate is within ESTADIA_ERROR
+# of the real value. Bucket 0 holds stays under a second (negative ones included), bucket i
+# stays in (gamma**(i-1), gamma**i] seconds, the last one everything over ~3 years.
+ESTADIA_ERROR = 0.01
+_ESTADIA_GAMMA = (1 + ESTADIA_ERROR) / (1 - ESTADIA_ERROR)
+_ESTADIA_BUCKETS = int(np.ceil(np.log(1e8) / np.log(_ESTADIA_GAMMA))) + 1
+_ESTADIA_VALORES = np.concatenate([[0.], 2 * _ESTADIA_GAMMA ** np.arange(1, _ESTADIA_BUCKETS) / (_ESTADIA_GAMMA + 1)])
+
+# Lower edge (hours) and label of every histogram bucket
+ESTADIA_HISTOGRAMA = [0, 6, 12, 24, 48, 72, 120, 168, 336, 720]
+ESTADIA_HISTOGRAMA_LABELS = ['<6h', '6-12h', '12-24h', '1-2d', '2-3d', '3-5d', '5-7d', '7-14d', '14-30d', '+30d']
+
+
+def _group_codes(dataframe, por):
+  # Group number of every row and the group keys, in order of appearance, NaN as a group
+  if not por:
+    return np.zeros(len(dataframe), dtype=np.intp), pd.Index(['Total'])
+  if len(por) == 1:
+    codes, grupos = pd.factorize(dataframe[por[0]], use_na_sentinel=False)
+    return codes, pd.Index(grupos, name=por[0])
+  codes, grupos = pd.MultiIndex.from_arrays([dataframe[column] for column in por]).factorize()
+  return codes, grupos.set_names(por)
+
+
+class StaySketch:
+  """
+  Mergeable summary of stay times per group, computed in one vectorized pass over int64 nanoseconds.
+
+  For every group and column it keeps the exact count, sum, minimum, maximum and negative stays,
+  a quantile sketch (log buckets, ESTADIA_ERROR relative error) and a histogram of ESTADIA_HISTOGRAMA
+  buckets. Sketches of different months are added with + (or sum) and give the same result as a
+  sketch of all their rows, so yearly stats don't need the raw rows.
+
+  Args:
+    dataframe: preprocessed pandas dataframe with timedelta columns
+    por: grouping column(s), e.g. ['SERVICIO', 'SECCION']. A single 'Total' group if None.
+    columnas (list): timedelta columns to summarize
+  """
+
+  def __init__(self, dataframe, por=('SERVICIO', 'SECCION'), columnas=STAY_COLUMNS):
+    self.por = [por] if isinstance(por, str) else list(por or [])
+    self.columnas = list(columnas)
+    codes, self.grupos = _group_codes(dataframe, self.por)
+    self._empty(len(self.grupos))
+
+    n_grupos, n_buckets, n_hist = len(self.grupos), _ESTADIA_BUCKETS, len(ESTADIA_HISTOGRAMA)
+    for j, columna in enumerate(self.columnas):
+      valores = dataframe[columna].to_numpy(dtype='timedelta64[ns]').view(np.int64)
+      validos = valores != np.iinfo(np.int64).min
+      valores, grupo = valores[validos], codes[validos]
+      segundos = valores / 1e9
+
+      self.n[:, j] = np.bincount(grupo, minlength=n_grupos)
+      self.suma[:, j] = np.bincount(grupo, weights=segundos, minlength=n_grupos)
+      self.negativos[:, j] = np.bincount(grupo[valores < 0], minlength=n_grupos)
+      np.minimum.at(self.minimo[:, j], grupo, valores)
+      np.maximum.at(self.maximo[:, j], grupo, valores)
+
+      bucket = np.ceil(np.log(np.maximum(segundos, 1)) / np.log(_ESTADIA_GAMMA)).astype(np.intp)
+      bucket = np.minimum(bucket, n_buckets - 1)
+      self.buckets[:, j] = np.bincount(grupo * n_buckets + bucket, minlength=n_grupos * n_buckets).reshape(n_grupos, n_buckets)
+      hist = np.maximum(np.searchsorted(np.asarray(ESTADIA_HISTOGRAMA) * 3600, segundos, side='right') - 1, 0)
+      self.histograma[:, j] = np.bincount(grupo * n_hist + hist, minlength=n_grupos * n_hist).reshape(n_grupos, n_hist)
+
+  def _empty(self, n_grupos):
+    shape = (n_grupos, len(self.columnas))
+    self.n = np.zeros(shape, dtype=np.int64)
+    self.suma = np.zeros(shape)
+    self.negativos = np.zeros(shape, dtype=np.int64)
+    self.minimo = np.full(shape, np.iinfo(np.int64).max)
+    self.maximo = np.full(shape, np.iinfo(np.int64).min)
+    self.buckets = np.zeros(shape + (_ESTADIA_BUCKETS,), dtype=np.int64)
+    self.histograma = np.zeros(shape + (len(ESTADIA_HISTOGRAMA),), dtype=np.int64)
+
+  def _regroup(self, codes, grupos):
+    # New sketch with the groups of self added into grupos, codes[i] being the new group of group i
+    sketch = object.__new__(StaySketch)
+    sketch.por, sketch.columnas, sketch.grupos = list(grupos.names) if grupos.names != [None] else [], self.columnas, grupos
+    sketch._empty(len(grupos))
+    sketch._add(codes, self)
+    return sketch
+
+  def _add(self, codes, other):
+    for name in ['n', 'suma', 'negativos', 'buckets', 'histograma']:
+      np.add.at(getattr(self, name), codes, getattr(other, name))
+    np.minimum.at(self.minimo, codes, other.minimo)
+    np.maximum.at(self.maximo, codes, other.maximo)
+
+  def __add__(self, other):
+    if (self.por, self.columnas) != (other.por, other.columnas):
+      raise ValueError('Sketches with different groups or columns can not be added')
+    sketch = self._regroup(np.arange(len(self.grupos)), self.grupos.append(other.grupos).unique())
+    sketch._add(sketch.grupos.get_indexer(other.grupos), other)
+    return sketch
+
+  def __radd__(self, other):
+    # sum() starts from 0
+    return self if other == 0 else self.__add__(other)
+
+  def rollup(self, por=None):
+    """
+    Function that merges groups into coarser ones, e.g. secciones into servicios.
+
+    Args:
+      por: grouping column(s), a subset of self.por. A single 'Total' group if None.
+
+    Returns:
+      StaySketch
+    """
+    por = [por] if isinstance(por, str) else list(por or [])
+    keys = self.grupos.to_frame(index=False) if self.por else pd.DataFrame(index=range(len(self.grupos)))
+    codes, grupos = _group_codes(keys, por)
+    return self._regroup(codes, grupos)
+
+  def quantile(self, q):
+    """
+    Function that estimates a quantile of every group and column from the sketch.
+
+    Args:
+      q (float): quantile, between 0 and 1
+
+    Returns:
+      numpy array of seconds, shape (groups, columns). NaN for empty groups.
+    """
+    rank = np.floor(q * (self.n - 1))
+    bucket = (self.buckets.cumsum(axis=2) <= rank[..., None]).sum(axis=2)
+    valores = _ESTADIA_VALORES[np.minimum(bucket, _ESTADIA_BUCKETS - 1)]
+    # Extremes are known exactly
+    valores = np.clip(valores, self.minimo / 1e9, self.maximo / 1e9)
+    return np.where(self.n > 0, valores, np.nan)
+
+  def atipicos(self):
+    """
+    Function that counts outliers: stays over Q3 + 1.5 IQR (Tukey's fence) of their group.
+
+    Returns:
+      numpy array of counts, shape (groups, columns)
+    """
+    q1, q3 = self.quantile(0.25), self.quantile(0.75)
+    limite = q3 + 1.5 * (q3 - q1)
+    return (self.buckets * (_ESTADIA_VALORES > np.nan_to_num(limite, nan=np.inf)[..., None])).sum(axis=2)
+
+  def stats(self):
+    """
+    Function that summarizes every group and column.
+
+    Returns:
+      tidy pandas dataframe with the por columns, 'COLUMNA', 'N', 'MEDIA', 'MEDIANA', 'P90', 'P95',
+      'P99', 'MIN', 'MAX' (timedeltas), 'ATIPICOS' and 'NEGATIVOS'
+    """
+    def tiempo(segundos):
+      return pd.to_timedelta(np.asarray(segundos, dtype=float).ravel(), unit='s').round('s')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+      media = self.suma / self.n
+    vacios = self.n == 0
+    stats = pd.DataFrame({
+      'COLUMNA': np.tile(self.columnas, len(self.grupos)),
+      'N': self.n.ravel(),
+      'MEDIA': tiempo(media),
+      'MEDIANA': tiempo(self.quantile(0.5)),
+      'P90': tiempo(self.quantile(0.9)),
+      'P95': tiempo(self.quantile(0.95)),
+      'P99': tiempo(self.quantile(0.99)),
+      'MIN': tiempo(np.where(vacios, np.nan, self.minimo / 1e9)),
+      'MAX': tiempo(np.where(vacios, np.nan, self.maximo / 1e9)),
+      'ATIPICOS': self.atipicos().ravel(),
+      'NEGATIVOS': self.negativos.ravel(),
+    })
+    if self.por:
+      keys = self.grupos.to_frame(index=False).loc[np.repeat(np.arange(len(self.grupos)), len(self.columnas))]
+      stats = pd.concat([keys.reset_index(drop=True), stats], axis=1)
+    return stats
+
+  def histogramas(self, columna='ESTADIA_TOTAL'):
+    """
+    Function that returns the histogram of a column for every group.
+
+    Args:
+      columna (str): one of self.columnas
+
+    Returns:
+      pandas dataframe with one row per group and one column per ESTADIA_HISTOGRAMA_LABELS
+    """
+    j = self.columnas.index(columna)
+    return pd.DataFrame(self.histograma[:, j], index=self.grupos, columns=ESTADIA_HISTOGRAMA_LABELS)
+
+
+def _top_frame(conteos, k, columna):
+  # Counts and % over every value (not only the first k), from one series of counts
+  conteos = conteos.sort_values(ascending=False, kind='stable')
+  top = conteos[:k].rename('ATENCIONES').rename_axis(columna).to_frame()
+  top['% TOTAL'] = top['ATENCIONES'] / conteos.sum() * 100
+  return top
+
+
+def top_k(dataframe, columna, k=20, por=None, dropna=True):
+  """
+  Function that ranks the values of a column, exactly, with a single count reused for the percentages.
+
+  Args:
+    dataframe: pandas dataframe
+    columna (str): column to rank, e.g. 'CIE10' or 'PROFESIONAL'
+    k (int): values kept, every value if None
+    por (str): column to rank within, e.g. 'SECCION'
+    dropna (bool): same as in value_counts. False to rank missing values too, e.g. unassigned PROFESIONAL
+
+  Returns:
+    pandas dataframe indexed by value with 'ATENCIONES' and '% TOTAL', or a dict {group: dataframe}
+    if por is given
+  """
+  if por is None:
+    return _top_frame(dataframe[columna].value_counts(dropna=dropna), k, columna)
+  return {grupo: _top_frame(conteo, k, columna) for grupo, conteo in conteos_por_grupo(dataframe, por, columna, dropna=dropna).items()}
+
+
+# Counters kept per group by TopKSketch. A value is guaranteed to be counted if it has more than
+# 1/(TOPK_CAPACIDAD + 1) of the rows, and counts are at most that fraction of the rows short.
+TOPK_CAPACIDAD = 500
+
+
+def _reducir(contadores, capacidad):
+  # Misra-Gries: subtract the (capacidad + 1)-th count from every counter, keep the ones left above 0
+  if len(contadores) <= capacidad:
+    return contadores, 0
+  corte = contadores.nlargest(capacidad + 1).iloc[-1]
+  contadores = contadores - corte
+  return contadores[contadores > 0], int(corte)
+
+
+class TopKSketch:
+  """
+  Approximate, mergeable ranking of the values of a column per group, in constant memory.
+
+  Every group keeps at most capacidad counters (Misra-Gries / Space-Saving family), the exact
+  number of rows and the largest possible undercount. Sketches of different months or chunks
+  are added with + (or sum), so a top 20 over years never needs more than the counters.
+
+  Args:
+    dataframe: pandas dataframe
+    columna (str): column to rank, e.g. 'CIE10' or 'PROFESIONAL'
+    por (str): column to rank within, e.g. 'SECCION'. A single group (None) if None.
+    capacidad (int): counters kept per group
+    dropna (bool): same as in value_counts. False to rank missing values too, e.g. unassigned PROFESIONAL
+  """
+
+  def __init__(self, dataframe, columna, por=None, capacidad=TOPK_CAPACIDAD, dropna=True):
+    self.columna, self.por, self.capacidad = columna, por, capacidad
+    if por is None:
+      conteos = {None: dataframe[columna].value_counts(dropna=dropna)}
+    else:
+      conteos = conteos_por_grupo(dataframe, por, columna, dropna=dropna)
+
+    self.contadores, self.filas, self.error = {}, {}, {}
+    for grupo, conteo in conteos.items():
+      self.contadores[grupo], self.error[grupo] = _reducir(conteo, capacidad)
+      self.filas[grupo] = int(conteo.sum())
+
+  def __add__(self, other):
+    if (self.columna, self.por, self.capacidad) != (other.columna, other.por, other.capacidad):
+      raise ValueError('Sketches of different columns, groups or capacity can not be added')
+    sketch = object.__new__(TopKSketch)
+    sketch.columna, sketch.por, sketch.capacidad = self.columna, self.por, self.capacidad
+    sketch.contadores, sketch.filas, sketch.error = dict(self.contadores), dict(self.filas), dict(self.error)
+    for grupo, contadores in other.contadores.items():
+      if grupo not in sketch.contadores:
+        sketch.contadores[grupo], sketch.filas[grupo], sketch.error[grupo] = contadores, other.filas[grupo], other.error[grupo]
+        continue
+      sumados = sketch.contadores[grupo].add(contadores, fill_value=0).astype(np.int64)
+      sketch.contadores[grupo], corte = _reducir(sumados, self.capacidad)
+      sketch.filas[grupo] += other.filas[grupo]
+      sketch.error[grupo] += other.error[grupo] + corte
+    return sketch
+
+  def __radd__(self, other):
+    # sum() starts from 0
+    return self if other == 0 else self.__add__(other)
+
+  def top(self, k=20):
+    """
+    Function that returns the k values with most rows, as top_k does.
+
+    'ATENCIONES' is a lower bound of the real count and 'ERROR' the most it can be short, so the
+    real count is between ATENCIONES and ATENCIONES + ERROR. '% TOTAL' is over the exact rows.
+
+    Args:
+      k (int): values kept
+
+    Returns:
+      pandas dataframe indexed by value, or a dict {group: dataframe} if the sketch has por
+    """
+    tops = {}
+    for grupo, contadores in self.contadores.items():
+      top = _top_frame(contadores, k, self.columna)
+      # Over every row, not only the counted ones
+      top['% TOTAL'] = top['ATENCIONES'] / self.filas[grupo] * 100
+      top['ERROR'] = self.error[grupo]
+      tops[grupo] = top
+    return tops[None] if self.por is None else tops
+
+
+# Bump every time partial_aggregates changes its output, so stored aggregates are recomputed
+AGGREGATES_VERSION = 5
+
+
+def partial_aggregates(dataframe, kind):
+  """
+  Function that computes the counts used by the report functions, in a form that can be added up.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    kind (str): 'emergencias', 'ambulatorio', 'hospitalizacion' or 'lab'
+
+  Returns:
+    dict {name: pandas series of counts}. 'CUBO' holds the cube of build_cube, for counts by
+    service, section, hour, weekday, age group and reason for discharge. 'ESTADIA' holds a
+    StaySketch and 'TOPK/SECCION/<column>' a TopKSketch.
+  """
+  # Same cube the report functions take with cube=, so both count the same way
+  aggregates = {'CUBO': build_cube(dataframe, kind)}
+  for column in ['PROFESIONAL', 'CIE10', 'PRUEBA', 'AMBITO']:
+    if column in dataframe.columns:
+      aggregates[column] = dataframe.groupby(column, dropna=False, observed=True).size()
+  if 'SECCION' in dataframe.columns:
+    for column in ['PROFESIONAL', 'CIE10']:
+      if column in dataframe.columns:
+        # Bounded rankings instead of every (SECCION, value) count. Uncoded diagnoses are not ranked,
+        # unassigned professionals are, as in top_20_professionals.
+        aggregates[f'TOPK/SECCION/{column}'] = TopKSketch(dataframe, column, por='SECCION', dropna=column == 'CIE10')
+  if 'ESTADIA_TOTAL' in dataframe.columns and 'SECCION' in dataframe.columns:
+    # Stay times as a sketch, so means, medians and percentiles can be merged
+    aggregates['ESTADIA'] = StaySketch(dataframe, por=[c for c in ['SERVICIO', 'SECCION'] if c in dataframe.columns])
+  return aggregates
+
+
+def add_aggregates(left, right):
+  """
+  Function that adds two dicts returned by partial_aggregates.
+
+  Args:
+    left (dict): aggregates
+    right (dict): aggregates
+
+  Returns:
+    dict with the sum of both
+  """
+  total = dict(left)
+  for name, counts in right.items():
+    if name in total and isinstance(counts, (StaySketch, TopKSketch, int, np.integer)):
+      # Sketches and scalars like preprocess_chunked's FILAS
+      total[name] = total[name] + counts
+    elif name in total and isinstance(counts, pd.DataFrame):
+      total[name] = add_cubes(total[name], counts)
+    elif name in total:
+      summed = total[name].add(counts, fill_value=0)
+      # Labels missing on one side turn counts into float
+      if isinstance(summed, pd.Series) and pd.api.types.is_integer_dtype(counts):
+        summed = summed.astype(np.int64)
+      total[name] = summed
+    else:
+      total[name] = counts
+  return total
+
+
+def _merge_sorted(left, right, key):
+  # Both dataframes sorted by key. Right rows are inserted after equal left rows, left
+  # rows keep their relative order, so nothing already sorted is sorted again.
+  position = np.searchsorted(left[key].to_numpy(), right[key].to_numpy(), side='right')
+  order = np.insert(np.arange(len(left)), position, np.arange(len(left), len(left) + len(right)))
+  merged = pd.concat([left, right], ignore_index=True)
+  return merged.take(order).reset_index(drop=True)
+
+
+class IncrementalDataset:
+  """
+  Dataset of monthly exports stored in a directory, that only preprocesses new or changed files.
+
+  Every source file is kept as its own part with its partial aggregates, so adding a month
+  preprocesses and aggregates that month only, no matter how many are already stored.
+
+  Args:
+    store_dir (str): directory where parts and manifest are kept
+    kind (str): 'emergencias', 'ambulatorio', 'hospitalizacion' or 'lab'
+    compact (bool): same as in concatenate_dfs
+  """
+
+  def __init__(self, store_dir, kind, compact=False):
+    self.store_dir = store_dir
+    self.kind = kind
+    self.compact = compact
+    self.key = DATE_KEYS[kind]
+    self._manifest_path = os.path.join(store_dir, 'manifest.pkl')
+    self._data = None
+    self._pacientes = None
+
+    self.parts = {}
+    if os.path.exists(self._manifest_path):
+      with open(self._manifest_path, 'rb') as f:
+        manifest = pickle.load(f)
+      # Parts built by other preprocessors or modes are deleted and rebuilt on the next add
+      if (manifest['version'], manifest['kind'], manifest['compact']) != (PREPROCESS_VERSION, kind, compact):
+        for part in manifest['parts'].values():
+          if os.path.exists(part['file']):
+            os.remove(part['file'])
+        self._save_manifest()
+      else:
+        self.parts = manifest['parts']
+        # Stored parts are still valid, only their aggregates are recomputed
+        if manifest.get('aggregates_version', 1) != AGGREGATES_VERSION:
+          for part in self.parts.values():
+            part['aggregates'] = partial_aggregates(_read_frame(part['file']), kind)
+          self._save_manifest()
+    self.aggregates = self._total_aggregates()
+
+  def _total_aggregates(self):
+    total = {}
+    for part in self.parts.values():
+      total = add_aggregates(total, part['aggregates'])
+    return total
+
+  def _save_manifest(self):
+    os.makedirs(self.store_dir, exist_ok=True)
+    tmp_path = f'{self._manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+      pickle.dump({'version': PREPROCESS_VERSION, 'aggregates_version': AGGREGATES_VERSION, 'kind': self.kind,
+                   'compact': self.compact, 'parts': self.parts}, f)
+    os.replace(tmp_path, self._manifest_path)
+
+  def add(self, paths, engine=None):
+    """
+    Function that ingests new or changed source files.
+
+    Args:
+      paths: list of csv paths, or a glob pattern
+      engine (str): csv parser engine passed to the preprocessor
+
+    Returns:
+      list of paths that were (re)ingested
+    """
+    if isinstance(paths, str):
+      paths = sorted(glob.glob(paths))
+
+    added = []
+    for path in paths:
+      path = os.path.abspath(path)
+      digest = file_hash(path)
+      if path in self.parts and self.parts[path]['hash'] == digest:
+        continue
+
+      df = PREPROCESSORS[self.kind](path, engine=engine, compact=self.compact)
+      df = df.sort_values(self.key, kind='mergesort', ignore_index=True)
+      # Source path and content, so files with the same content don't share (and delete) a part
+      source = hashlib.blake2b(path.encode(), digest_size=8).hexdigest()
+      part_file = os.path.join(self.store_dir, f'{source}.{digest}.{_cache_format()}')
+      _write_frame(df, part_file)
+
+      changed = path in self.parts
+      if changed:
+        old_file = self.parts[path]['file']
+        if old_file != part_file and os.path.exists(old_file):
+          os.remove(old_file)
+      self.parts[path] = {'hash': digest, 'file': part_file, 'rows': len(df),
+                          'start': df[self.key].min(), 'aggregates': partial_aggregates(df, self.kind)}
+
+      if changed:
+        # Rows of the old version are mixed with the rest, rebuild totals
+        self.aggregates = self._total_aggregates()
+      else:
+        self.aggregates = add_aggregates(self.aggregates, self.parts[path]['aggregates'])
+      # Merging into loaded data would touch every stored row, data is rebuilt on demand instead
+      self._data = None
+      added.append(path)
+
+    if added:
+      self._save_manifest()
+    return added
+
+  def remove(self, path):
+    """
+    Function that drops a source file from the dataset.
+
+    Args:
+      path (str): path of an ingested csv
+    """
+    part = self.parts.pop(os.path.abspath(path))
+    if os.path.exists(part['file']):
+      os.remove(part['file'])
+    self.aggregates = self._total_aggregates()
+    self._data = None
+    self._save_manifest()
+
+  @property
+  def data(self):
+    """
+    Dataframe with every part, sorted by the date column of the kind. Built from the stored
+    parts on first access after an add or remove.
+    """
+    if self._data is None:
+      parts = sorted(self.parts.values(), key=lambda part: part['start'])
+      frames = [_read_frame(part['file']) for part in parts]
+      if not frames:
+        return pd.DataFrame()
+      if self.compact:
+        categories = union_categories(frames)
+        frames = [compact_df(frame, categories) for frame in frames]
+      # Parts of consecutive months don't overlap and only need to be concatenated
+      chunks = [frames[0]]
+      for frame in frames[1:]:
+        last = chunks[-1]
+        if len(last) and len(frame) and last[self.key].iloc[-1] <= frame[self.key].iloc[0]:
+          chunks.append(frame)
+        else:
+          chunks = [_merge_sorted(pd.concat(chunks, ignore_index=True), frame, self.key)]
+      self._data = pd.concat(chunks, ignore_index=True)
+    return self._data
+
+  @property
+  def cube(self):
+    """
+    Cube of every part, added up from the aggregates, to be passed to the report functions with cube=.
+    """
+    return self.aggregates.get('CUBO')
+
+  @property
+  def pacientes(self):
+    """
+    PatientIndex of data, rebuilt only when data changes.
+    """
+    data = self.data
+    if self._pacientes is None or self._pacientes[0] is not data:
+      self._pacientes = (data, PatientIndex(data, self.kind))
+    return self._pacientes[1]
+
+
+def stay_stats(aggregates, por='SECCION'):
+  """
+  Function that computes stay time stats (mean, median, percentiles, outliers) from partial_aggregates.
+
+  Args:
+    aggregates (dict): from partial_aggregates, add_aggregates or preprocess_chunked
+    por: 'SERVICIO', 'SECCION', both or None for the whole dataset
+
+  Returns:
+    tidy pandas dataframe, see StaySketch.stats
+  """
+  return aggregates['ESTADIA'].rollup(por).stats()
+
+
+def stay_means(aggregates):
+  """
+  Function that computes mean stay times per seccion from partial_aggregates.
+
+  Args:
+    aggregates (dict): from partial_aggregates, add_aggregates or preprocess_chunked
+
+  Returns:
+    pandas dataframe with one row per seccion and one timedelta column per STAY_COLUMNS
+  """
+  stats = stay_stats(aggregates)
+  return stats.pivot(index='SECCION', columns='COLUMNA', values='MEDIA')[STAY_COLUMNS].rename_axis(columns=None)
+
+
+# Patient key of every kind of dataset
+PATIENT_KEYS = {
+  'emergencias': 'NHC',
+  'ambulatorio': 'NHC',
+  'hospitalizacion': 'NHC',
+  'lab': 'HC',
+}
+
+# Re-admission window of every kind and the column the previous visit ends at (None: its start)
+REINGRESO_VENTANAS = {
+  'emergencias': ('72h', 'ALTA_ADMIN'),
+  'hospitalizacion': ('30D', 'ALTA_ADMIN'),
+}
+
+
+def _ns(fechas):
+  # Dates or timedeltas as int64 nanoseconds, NaT as the smallest int64
+  dtype = 'timedelta64[ns]' if pd.api.types.is_timedelta64_dtype(fechas) else 'datetime64[ns]'
+  return fechas.to_numpy(dtype=dtype).view(np.int64)
+
+
+class PatientIndex:
+  """
+  Index of the rows of every patient of a dataset, in date order.
+
+  Patients are encoded as integers and rows sorted by (patient, date) once, so the visits of a
+  patient are a contiguous range of orden and the time between visits is one diff over the whole
+  dataset instead of a scan per patient. Rows of a patient with the same date (a stay exported
+  once per diagnosis) are one visit.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    kind (str): 'emergencias', 'ambulatorio', 'hospitalizacion' or 'lab'
+    clave (str): patient column. PATIENT_KEYS[kind] if None.
+    pacientes: pandas Index of patient keys to encode into, to share codes between datasets.
+      The keys of dataframe, in order of appearance, if None. Unknown keys are left out.
+
+  Attributes:
+    pacientes: pandas Index of patient keys, the code of a patient is its position
+    codigos: numpy array with the code of every row of dataframe, -1 if missing or unknown
+    orden: numpy array of row positions sorted by patient and date, rows without code left out
+    inicio: numpy array, the rows of patient i are orden[inicio[i]:inicio[i + 1]]
+    fechas: numpy array of int64 nanoseconds, date of every row in orden
+    nueva: numpy boolean array, True for the rows in orden that start a visit
+  """
+
+  def __init__(self, dataframe, kind, clave=None, pacientes=None):
+    self.kind = kind
+    self.clave = clave or PATIENT_KEYS[kind]
+    self.fecha = DATE_KEYS[kind]
+    if pacientes is None:
+      self.codigos, self.pacientes = pd.factorize(dataframe[self.clave])
+      self.pacientes = pd.Index(self.pacientes, name=self.clave)
+    else:
+      self.pacientes = pacientes
+      self.codigos = pacientes.get_indexer(dataframe[self.clave])
+
+    fechas = _ns(dataframe[self.fecha])
+    if dataframe[self.fecha].is_monotonic_increasing:
+      # Preprocessed datasets are sorted by date already
+      orden = np.argsort(self.codigos, kind='stable')
+    else:
+      orden = np.lexsort((fechas, self.codigos))
+    self.orden = orden[self.codigos[orden] >= 0]
+    codigos = self.codigos[self.orden]
+    self.inicio = np.searchsorted(codigos, np.arange(len(self.pacientes) + 1))
+    self.fechas = fechas[self.orden]
+
+    self.nueva = np.ones(len(self.orden), dtype=bool)
+    self.nueva[1:] = (codigos[1:] != codigos[:-1]) | (self.fechas[1:] != self.fechas[:-1])
+
+  def filas(self, paciente):
+    """
+    Function that returns the rows of a patient.
+
+    Args:
+      paciente: patient key, e.g. a NHC
+
+    Returns:
+      numpy array of row positions, in date order, to be used with dataframe.iloc
+    """
+    codigo = self.pacientes.get_loc(paciente)
+    return self.orden[self.inicio[codigo]:self.inicio[codigo + 1]]
+
+  def visitas(self):
+    """
+    Function that counts the visits of every patient.
+
+    Returns:
+      pandas series indexed by patient key
+    """
+    visitas = np.bincount(self.codigos[self.orden[self.nueva]], minlength=len(self.pacientes))
+    return pd.Series(visitas, index=self.pacientes, name='VISITAS')
+
+  def gaps(self, dataframe, fin=None):
+    """
+    Function that computes the time since the previous visit of the same patient, for every row.
+
+    Args:
+      dataframe: the dataframe the index was built from
+      fin (str): column the previous visit ends at, e.g. 'ALTA_ADMIN'. Its date column if None.
+
+    Returns:
+      pandas series of timedeltas aligned with dataframe, NaT for first visits
+    """
+    nat = np.iinfo(np.int64).min
+    anterior = self.fechas if fin is None else _ns(dataframe[fin])[self.orden]
+    # Last row of the previous visit of every row, -1 for the first visit of a patient
+    previa = np.flatnonzero(self.nueva)[np.cumsum(self.nueva) - 1] - 1
+    primera = self.inicio[self.codigos[self.orden]]
+    validos = previa >= primera
+    validos[validos] = anterior[previa[validos]] != nat
+
+    gap = np.full(len(self.orden), nat)
+    gap[validos] = self.fechas[validos] - anterior[previa[validos]]
+    aligned = np.full(len(dataframe), nat)
+    aligned[self.orden] = gap
+    return pd.Series(aligned.view('timedelta64[ns]'), index=dataframe.index, name='DIF_VISITA_ANTERIOR')
+
+  def reingresos(self, dataframe, ventana=None, fin=None):
+    """
+    Function that flags the rows of visits that are a return of the same patient within a window.
+
+    Visits that start before the previous one ends (overlapping stays) are not returns.
+
+    Args:
+      dataframe: the dataframe the index was built from
+      ventana: maximum time since the previous visit, e.g. '72h'. REINGRESO_VENTANAS[kind] if None.
+      fin (str): same as in gaps. REINGRESO_VENTANAS[kind] if ventana is None too.
+
+    Returns:
+      pandas boolean series aligned with dataframe
+    """
+    if ventana is None:
+      ventana, fin = REINGRESO_VENTANAS[self.kind]
+    gap = self.gaps(dataframe, fin)
+    return ((gap >= pd.Timedelta(0)) & (gap <= pd.Timedelta(ventana))).rename('REINGRESO')
+
+  def tasa_reingreso(self, dataframe, ventana=None, fin=None, por=None):
+    """
+    Function that computes the re-admission rate: share of visits followed by a return of the
+    patient within the window. Returns are counted in the group of the visit they come back from.
+
+    Args:
+      dataframe: the dataframe the index was built from
+      ventana: same as in reingresos
+      fin (str): same as in reingresos
+      por (str): grouping column, e.g. 'SECCION'. Whole dataset if None.
+
+    Returns:
+      pandas dataframe with 'VISITAS', 'REINGRESOS' and '% REINGRESO', one row per group
+    """
+    visitas = self.orden[self.nueva]
+    reingreso = self.reingresos(dataframe, ventana, fin).to_numpy()[visitas]
+    # A return is charged to the visit before it, of the same patient by construction
+    vuelve = np.zeros(len(visitas), dtype=bool)
+    vuelve[:-1] = reingreso[1:]
+
+    grupos = dataframe[por].iloc[visitas].to_numpy() if por else np.full(len(visitas), 'Total')
+    tasa = pd.Series(vuelve).groupby(grupos, sort=False).agg(['size', 'sum'])
+    tasa.columns = ['VISITAS', 'REINGRESOS']
+    tasa.index.name = por
+    tasa['% REINGRESO'] = tasa['REINGRESOS'] / tasa['VISITAS'] * 100
+    return tasa
+
+
+# Steps of a patient journey: (from kind, to kind, window). Every step links a visit to the first
+# visit of the next kind, of the same patient, within the window after it.
+JOURNEY_ETAPAS = [
+  ('emergencias', 'hospitalizacion', '48h'),
+  ('hospitalizacion', 'ambulatorio', '30D'),
+  ('ambulatorio', 'lab', '7D'),
+]
+
+# Column a visit of every kind is followed from: the end of the stay when there is one
+JOURNEY_DESDE = {
+  'emergencias': 'FECHA_HORA_INGRESO',
+  'hospitalizacion': 'ALTA_ADMIN',
+  'ambulatorio': 'FECHA_HORA_TURNO',
+  'lab': 'FECHA',
+}
+
+
+def shared_patient_keys(datasets, clave=None):
+  """
+  Function that collects the patient keys of several datasets into one index, so they share codes.
+
+  Args:
+    datasets (dict): {kind: preprocessed dataframe}
+    clave (str): patient column of every dataset, e.g. 'DNI'. PATIENT_KEYS[kind] if None.
+
+  Returns:
+    pandas Index of patient keys named after the key column ('NHC' when mixed with lab's 'HC'), the
+    code of a patient is its position. See PatientIndex.
+  """
+  columnas = [clave or PATIENT_KEYS[kind] for kind in datasets]
+  claves = pd.concat([dataframe[columna] for columna, dataframe in zip(columnas, datasets.values())], ignore_index=True)
+  # Named after the key, lab's HC is the NHC of the other datasets
+  nombre = columnas[0] if len(set(columnas)) == 1 else 'NHC'
+  return pd.Index(claves.dropna().unique(), name=nombre)
+
+
+def _visitas(dataframe, kind, clave, pacientes):
+  # First row of every visit with its patient code, date and the date it's followed from
+  indice = PatientIndex(dataframe, kind, clave, pacientes=pacientes)
+  filas = indice.orden[indice.nueva]
+  return pd.DataFrame({
+    'PACIENTE_ID': indice.codigos[filas],
+    'FILA': filas,
+    'FECHA': dataframe[DATE_KEYS[kind]].to_numpy(dtype='datetime64[ns]')[filas],
+    'DESDE': dataframe[JOURNEY_DESDE[kind]].to_numpy(dtype='datetime64[ns]')[filas],
+  })
+
+
+def build_journeys(datasets, etapas=JOURNEY_ETAPAS, clave=None):
+  """
+  Function that links every visit of the first kind to the next visits of the same patient in other
+  datasets, e.g. emergency -> hospitalization -> outpatient follow-up -> lab request.
+
+  Patient keys of every dataset are encoded into one integer space and each step is a single
+  merge_asof by patient code, so a year of the four datasets is linked without Python loops.
+
+  Args:
+    datasets (dict): {kind: preprocessed dataframe}. Steps towards a missing kind are skipped,
+      with the ones after them.
+    etapas (list): chained (from kind, to kind, window) steps, see JOURNEY_ETAPAS
+    clave (str): same as in shared_patient_keys
+
+  Returns:
+    pandas dataframe with one row per visit of the first kind, in date order: the patient key (named
+    as in shared_patient_keys) and, for every kind reached, 'FILA_<KIND>' (row position in its
+    dataframe, <NA> if not linked) and 'FECHA_<KIND>'
+  """
+  pacientes = shared_patient_keys(datasets, clave)
+  origen = etapas[0][0]
+  visitas = _visitas(datasets[origen], origen, clave, pacientes)
+  journeys = pd.DataFrame({
+    pacientes.name: pacientes[visitas['PACIENTE_ID']],
+    f'FILA_{origen.upper()}': visitas['FILA'].astype('Int64'),
+    f'FECHA_{origen.upper()}': visitas['FECHA'],
+  })
+  desde, actual = visitas['DESDE'], origen
+
+  for de, hacia, ventana in etapas:
+    if de != actual:
+      raise ValueError(f'Steps must be chained, {de} follows {actual}')
+    if hacia not in datasets:
+      break
+    siguientes = _visitas(datasets[hacia], hacia, clave, pacientes)
+    siguientes = siguientes[siguientes['FECHA'].notna()].sort_values('FECHA', kind='stable')
+    siguientes = siguientes.rename(columns={'DESDE': 'SIGUIENTE_DESDE'})
+
+    # Only visits that reached this step and have a date to follow from
+    left = pd.DataFrame({'PACIENTE_ID': visitas['PACIENTE_ID'], 'DESDE': desde})
+    left = left[left['DESDE'].notna()].sort_values('DESDE', kind='stable')
+    linked = pd.merge_asof(left, siguientes, left_on='DESDE', right_on='FECHA', by='PACIENTE_ID',
+                           direction='forward', tolerance=pd.Timedelta(ventana))
+    linked.index = left.index
+
+    filas = linked['FILA'].reindex(journeys.index).astype('Int64')
+    journeys[f'FILA_{hacia.upper()}'] = filas
+    journeys[f'FECHA_{hacia.upper()}'] = linked['FECHA'].reindex(journeys.index)
+    desde, actual = linked['SIGUIENTE_DESDE'].reindex(journeys.index), hacia
+  return journeys.sort_values(f'FECHA_{origen.upper()}', kind='stable', ignore_index=True)
+
+
+def journey_funnel(journeys):
+  """
+  Function that counts how many journeys reach every step.
+
+  Args:
+    journeys: pandas dataframe from build_journeys
+
+  Returns:
+    pandas dataframe with 'VISITAS', '% INICIO' and '% ANTERIOR', one row per kind
+  """
+  filas = [column for column in journeys.columns if column.startswith('FILA_')]
+  funnel = pd.DataFrame({'VISITAS': [int(journeys[column].notna().sum()) for column in filas]},
+                        index=pd.Index([column[len('FILA_'):] for column in filas], name='ETAPA'))
+  funnel['% INICIO'] = funnel['VISITAS'] / funnel['VISITAS'].iloc[0] * 100
+  funnel['% ANTERIOR'] = funnel['VISITAS'] / funnel['VISITAS'].shift(fill_value=funnel['VISITAS'].iloc[0]) * 100
+  return funnel
+
+
+_HORA = 3600 * 10**9
+
+
+def _hora(fechas):
+  # Hour mark at or after every date, as hours since epoch
+  return -(-_ns(fechas) // _HORA)
+
+
+class OccupancyTimeline:
+  """
+  Hourly census (occupied beds) per group, from admission and discharge times.
+
+  Every stay adds +1 at the first hour mark at or after its admission and -1 at the first one at or
+  after its discharge, and the census is the cumulative sum of those deltas: a patient is counted at
+  every mark t with admission <= t < discharge, and stays are never expanded hour by hour.
+  Deltas add up, so months are added as they arrive without touching the ones already in. Stays
+  without discharge stay open until a later add brings them discharged.
+
+  Args:
+    dataframe: preprocessed hospitalizacion (or emergencias) dataframe. Empty timeline if None.
+    por (str): grouping column, e.g. 'SECCION'
+    ingreso (str): admission column
+    alta (str): discharge column
+  """
+
+  def __init__(self, dataframe=None, por='SECCION', ingreso='FECHA_HORA_INGRESO', alta='ALTA_ADMIN'):
+    self.por, self.ingreso, self.alta = por, ingreso, alta
+    self.grupos = pd.Index([], name=por)
+    self.primera = None
+    self.deltas = np.zeros((0, 0), dtype=np.int64)
+    self.abiertas = None
+    self.descartadas = 0
+    if dataframe is not None:
+      self.add(dataframe)
+
+  def _claves(self, dataframe):
+    # A stay is exported once per diagnosis, these columns tell its rows apart
+    return [column for column in ['NHC', self.ingreso, self.por] if column in dataframe.columns]
+
+  def _extender(self, grupos, primera, ultima):
+    # Make room for new groups and hours [primera, ultima]
+    nuevos = self.grupos.append(pd.Index(grupos, name=self.por)).unique()
+    if self.primera is not None:
+      primera, ultima = min(primera, self.primera), max(ultima, self.primera + self.deltas.shape[1] - 1)
+    deltas = np.zeros((len(nuevos), ultima - primera + 1), dtype=np.int64)
+    if self.primera is not None:
+      desde = self.primera - primera
+      deltas[:len(self.grupos), desde:desde + self.deltas.shape[1]] = self.deltas
+    self.grupos, self.primera, self.deltas = nuevos, primera, deltas
+
+  def add(self, dataframe):
+    """
+    Function that adds the stays of a new export (e.g. a month) to the timeline.
+
+    Every stay must be added once, except open ones (no discharge), which are replaced when they
+    come again.
+
+    Args:
+      dataframe: preprocessed dataframe with por, ingreso and alta columns
+
+    Returns:
+      number of stays added
+    """
+    claves = self._claves(dataframe)
+    estadias = dataframe[claves + [self.alta]].drop_duplicates(claves)
+    estadias = estadias[estadias[self.ingreso].notna()]
+
+    abiertas = estadias[self.alta].isna()
+    if self.abiertas is not None:
+      # Open stays seen again are taken from the new export
+      previas = self.abiertas.merge(estadias[claves], on=claves, how='left', indicator=True)['_merge'] == 'left_only'
+      self.abiertas = self.abiertas[previas.to_numpy()]
+    self.abiertas = pd.concat([self.abiertas, estadias.loc[abiertas, claves]], ignore_index=True)
+
+    cerradas = estadias[~abiertas]
+    # Discharges before admission are errors of the export
+    validas = (cerradas[self.alta] >= cerradas[self.ingreso]).to_numpy()
+    self.descartadas += int((~validas).sum())
+    cerradas = cerradas[validas]
+
+    desde, hasta = _hora(cerradas[self.ingreso]), _hora(cerradas[self.alta])
+    inicios = _hora(self.abiertas[self.ingreso])
+    horas = np.concatenate([desde, hasta, inicios])
+    if len(horas):
+      self._extender(pd.concat([cerradas[self.por], self.abiertas[self.por]]).unique(), int(horas.min()), int(horas.max()))
+      grupo = self.grupos.get_indexer(cerradas[self.por])
+      n_horas = self.deltas.shape[1]
+      size = len(self.grupos) * n_horas
+      self.deltas += (np.bincount(grupo * n_horas + desde - self.primera, minlength=size)
+                      - np.bincount(grupo * n_horas + hasta - self.primera, minlength=size)).reshape(len(self.grupos), n_horas)
+    return len(cerradas) + int(abiertas.sum())
+
+  def censo(self, total=True):
+    """
+    Function that computes the census at every hour mark.
+
+    Args:
+      total (bool): add a 'TOTAL' column with every group
+
+    Returns:
+      pandas dataframe with one row per hour and one column per group
+    """
+    deltas = self.deltas.copy()
+    if self.abiertas is not None and len(self.abiertas):
+      np.add.at(deltas, (self.grupos.get_indexer(self.abiertas[self.por]), _hora(self.abiertas[self.ingreso]) - self.primera), 1)
+    horas = pd.date_range(pd.Timestamp((self.primera or 0) * _HORA), periods=deltas.shape[1], freq='h')
+    censo = pd.DataFrame(deltas.cumsum(axis=1).T, index=horas, columns=self.grupos)
+    if total:
+      censo['TOTAL'] = censo.sum(axis=1)
+    return censo
+
+  def picos(self, censo=None):
+    """
+    Function that summarizes the census: mean, median, 95th percentile and peak of every group.
+
+    Args:
+      censo: pandas dataframe from censo, e.g. a slice of some months. The whole census if None.
+
+    Returns:
+      pandas dataframe with 'MEDIA', 'MEDIANA', 'P95', 'MAXIMO' and 'FECHA_MAXIMO' (first hour at
+      the peak), one row per group
+    """
+    if censo is None:
+      censo = self.censo()
+    return pd.DataFrame({
+      'MEDIA': censo.mean(),
+      'MEDIANA': censo.median(),
+      'P95': censo.quantile(0.95),
+      'MAXIMO': censo.max(),
+      'FECHA_MAXIMO': censo.idxmax(),
+    })
+
+
+def preprocess_chunked(path, kind, chunksize=100000):
+  """
+  Function that aggregates an export chunk by chunk, without building the whole dataframe.
+
+  Every chunk goes through the same cleaning as preprocess_* and is reduced to
+  partial_aggregates, so memory is bounded by chunksize.
+
+  Args:
+    path (str): Path to csv
+    kind (str): 'emergencias', 'ambulatorio', 'hospitalizacion' or 'lab'
+    chunksize (int): rows per chunk
+
+  Returns:
+    dict of aggregates, as in partial_aggregates. 'FILAS' holds the number of rows read.
+  """
+  aggregates = {}
+  filas = 0
+  for chunk in read_export_chunks(path, kind, chunksize=chunksize):
+    chunk = clean_export(chunk, kind)
+    aggregates = add_aggregates(aggregates, partial_aggregates(chunk, kind))
+    filas += len(chunk)
+  aggregates['FILAS'] = filas
+  return aggregates
@@ -2,47 +2,141 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import re
-import streamlit as st
 import datetime
+import hashlib
+import os
+import shutil
+from hmn_functions import read_export, clean_export, grupos_etareos, conteos_por_grupo, codificacion_por_grupo, compact_df, evict_cache
+from hmn_functions import output_format, output_path, save_figure, save_chart_data, draw_chart, label_bars
+from hmn_functions import StaySketch, _mostrar_estadias, top_k
+
+# Bump when plot_bar/plot_pie change how charts look, so charts cached by report.render_chart are not reused
+RENDER_VERSION = 2
+RENDER_CACHE_DIRNAME = '.hmn_render_cache'
+RENDER_CACHE_MAX_BYTES = 256 * 1024**2
+
+def render_key(dataframe, **params):
+    """
+    Function that hashes a chart: the plotted data plus every parameter that changes the png.
+
+    Args:
+    dataframe: pandas series or dataframe to plot
+    params: title, labels, sizes, dpi, etc.
+
+    Returns:
+    hex digest (str)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(pd.util.hash_pandas_object(dataframe, index=True).values.tobytes())
+    if isinstance(dataframe, pd.DataFrame):
+        columns, dtypes = list(dataframe.columns), list(dataframe.dtypes.astype(str))
+    else:
+        columns, dtypes = [dataframe.name], [str(dataframe.dtype)]
+    layout = (RENDER_VERSION, columns, dtypes, list(dataframe.index.names), str(dataframe.index.dtype),
+              sorted(params.items()))
+    digest.update(repr(layout).encode())
+    return digest.hexdigest()
+
+def restore_render(key, path, cache_dir):
+    """
+    Function that copies a cached chart to path, if there is one for key.
 
-def plot_bar(dataframe, title, x_label, y_label, save_plot, save_path, rotation=90, figsize=(10,7), fontsize=10, dpi=300):
-    fig, ax = plt.subplots(figsize=figsize)
-    dataframe.plot.bar(fontsize=fontsize,
-                        ax=ax,
-                        rot=rotation)
-    ax.set_title(title)
-    ax.set_xlabel(x_label)
-    ax.set_ylabel(y_label)
-    for j in ax.patches:
-        ax.text(j.get_x(),
-                j.get_height()+ax.get_ylim()[1]/100,
-                str(j.get_height()),
-                fontsize=10,
-                color='dimgrey')
+    Args:
+    key (str): from render_key
+    path (str): destination png or svg
+    cache_dir (str): render cache directory
+
+    Returns:
+    True if the chart was found
+    """
+    cached = os.path.join(cache_dir, key + os.path.splitext(path)[1])
+    if not os.path.exists(cached):
+        return False
+    # Mark as recently used
+    os.utime(cached)
+    shutil.copyfile(cached, path)
+    return True
+
+def store_render(key, path, cache_dir, max_bytes=RENDER_CACHE_MAX_BYTES):
+    """
+    Function that stores a rendered chart under key, deleting least recently used ones over max_bytes.
+
+    Args:
+    key (str): from render_key
+    path (str): png or svg just saved
+    cache_dir (str): render cache directory
+    max_bytes (int): size limit of cache_dir
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = os.path.join(cache_dir, key + os.path.splitext(path)[1])
+    tmp_path = f'{cached}.{os.getpid()}.tmp'
+    shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, cached)
+    evict_cache(cache_dir, max_bytes)
+
+def plot_bar(dataframe, title, x_label, y_label, save_plot, save_path, rotation=90, figsize=(10,7), fontsize=10, dpi=300,
+             fmt=None, canvas=False):
+    """
+    Function that plots a bar chart and optionally saves it as '<title>_barra.<ext>'.
+
+    Args:
+    dataframe: pandas series or dataframe to plot
+    title (str): chart title, also used for the file name
+    x_label (str), y_label (str): axis labels
+    save_plot (bool): save the chart in save_path
+    save_path (str): output directory
+    rotation, figsize, fontsize, dpi: matplotlib options
+    fmt (str): 'png', 'preview' (low dpi png), 'svg' or 'json' (the plotted data), see
+    hmn_functions.OUTPUT_FORMATS. hmn_functions.OUTPUT_FORMAT if None. With 'json' the figure
+    is still drawn for callers that display it, only the saved file changes.
+    canvas (bool): draw on the reusable figure of hmn_functions.chart_canvas, for batch rendering
+
+    Returns:
+    fig, ax
+    """
+    fmt = output_format(fmt)
+    base = f'{save_path}/{title.replace(" ","_")}_barra'
+    path = output_path(base, fmt)
+    fig, ax = draw_chart(dataframe, 'bar', title, x_label, y_label, rotation=rotation, canvas=canvas,
+                         style={'figsize': figsize, 'fontsize': fontsize})
     if save_plot:
-        fig.savefig(f'{save_path}/{title.replace(" ","_")}_barra.png',
-                    dpi=dpi,
-                    bbox_inches='tight')
-    print(f'Guardando \"{title.replace(" ","_")}_barra.png\" en {save_path}')
+        if fmt == 'json':
+            save_chart_data(dataframe, base, tipo='barra', titulo=title, x_label=x_label, y_label=y_label)
+        else:
+            save_figure(fig, base, fmt, dpi)
+    print(f'Guardando \"{os.path.basename(path)}\" en {save_path}')
 
     return fig, ax
 
-def plot_pie(dataframe, column, title, y_label, save_plot, save_path, figsize=(10,10), fontsize=10, dpi=300, autopct='%1.2f%%'):
-    fig, ax = plt.subplots(figsize=figsize)
-    dataframe.plot.pie(y=column,
-                    autopct=autopct,
-                    labels=None,
-                    ax=ax)
-    ax.legend(bbox_to_anchor=(1,1),
-            loc='upper right',
-            labels=dataframe.index)
-    ax.set_title(title, fontsize=fontsize)
-    ax.set_ylabel(y_label)
+def plot_pie(dataframe, column, title, y_label, save_plot, save_path, figsize=(10,10), fontsize=10, dpi=300, autopct='%1.2f%%',
+             fmt=None, canvas=False):
+    """
+    Function that plots a pie chart of a dataframe column and optionally saves it as '<title>_torta.<ext>'.
+
+    Args:
+    dataframe: pandas dataframe or series to plot
+    column (str): column of dataframe with the slice sizes, not used for a series
+    title, y_label, save_plot, save_path: same as in plot_bar
+    figsize, fontsize, dpi, autopct: matplotlib options
+    fmt (str): same as in plot_bar
+    canvas (bool): same as in plot_bar
+
+    Returns:
+    fig, ax
+    """
+    fmt = output_format(fmt)
+    base = f'{save_path}/{title.replace(" ","_")}_torta'
+    path = output_path(base, fmt)
+    fig, ax = draw_chart(dataframe, 'pie', title, y_label=y_label, column=column, canvas=canvas,
+                         style={'figsize': figsize, 'title_fontsize': fontsize, 'autopct': autopct})
     if save_plot:
-        fig.savefig(f'{save_path}/{title.replace(" ","_")}_torta.png',
-                    dpi=300,
-                    bbox_inches='tight')
-    print(f'Guardando \"{title.replace(" ","_")}_torta.png\" en {save_path}')
+        if fmt == 'json':
+            # Series are plotted as they are, as in draw_chart
+            serie = dataframe if isinstance(dataframe, pd.Series) else dataframe[column]
+            save_chart_data(serie, base, tipo='torta', titulo=title, y_label=y_label)
+        else:
+            save_figure(fig, base, fmt, dpi)
+    print(f'Guardando \"{os.path.basename(path)}\" en {save_path}')
     return fig, ax
 
 def motivo_alta(dataframe):
@@ -52,49 +146,27 @@ def motivo_alta(dataframe):
     fig, ax = plt.subplots(figsize=(10,10))
     dataframe['MOTIVO_ALTA'].value_counts(dropna=False).plot.barh(ax=ax)
     ax.set_title("Motivo de alta")
-    for i in ax.patches:
-        if i.get_width() > 1000:
-            ax.text(ax.get_xlim()[1]*.8, i.get_y() + 0.20, str(i.get_width()), fontsize=13, color='white')
-        else:
-            ax.text(i.get_width() + 20, i.get_y() + .20, str(i.get_width()), fontsize=13, color='black')
+    label_bars(ax)
     return [df_display, fig]
 #####################################FUNCIONES EMERGENCIAS#########################################
 
-def preprocess_emergencias(path):
+def preprocess_emergencias(path, engine=None, compact=False):
     """
     Function that preprocesses 'emergencias' csv from Pentaho.
 
     Args:
     path (str): Path to csv to preprocess
+    engine (str): csv parser engine, e.g. 'pyarrow'. Default parser if None.
+    compact (bool): store low cardinality columns as category, see compact_df
 
     Returns:
     Preprocessed pandas dataframe
     """
-    # Read csv
-    df = pd.read_csv(path)
-
-    # Get rid of unnecessary columns
-    df.drop(columns=[f'Unnamed: {i}' for i in range(18,27,1)], inplace=True)
-    df.drop(columns=['Unnamed: 0','Unnamed: 7','Unnamed: 10'], inplace=True)
-
-    # Get rid of unnecessary rows
-    df.drop(range(0,6), inplace=True)
-
-    # Set definitive columns
-    columns = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_INGRESO', 
-            'SERVICIO', 'SECCION', 'ALTA_MEDICA', 'MOTIVO_ALTA', 'ALTA_ADMIN', 
-            'PROFESIONAL', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10']
-    df.columns=columns
-
-    # Convert dates to datetype format
-    df['ALTA_ADMIN'] = pd.to_datetime(df['ALTA_ADMIN'], dayfirst=True)
-    df['ALTA_MEDICA'] = pd.to_datetime(df['ALTA_MEDICA'], dayfirst=True)
-    df['FECHA_HORA_INGRESO'] = pd.to_datetime(df['FECHA_HORA_INGRESO'], dayfirst=True)
+    # Read only useful columns and rows, with definitive column names
+    df = read_export(path, 'emergencias', engine=engine)
 
-    # Create time difference columns
-    df['DIF_ALTA_ADMIN_MEDICA'] = df['ALTA_ADMIN'] - df['ALTA_MEDICA']
-    df['DIF_ALTA_MEDICA_INGRESO'] = df['ALTA_MEDICA'] - df['FECHA_HORA_INGRESO']
-    df['ESTADIA_TOTAL'] = df['ALTA_ADMIN'] - df['FECHA_HORA_INGRESO']
+    # Dates and time difference columns
+    df = clean_export(df, 'emergencias')
 
     # Sort by 'FECHA_HORA_INGRESO'
     df.sort_values('FECHA_HORA_INGRESO', inplace=True)
@@ -106,6 +178,8 @@ def preprocess_emergencias(path):
 
     # Reset index
     df.reset_index(drop=True, inplace=True)
+    if compact:
+        df = compact_df(df)
 
     # Get dates
     #year = pd.DatetimeIndex(df['FECHA_HORA_INGRESO']).year.unique()[0]
@@ -125,8 +199,7 @@ def atenciones_por_seccion(dataframe, save_path, save_plot=False):
     ### Atenciones por sección
 
     # Dataframe
-    seccion = pd.DataFrame({'CANTIDADES':dataframe['SECCION'].value_counts(),
-                            '% TOTAL':np.round(dataframe['SECCION'].value_counts(normalize=True)*100,2)})
+    seccion = top_k(dataframe, 'SECCION', k=None, dropna=True).round({'% TOTAL': 2}).rename(columns={'ATENCIONES': 'CANTIDADES'})
     print(f"Atenciones por sección (Total = {seccion['CANTIDADES'].sum()})\n")
     #display(seccion)
     print('\n\n')
@@ -153,9 +226,7 @@ def atenciones_por_seccion(dataframe, save_path, save_plot=False):
 def top_20_professionals(dataframe, save_path, por_seccion=False, save_plot=False, show_plot=False):
 
     # Prepare df
-    df = pd.DataFrame(dataframe['PROFESIONAL'].value_counts(dropna=False)[:20])
-    df['% TOTAL'] = dataframe['PROFESIONAL'].value_counts(dropna=False, normalize=True) *100
-    df.columns=['ATENCIONES','% TOTAL']
+    df = top_k(dataframe, 'PROFESIONAL', dropna=False)
     print(f'Top 20 profesionales con mayoeres atenciones en todos los servicios')
     #display (df)
     #print('\n')
@@ -171,15 +242,10 @@ def top_20_professionals(dataframe, save_path, por_seccion=False, save_plot=Fals
                     save_path=save_path)
 
     if por_seccion:
-        secciones = dataframe['SECCION'].unique()
         figures=[]
         professionals=[]
         # Dataframe loop
-        for i, secc in enumerate(secciones):
-            secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-            professional = pd.DataFrame(secc_temp['PROFESIONAL'].value_counts(dropna=False))[:20]
-            professional['% TOTAL'] = secc_temp['PROFESIONAL'].value_counts(dropna=False, normalize=True)*100
-            professional.columns=['ATENCIONES', '% TOTAL']      
+        for secc, professional in top_k(dataframe, 'PROFESIONAL', por='SECCION', dropna=False).items():
             # Plot bar
             fig2, axs = plot_bar(professional.drop(columns='% TOTAL'),
                             f'Top 20 profesionales con mayores atenciones en {secc} EMERGENCIAS',
@@ -211,13 +277,11 @@ def atenciones_por_hora(dataframe, save_path, por_servicio=False, save_plot=Fals
                     rotation=0)
 
     if por_servicio:
-        secciones = dataframe['SECCION'].unique()
+        conteos = conteos_por_grupo(dataframe, 'SECCION', dataframe.FECHA_HORA_INGRESO.dt.hour)
         dfs = []
         figures = []
         # Loop plot by seccion
-        for i, secc in enumerate(secciones):
-            secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-            df_horas_temp = secc_temp.FECHA_HORA_INGRESO.dt.hour.value_counts()
+        for secc, df_horas_temp in conteos.items():
             df_horas_temp = df_horas_temp.sort_index()
 
             fig2, axs = plot_bar(df_horas_temp,
@@ -255,13 +319,11 @@ def atenciones_por_dia_semana(dataframe, save_path, save_plot=False, show_plot=F
 
     if por_seccion:
         # Df by seccion
-        secciones = dataframe['SECCION'].unique()
+        conteos = conteos_por_grupo(dataframe, 'SECCION', dataframe['FECHA_HORA_INGRESO'].dt.dayofweek)
         df_dias_seccion=[]
         figures=[]
-        for i, secc in enumerate(secciones):
-            secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-            df_dias = secc_temp['FECHA_HORA_INGRESO'].dt.dayofweek.value_counts()
-            df_dias.sort_index(inplace=True)
+        for secc, df_dias in conteos.items():
+            df_dias = df_dias.sort_index()
             df_dias = df_dias.rename({0:'Lunes', 1:'Martes', 2:'Miércoles', 3:'Jueves', 4:'Viernes', 5:'Sábado', 6:'Domingo'})
 
         # Plot
@@ -284,29 +346,11 @@ def atenciones_grupo_etareo(dataframe, save_path, show_plot=False, save_plot=Fal
     year = pd.DatetimeIndex(dataframe['FECHA_HORA_INGRESO']).year.unique()[0]
     months = pd.DatetimeIndex(dataframe['FECHA_HORA_INGRESO']).month.unique()
 
-    labels=['0 años', '1 a 13', '14 a 21', '22 a 40', '41 a 60', '+61']
-
     # Group classifier
-    grupos = [0,0,0,0,0,0]
-    for i in range(len(dataframe.EDAD)):
-        if dataframe.EDAD[i] == 0:
-            grupos[0] = grupos[0] + 1
-        elif dataframe.EDAD[i] > 0 and dataframe.EDAD[i] < 14:
-            grupos[1] = grupos[1] + 1
-        elif dataframe.EDAD[i] > 14 and dataframe.EDAD[i] < 22:
-            grupos[2] = grupos[2] + 1
-        elif dataframe.EDAD[i] > 22 and dataframe.EDAD[i] < 41:
-            grupos[3] = grupos[3] + 1
-        elif dataframe.EDAD[i] > 41 and dataframe.EDAD[i] < 61:
-            grupos[4] = grupos[4] + 1
-        else:
-            grupos[5] = grupos[5] + 1
+    grupos = grupos_etareos(dataframe)
 
-    # Plot  
-    save_plot=save_plot
-    save_path=save_path
     # Create series to plot pie
-    s = pd.Series(grupos, index=labels, name='CANTIDADES')
+    s = grupos.rename('CANTIDADES')
     # Plot  
     save_plot=save_plot
     save_path=save_path
@@ -319,32 +363,15 @@ def atenciones_grupo_etareo(dataframe, save_path, show_plot=False, save_plot=Fal
 
     if por_seccion:
         # By seccion
-        secciones = dataframe['SECCION'].unique()
+        grupos_seccion = grupos_etareos(dataframe, por='SECCION')
         dfs=[]
         figures=[]
-        for j, secc in enumerate(secciones):
-            secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[j]])
-            secc_temp.reset_index(drop=True, inplace=True)
-            grupos = [0,0,0,0,0,0]
-            for k in range(len(secc_temp.EDAD)):
-                if secc_temp.EDAD[k] == 0:
-                    grupos[0] = grupos[0] + 1
-                elif secc_temp.EDAD[k] > 0 and secc_temp.EDAD[k] < 14:
-                    grupos[1] = grupos[1] + 1
-                elif secc_temp.EDAD[k] > 14 and secc_temp.EDAD[k] < 22:
-                    grupos[2] = grupos[2] + 1
-                elif secc_temp.EDAD[k] > 22 and secc_temp.EDAD[k] < 41:
-                    grupos[3] = grupos[3] + 1
-                elif secc_temp.EDAD[k] > 41 and secc_temp.EDAD[k] < 61:
-                    grupos[4] = grupos[4] + 1
-                else:
-                    grupos[5] = grupos[5] + 1
-
-            s_temp = pd.Series(grupos, index=labels, name='CANTIDADES')
+        for secc, grupos in grupos_seccion.iterrows():
+            s_temp = grupos.rename('CANTIDADES')
             # Plot  
             save_plot=save_plot
             save_path=save_path
-            fig2, axs = plot_pie(dataframe=s,
+            fig2, axs = plot_pie(dataframe=s_temp,
                         column='CANTIDADES',
                         title=f"Atenciones según grupo etáreo {secc.upper()} mes(es) {months[0]} a {months[-1]} de {year}",
                         y_label='',
@@ -376,13 +403,11 @@ def top_20_cod_diagnostics(dataframe, save_path, save_plot=False, show_plot=Fals
         figures=[]
         sin_cod_seccion=[]
         total_atenciones_seccion=[]
-        secciones = dataframe['SECCION'].unique()
-        for i, secc in enumerate(secciones):
-            secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-            sin_cod_temp = secc_temp['CIE10'].isna().sum()
-            total_atenciones_temp = len(secc_temp.CIE10)
-            if len(secc_temp['CIE10'].value_counts(dropna=False)) > 1:
-                fig2, axs = plot_bar(dataframe=secc_temp['CIE10'].value_counts()[:20],
+        codificacion = codificacion_por_grupo(dataframe, 'SECCION')
+        conteos = conteos_por_grupo(dataframe, 'SECCION', 'CIE10')
+        for secc, (sin_cod_temp, total_atenciones_temp) in codificacion.iterrows():
+            if secc in conteos:
+                fig2, axs = plot_bar(dataframe=conteos[secc][:20],
                                     title=f'Top 20 diagnósticos codificados con CIE10 en {secc}',
                                     x_label='DIAGNÓSTICOS',
                                     y_label='CANTIDAD',
@@ -391,7 +416,8 @@ def top_20_cod_diagnostics(dataframe, save_path, save_plot=False, show_plot=Fals
                 if show_plot==0:
                     plt.close(fig2)     
             else:
-                fig2, axs = plot_bar(dataframe=secc_temp['CIE10'].value_counts(dropna=False),
+                # Only uncoded diagnostics in this seccion
+                fig2, axs = plot_bar(dataframe=pd.Series({np.nan: sin_cod_temp}, name='CIE10'),
                                     title=f'Top 20 diagnósticos codificados con CIE10 en {secc}',
                                     x_label='DIAGNÓSTICOS',
                                     y_label='CANTIDAD',
@@ -406,71 +432,35 @@ def top_20_cod_diagnostics(dataframe, save_path, save_plot=False, show_plot=Fals
     return [fig, sin_cod, total_atenciones]
 
 def promedios_tiempo(dataframe):
-    st.write('Medias de tiempo según estado del paciente:')
-    st.write(f"="*85)
-    st.write(f"Entre Ingreso y Alta Médica: {dataframe['DIF_ALTA_MEDICA_INGRESO'].mean()}")
-    st.write(f"Entre Alta Médica y Alta Administrativa: {dataframe['DIF_ALTA_ADMIN_MEDICA'].mean()}")
-    st.write(f"Entre Ingreso y Alta Administrativa: {dataframe['ESTADIA_TOTAL'].mean()}")
-    st.write(f"="*85)
-    #st.write(f"Mediana de tiempo entre Alta Médica e Ingreso: {dataframe['DIF_ALTA_MEDICA_INGRESO'].median()}")
-    #st.write(f"Mediana de tiempo entre Alta administrativa e Ingreso: {dataframe['ESTADIA_TOTAL'].median()}")
-    #st.write(f"Mediana de tiempo entre Alta administrativa y Alta médica: {dataframe['DIF_ALTA_ADMIN_MEDICA'].median()}")
-
-    secciones = dataframe['SECCION'].unique()
+    # Imported here so the plotting helpers can run headless, without streamlit (see report.py)
+    import streamlit as st
+    # Every section in one pass, the whole dataset is the sum of the sections
+    sketch = StaySketch(dataframe, por='SECCION')
+    _mostrar_estadias(sketch.rollup().stats(), '', write=st.write)
+
     st.subheader('Por Sección')
-    for i, secc in enumerate(secciones):
-        secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-
-        st.write(f'\nMedias de tiempo según estado del paciente en **{secc}**:')
-        st.write(f"Entre Ingreso y Alta Médica en {secc}: {secc_temp['DIF_ALTA_MEDICA_INGRESO'].mean()}")
-        st.write(f"Entre Alta Médica y Alta Administrativa en {secc}: {secc_temp['DIF_ALTA_ADMIN_MEDICA'].mean()}")
-        st.write(f"Entre Ingreso y Alta Administrativa en {secc}: {secc_temp['ESTADIA_TOTAL'].mean()}")
-        st.write(f"="*85)
-        #st.write(f"Mediana de tiempo entre Alta Médica e Ingreso en {secc}: {secc_temp['DIF_ALTA_MEDICA_INGRESO'].median()}")
-        #st.write(f"Mediana de tiempo entre Alta administrativa e Ingreso en {secc}: {secc_temp['ESTADIA_TOTAL'].median()}")
-        #st.write(f"Mediana de tiempo entre Alta administrativa y Alta médica en {secc}: {secc_temp['DIF_ALTA_ADMIN_MEDICA'].median()}")
+    for secc, secc_stats in sketch.stats().groupby('SECCION', sort=False, dropna=False):
+        _mostrar_estadias(secc_stats, f' en **{secc}**', write=st.write)
 
 #####################################FUNCIONES AMBULATORIOS#########################################
 
-def preprocess_ambulatorio(path):
+def preprocess_ambulatorio(path, engine=None, compact=False):
     """
     Function that preprocesses 'ambulatorio' csv from Pentaho.
     
     Args:
         path (str): Path to csv to preprocess
+        engine (str): csv parser engine, e.g. 'pyarrow'. Default parser if None.
+        compact (bool): store low cardinality columns as category, see compact_df
 
     Returns:
         Preprocessed pandas dataframe
     """
-    # Read csv
-    df = pd.read_csv(path)
+    # Read only useful columns and rows, with definitive column names
+    df = read_export(path, 'ambulatorio', engine=engine)
 
-    # Get rid of unnecessary columns
-    df = df.drop(columns=['Unnamed: 15'])
-
-    # Get rid of unnecessary rows
-    df = df.drop(range(0,4))
-
-    # Set definitive columns
-    columns = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_TURNO', 
-                'HORA_TURNO', 'SERVICIO', 'SECCION', 'PRESTACION', 'AGENDA', 
-                'MOTIVO_ALTA', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10']
-    df.columns=columns
-
-    # Merge 'FECHA_TURNO' and 'HORA_TURNO', so as to convert to datetime
-    df['FECHA_HORA_TURNO'] = df['FECHA_TURNO'] + ' ' + df['HORA_TURNO']
-
-    # Convert dates to datetype format
-    df['FECHA_HORA_TURNO'] = pd.to_datetime(df['FECHA_HORA_TURNO'], dayfirst=True)
-
-    # Drop 'FECHA_TURNO' and 'HORA_TURNO'
-    df = df.drop(columns=['FECHA_TURNO','HORA_TURNO'])
-
-    # Reorder columns
-    columns = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_TURNO',
-            'SERVICIO', 'SECCION', 'PRESTACION', 'AGENDA', 
-            'MOTIVO_ALTA', 'DIAGNOSTICO', 'CIE10', 'DESC_CIE10']
-    df = df[columns]
+    # Merge 'FECHA_TURNO' and 'HORA_TURNO' into datetime, reorder columns
+    df = clean_export(df, 'ambulatorio')
 
     # Sort by 'AGENDA', then 'FECHA_TURNO', then 'HORA_TURNO'
     df.sort_values(by=['SERVICIO', 'SECCION', 'FECHA_HORA_TURNO'], inplace=True)
@@ -482,6 +472,8 @@ def preprocess_ambulatorio(path):
 
     # Reset index
     df.reset_index(drop=True, inplace=True)
+    if compact:
+        df = compact_df(df)
     return df
 
 def atenciones(dataframe, save_path, show_plot=False, save_plot=False, por_servicio=True, por_seccion=False, torta=False, barra=True):
@@ -539,27 +531,25 @@ def atenciones(dataframe, save_path, show_plot=False, save_plot=False, por_servi
 
     if por_seccion:
         # Get all servicios
-        servicios = dataframe['SERVICIO'].unique()
+        conteos = conteos_por_grupo(dataframe, 'SERVICIO', 'SECCION', dropna=False)
         dfs=[]
         figures_torta=[]
         figures_barra=[]
-        for i, secc in enumerate(servicios):
-            # Create dataframe with only servicios[i]
-            df_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[i]])
-            # Create dataframe with value counts of servicios[i]
-            df_temp = pd.DataFrame(df_temp['SECCION'].value_counts(dropna=False))
+        for servicio, conteo in conteos.items():
+            # Create dataframe with value counts of servicio
+            df_temp = pd.DataFrame(conteo)
             # Reset indexes
             df_temp = df_temp.reset_index()
             # Set columns names
             df_temp.columns=['SECCION','CANTIDADES']
-            print(f"Atenciones en {servicios[i]} (Total = {df['CANTIDADES'].sum()})\n")
+            print(f"Atenciones en {servicio} (Total = {df_temp['CANTIDADES'].sum()})\n")
             dfs.append(df_temp)
             if torta:
                 # Plot pie
                 df_bar = df_temp.set_index('SECCION') #change index for plotting SERVICIOS not numbers
                 fig_torta, ax = plot_pie(dataframe=df_bar,
                                         column='CANTIDADES',
-                                        title=f'Atenciones en {servicios[i]} AMBULATORIO mes(es) {months[0]} a {months[-1]} de {year}',
+                                        title=f'Atenciones en {servicio} AMBULATORIO mes(es) {months[0]} a {months[-1]} de {year}',
                                         y_label='ATENCIONES',
                                         save_plot=save_plot,
                                         save_path=save_path)
@@ -569,7 +559,7 @@ def atenciones(dataframe, save_path, show_plot=False, save_plot=False, por_servi
             if barra:
                 # Plot bar
                 fig_barra, ax = plot_bar(dataframe=df_temp.set_index('SECCION'),
-                                        title=f'Atenciones en {servicios[i]} AMBULATORIO mes(es) {months[0]} a {months[-1]} de {year}',
+                                        title=f'Atenciones en {servicio} AMBULATORIO mes(es) {months[0]} a {months[-1]} de {year}',
                                         x_label='SECCIONES',
                                         y_label='ATENCIONES',
                                         save_plot=save_plot,
@@ -604,15 +594,13 @@ def top_20_cod_diagnostics_ambulatorio(dataframe, save_path, save_plot=False, sh
         figures_secc=[]
         sin_cod_secc=[]
         total_secc=[]
-        secciones = dataframe['SECCION'].unique()
-        for i, secc in enumerate(secciones):
-            secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-            sin_cod_temp = secc_temp['CIE10'].isna().sum()
-            total_atenciones_temp = len(secc_temp.CIE10)
+        codificacion = codificacion_por_grupo(dataframe, 'SECCION')
+        conteos = conteos_por_grupo(dataframe, 'SECCION', 'CIE10')
+        for secc, (sin_cod_temp, total_atenciones_temp) in codificacion.iterrows():
             # If - else, in case seccion only has nan values
-            if len(secc_temp['CIE10'].value_counts(dropna=False)) > 1:      
+            if secc in conteos:
             # Plot bar
-                fig_secc, axs = plot_bar(dataframe=secc_temp['CIE10'].value_counts()[:20],
+                fig_secc, axs = plot_bar(dataframe=conteos[secc][:20],
                                     title=f'Top 20 diagnósticos codificados con CIE10 AMBULATORIO en {secc} en mes(es) {months[0]} a {months[-1]} de {year}',
                                     x_label='CÓDIGO CIE10',
                                     y_label='CANTIDAD',
@@ -625,7 +613,7 @@ def top_20_cod_diagnostics_ambulatorio(dataframe, save_path, save_plot=False, sh
                 sin_cod_secc.append(sin_cod_temp)
                 total_secc.append(total_atenciones_temp)
             else:
-                fig_secc, axs = plot_bar(dataframe=secc_temp['CIE10'].value_counts(dropna=False),
+                fig_secc, axs = plot_bar(dataframe=pd.Series({np.nan: sin_cod_temp}, name='CIE10'),
                                     title=f'Top 20 diagnósticos codificados con CIE10 AMBULATORIO en {secc} en mes(es) {months[0]} a {months[-1]} de {year}',
                                     x_label='CÓDIGO CIE10',
                                     y_label='CANTIDAD',
@@ -639,17 +627,15 @@ def top_20_cod_diagnostics_ambulatorio(dataframe, save_path, save_plot=False, sh
                 total_secc.append(total_atenciones_temp)                
     if por_servicio:  
         # By service
-        servicios = dataframe['SERVICIO'].unique()
+        codificacion = codificacion_por_grupo(dataframe, 'SERVICIO')
+        conteos = conteos_por_grupo(dataframe, 'SERVICIO', 'CIE10')
         figures_serv=[]
         sin_cod_serv=[]
         total_serv=[]
-        for i, serv in enumerate(servicios):
-            serv_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[i]])
-            sin_cod_temp = serv_temp['CIE10'].isna().sum()
-            total_atenciones_temp = len(serv_temp.CIE10)
-
-            if len(serv_temp['CIE10'].value_counts(dropna=False)) > 1:
-                fig_serv, axs = plot_bar(dataframe=serv_temp['CIE10'].value_counts()[:20],
+        for serv, (sin_cod_temp, total_atenciones_temp) in codificacion.iterrows():
+            # If - else, in case servicio only has nan values
+            if serv in conteos:
+                fig_serv, axs = plot_bar(dataframe=conteos[serv][:20],
                                         title=f'Top 20 diagnósticos codificados con CIE10 AMBULATORIO en {serv} en mes(es) {months[0]} a {months[-1]} de {year}',
                                         x_label='CÓDIGO CIE10',
                                         y_label='CANTIDAD',
@@ -662,7 +648,7 @@ def top_20_cod_diagnostics_ambulatorio(dataframe, save_path, save_plot=False, sh
                 sin_cod_serv.append(sin_cod_temp)
                 total_serv.append(total_atenciones_temp)
             else:
-                fig_serv, axs = plot_bar(dataframe=serv_temp['CIE10'].value_counts(dropna=False),
+                fig_serv, axs = plot_bar(dataframe=pd.Series({np.nan: sin_cod_temp}, name='CIE10'),
                                         title=f'Top 20 diagnósticos codificados con CIE10 AMBULATORIO en {serv} en mes(es) {months[0]} a {months[-1]} de {year}',
                                         x_label='CÓDIGO CIE10',
                                         y_label='CANTIDAD',
@@ -696,13 +682,11 @@ def atenciones_por_hora_ambulatorio(dataframe, save_path, show_plot=False, save_
                         rotation=0)
 
     if por_servicio:
-        servicios = dataframe['SERVICIO'].unique()
+        conteos = conteos_por_grupo(dataframe, 'SERVICIO', dataframe.FECHA_HORA_TURNO.dt.hour)
         dfs=[]
         figures=[]
         # Loop plot by seccion
-        for i, serv in enumerate(servicios):
-            serv_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[i]])
-            df_horas_temp = serv_temp.FECHA_HORA_TURNO.dt.hour.value_counts()
+        for serv, df_horas_temp in conteos.items():
             df_horas_temp = df_horas_temp.sort_index()
             dfs.append(df_horas_temp)
             # Plot
@@ -742,12 +726,10 @@ def atenciones_por_dia_semana_ambulatorio(dataframe, save_path, show_plot=False,
 
     # Df by seccion
     if por_servicio:
-        servicios = dataframe['SERVICIO'].unique()
+        conteos = conteos_por_grupo(dataframe, 'SERVICIO', dataframe['FECHA_HORA_TURNO'].dt.dayofweek)
         figures=[]
-        for i, serv in enumerate(servicios):
-            serv_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[i]])
-            df_dias = serv_temp['FECHA_HORA_TURNO'].dt.dayofweek.value_counts()
-            df_dias.sort_index(inplace=True)
+        for serv, df_dias in conteos.items():
+            df_dias = df_dias.sort_index()
             df_dias = df_dias.rename({0:'Lunes', 1:'Martes', 2:'Miércoles', 3:'Jueves', 4:'Viernes', 5:'Sábado', 6:'Domingo'})
             # Plot bar
             fig_serv, axs = plot_bar(dataframe=df_dias,
@@ -768,26 +750,11 @@ def atenciones_grupo_etareo_ambulatorio(dataframe, save_path, show_plot=False, s
     year = pd.DatetimeIndex(dataframe['FECHA_HORA_TURNO']).year.unique()[0]
     months = pd.DatetimeIndex(dataframe['FECHA_HORA_TURNO']).month.unique()
 
-    labels=['0 años', '1 a 13', '14 a 21', '22 a 40', '41 a 60', '+61']
-
     # Group classifier
-    grupos = [0,0,0,0,0,0]
-    for i in range(len(dataframe.EDAD)):
-        if dataframe.EDAD[i] == 0:
-            grupos[0] = grupos[0] + 1
-        elif dataframe.EDAD[i] > 0 and dataframe.EDAD[i] < 14:
-            grupos[1] = grupos[1] + 1
-        elif dataframe.EDAD[i] > 14 and dataframe.EDAD[i] < 22:
-            grupos[2] = grupos[2] + 1
-        elif dataframe.EDAD[i] > 22 and dataframe.EDAD[i] < 41:
-            grupos[3] = grupos[3] + 1
-        elif dataframe.EDAD[i] > 41 and dataframe.EDAD[i] < 61:
-            grupos[4] = grupos[4] + 1
-        else:
-            grupos[5] = grupos[5] + 1
+    grupos = grupos_etareos(dataframe)
 
     # Create series to plot pie
-    s = pd.Series(grupos, index=labels, name='EDADES')
+    s = grupos.rename('EDADES')
     # Plot  
     save_plot=save_plot
     save_path=save_path
@@ -800,28 +767,11 @@ def atenciones_grupo_etareo_ambulatorio(dataframe, save_path, show_plot=False, s
 
     if por_servicio:
     # By seccion
-        servicios = dataframe['SERVICIO'].unique()
+        grupos_servicio = grupos_etareos(dataframe, por='SERVICIO')
         dfs = []
         figures = []
-        for j, serv in enumerate(servicios):
-            serv_temp = pd.DataFrame(dataframe[dataframe['SERVICIO']==servicios[j]])
-            serv_temp.reset_index(drop=True, inplace=True)
-            grupos = [0,0,0,0,0,0]
-            for k in range(len(serv_temp.EDAD)):
-                if serv_temp.EDAD[k] == 0:
-                    grupos[0] = grupos[0] + 1
-                elif serv_temp.EDAD[k] > 0 and serv_temp.EDAD[k] < 14:
-                    grupos[1] = grupos[1] + 1
-                elif serv_temp.EDAD[k] > 14 and serv_temp.EDAD[k] < 22:
-                    grupos[2] = grupos[2] + 1
-                elif serv_temp.EDAD[k] > 22 and serv_temp.EDAD[k] < 41:
-                    grupos[3] = grupos[3] + 1
-                elif serv_temp.EDAD[k] > 41 and serv_temp.EDAD[k] < 61:
-                    grupos[4] = grupos[4] + 1
-                else:
-                    grupos[5] = grupos[5] + 1
-
-            s_temp = pd.Series(grupos, index=labels, name='EDADES')
+        for serv, grupos in grupos_servicio.iterrows():
+            s_temp = grupos.rename('EDADES')
             dfs.append(s_temp)
             # Plot  
             save_plot=save_plot
@@ -840,40 +790,22 @@ def atenciones_grupo_etareo_ambulatorio(dataframe, save_path, show_plot=False, s
 
 ###################################FUNCIONES HOSPITALIZACION######################################
 
-def preprocess_hospitalizacion(path):
+def preprocess_hospitalizacion(path, engine=None, compact=False):
   """
   Function that preprocesses 'hospitalizacion' csv from Pentaho.
   
   Args:
     path (str): Path to csv to preprocess
+    engine (str): csv parser engine, e.g. 'pyarrow'. Default parser if None.
+    compact (bool): store low cardinality columns as category, see compact_df
   Returns:
     Preprocessed pandas dataframe
   """
-  # Read csv
-  df = pd.read_csv(path)
-
-  # Get rid of unnecessary columns
-  df.drop(columns=[f'Unnamed: {i}' for i in range(16,24,1)], inplace=True)
-  df.drop(columns=['Unnamed: 0'], inplace=True)
-
-  # Get rid of unnecessary rows
-  df.drop(range(0,6), inplace=True)
-
-  # Set definitive columns
-  columns = ['DNI', 'NHC', 'PACIENTE', 'SEXO', 'EDAD', 'FECHA_HORA_INGRESO', 
-          'SERVICIO', 'SECCION', 'ALTA_MEDICA', 'MOTIVO_ALTA', 'ALTA_ADMIN', 
-          'PROFESIONAL', 'DIAGNOSTICO_LIBRE', 'CIE10', 'DESC_CIE10']
-  df.columns=columns
-
-  # Convert dates to datetype format
-  df['ALTA_ADMIN'] = pd.to_datetime(df['ALTA_ADMIN'], dayfirst=True)
-  df['ALTA_MEDICA'] = pd.to_datetime(df['ALTA_MEDICA'], dayfirst=True)
-  df['FECHA_HORA_INGRESO'] = pd.to_datetime(df['FECHA_HORA_INGRESO'], dayfirst=True)
+  # Read only useful columns and rows, with definitive column names
+  df = read_export(path, 'hospitalizacion', engine=engine)
 
-  # Create time difference columns
-  df['DIF_ALTA_ADMIN_MEDICA'] = df['ALTA_ADMIN'] - df['ALTA_MEDICA']
-  df['DIF_ALTA_MEDICA_INGRESO'] = df['ALTA_MEDICA'] - df['FECHA_HORA_INGRESO']
-  df['ESTADIA_TOTAL'] = df['ALTA_ADMIN'] - df['FECHA_HORA_INGRESO']
+  # Dates and time difference columns
+  df = clean_export(df, 'hospitalizacion')
 
   # Sort by 'FECHA_HORA_INGRESO'
   df.sort_values(by=['FECHA_HORA_INGRESO', 'SERVICIO'], inplace=True)
@@ -885,19 +817,22 @@ def preprocess_hospitalizacion(path):
 
   # Reset index
   df.reset_index(drop=True, inplace=True)
+  if compact:
+    df = compact_df(df)
   return df
 
 def atenciones_hosp(dataframe, save_path, show_plot=False, save_plot=False):
     year = pd.DatetimeIndex(dataframe['FECHA_HORA_INGRESO']).year.unique()[0]
     months = pd.DatetimeIndex(dataframe['FECHA_HORA_INGRESO']).month.unique()    
     # Defino los dos servicios principales
-    toco = dataframe[dataframe['SERVICIO']=='Tocoginecología']
-    neo = dataframe[dataframe['SERVICIO']=='Neonatología']
+    conteos = conteos_por_grupo(dataframe, 'SERVICIO', 'SECCION')
+    toco = conteos.get('Tocoginecología', pd.Series(dtype=int))
+    neo = conteos.get('Neonatología', pd.Series(dtype=int))
     # Genero df's con totales
-    toco_df = pd.DataFrame({'ATENCIONES':toco['SECCION'].value_counts(),
-                            '% TOTAL':np.round(toco['SECCION'].value_counts(normalize=True)*100,2)})
-    neo_df = pd.DataFrame({'ATENCIONES':neo['SECCION'].value_counts(),
-                            '% TOTAL':np.round(neo['SECCION'].value_counts(normalize=True)*100,2)})
+    toco_df = pd.DataFrame({'ATENCIONES':toco,
+                            '% TOTAL':np.round(toco/toco.sum()*100,2)})
+    neo_df = pd.DataFrame({'ATENCIONES':neo,
+                            '% TOTAL':np.round(neo/neo.sum()*100,2)})
     total_toco = toco_df.ATENCIONES.sum()
     total_neo = neo_df.ATENCIONES.sum()
 
@@ -953,14 +888,15 @@ def top_20_professionals_hosp(dataframe, save_path, show_plot=False, save_plot=F
     months = dataframe.FECHA_HORA_INGRESO.dt.month.unique()
 
     # Defino los dos servicios principales
-    toco = dataframe[dataframe['SERVICIO']=='Tocoginecología']
-    neo = dataframe[dataframe['SERVICIO']=='Neonatología']
+    conteos = conteos_por_grupo(dataframe, 'SERVICIO', 'PROFESIONAL')
+    toco = conteos.get('Tocoginecología', pd.Series(dtype=int))
+    neo = conteos.get('Neonatología', pd.Series(dtype=int))
 
     # Me quedo con las columnas que quiero solamente
-    toco_df = pd.DataFrame({'ATENCIONES':toco['PROFESIONAL'].value_counts(),
-                            '% TOTAL':np.round(toco['PROFESIONAL'].value_counts(normalize=True)*100,2)})
-    neo_df = pd.DataFrame({'ATENCIONES':neo['PROFESIONAL'].value_counts(),
-                            'SECCION':np.round(neo['PROFESIONAL'].value_counts(normalize=True)*100,2)})
+    toco_df = pd.DataFrame({'ATENCIONES':toco,
+                            '% TOTAL':np.round(toco/toco.sum()*100,2)})
+    neo_df = pd.DataFrame({'ATENCIONES':neo,
+                            'SECCION':np.round(neo/neo.sum()*100,2)})
 
     save_plot=save_plot
     save_path=save_path
@@ -1006,15 +942,13 @@ def atenciones_por_hora_hosp(dataframe, save_path, show_plot=False, save_plot=Fa
                     rotation=0)
     
     if por_servicio:
-        secciones = dataframe['SECCION'].unique()
+        conteos = conteos_por_grupo(dataframe, 'SECCION', dataframe.FECHA_HORA_INGRESO.dt.hour)
         figures=[]
         # Loop plot by seccion
-        for i, secc in enumerate(secciones):
-            secc_temp = pd.DataFrame(dataframe[dataframe['SECCION']==secciones[i]])
-            df_horas_temp = secc_temp.FECHA_HORA_INGRESO.dt.hour.value_counts()
+        for secc, df_horas_temp in conteos.items():
             df_horas_temp = df_horas_temp.sort_index()
             
-            fig_secc, axs = plot_bar(dataframe=df_horas,
+            fig_secc, axs = plot_bar(dataframe=df_horas_temp,
                                     title=f'Atenciones por hora {secc} HOSPITALIZACIÓN mes(es) {months[0]} a {months[-1]} de {year}',
                                     x_label='HORAS',
                                     y_label='ATENCIONES',
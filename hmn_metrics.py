@@ -0,0 +1,370 @@
+"""
+Metrics of the patient record exports, as data only.
+
+Every metric takes a preprocessed dataframe and returns a MetricResult: a tidy dataframe plus the
+period, total and uncoded count. Nothing here imports matplotlib, so scheduled jobs don't pay for
+figures. MetricResult.plot draws a result with hmn_functions.draw_chart when a chart is needed.
+"""
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+from hmn_functions import DATE_KEYS, EDAD_LABELS, STAY_COLUMNS, REINGRESO_VENTANAS, OccupancyTimeline, PatientIndex, StaySketch
+from hmn_functions import _grupo_etareo, codificacion_por_grupo, draw_chart
+
+DIAS_SEMANA = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+
+
+@dataclass
+class MetricResult:
+  """
+  Class that holds the result of a metric.
+
+  Attributes:
+    nombre (str): metric name, one of METRICS keys
+    data: tidy pandas dataframe. Counts are in 'ATENCIONES' and '% TOTAL' (within each group).
+    por (list): grouping columns of data, empty if none
+    valor (str): column of data with the counted value, e.g. 'HORA'. None if data isn't counts.
+    periodo (tuple): first and last date of the rows, (None, None) if there are none
+    total (int): rows the metric was computed on
+    sin_codificar (int): rows without CIE10, only for diagnostics metrics
+    meta (dict): anything else specific to the metric
+  """
+  nombre: str
+  data: pd.DataFrame
+  por: list
+  valor: str
+  periodo: tuple
+  total: int
+  sin_codificar: int = None
+  meta: dict = field(default_factory=dict)
+
+  def serie(self, grupo=None):
+    """
+    Method that returns the counts as a pandas series indexed by valor.
+
+    Args:
+      grupo: value of the por column (tuple if several) to keep. Every group added up if None.
+
+    Returns:
+      pandas series of counts
+    """
+    data = self.data
+    if self.por and grupo is not None:
+      grupo = grupo if isinstance(grupo, tuple) else (grupo,)
+      for column, value in zip(self.por, grupo):
+        data = data[data[column] == value]
+    serie = data.groupby(self.valor, sort=False, dropna=False, observed=True)['ATENCIONES'].sum()
+    return serie.rename('ATENCIONES')
+
+  def plot(self, kind='bar', grupo=None, title=None, **kwargs):
+    """
+    Method that draws the result, see hmn_functions.draw_chart. Imports matplotlib on first use.
+
+    Args:
+      kind (str): 'bar', 'barh' or 'pie'
+      grupo: same as in serie
+      title (str): chart title. Metric name and period if None.
+      kwargs: passed to draw_chart
+
+    Returns:
+      fig, ax
+    """
+    if title is None:
+      inicio, fin = self.periodo
+      title = self.nombre.replace('_', ' ').capitalize() + (f' {grupo}' if grupo is not None else '')
+      if inicio is not None:
+        title += f" | {inicio:%m-%Y} a {fin:%m-%Y}"
+    return draw_chart(self.serie(grupo), kind, title, x_label=self.valor, **kwargs)
+
+
+def _fechas(dataframe, kind):
+  # Date column of the kind, guessed from the columns if no kind is given
+  if kind is not None:
+    return dataframe[DATE_KEYS[kind]]
+  for column in DATE_KEYS.values():
+    if column in dataframe.columns:
+      return dataframe[column]
+  raise ValueError('No date column found, pass kind')
+
+
+def _periodo(fechas):
+  fechas = fechas.dropna()
+  if fechas.empty:
+    return (None, None)
+  return (fechas.min(), fechas.max())
+
+
+def _por(por):
+  if por is None:
+    return []
+  return [por] if isinstance(por, str) else list(por)
+
+
+def _conteos(dataframe, por, valores, orden='valor', dropna=True, observed=True, n=None):
+  """
+  Function that counts a value, optionally within groups, as a tidy dataframe.
+
+  Args:
+    dataframe: pandas dataframe
+    por (list): grouping columns
+    valores: pandas series aligned with dataframe, named as the output column
+    orden (str): 'valor' to sort by value, 'cantidad' by count (descending) within each group
+    dropna (bool): same as in value_counts
+    observed (bool): keep only observed categories, False to list empty age groups
+    n (int): keep the first n rows of every group
+
+  Returns:
+    pandas dataframe with por columns, the valores column, 'ATENCIONES' and '% TOTAL'
+  """
+  keys = [dataframe[column] for column in por] + [valores]
+  counts = valores.groupby(keys, sort=orden == 'valor', dropna=dropna, observed=observed).size()
+  counts = counts.rename('ATENCIONES').reset_index()
+  if por:
+    totals = counts.groupby(por, sort=False, dropna=False, observed=True)['ATENCIONES'].transform('sum')
+  else:
+    totals = counts['ATENCIONES'].sum()
+  counts['% TOTAL'] = counts['ATENCIONES'] / totals * 100
+
+  if orden == 'cantidad':
+    counts = counts.sort_values(por + ['ATENCIONES'], ascending=[True] * len(por) + [False], kind='stable')
+  if n is not None:
+    counts = counts.groupby(por, sort=False, dropna=False, observed=True).head(n) if por else counts.head(n)
+  return counts.reset_index(drop=True)
+
+
+def atenciones(dataframe, valor='SERVICIO', por=None, kind=None):
+  """
+  Function that counts attentions by service, section or any other column.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    valor (str): column to count, e.g. 'SERVICIO' or 'SECCION'
+    por: grouping column(s), e.g. 'SERVICIO' to count sections within every service
+    kind (str): 'emergencias', 'ambulatorio' or 'hospitalizacion'. Guessed from the columns if None.
+
+  Returns:
+    MetricResult, sorted by count within each group
+  """
+  por = _por(por)
+  data = _conteos(dataframe, por, dataframe[valor], orden='cantidad', dropna=False)
+  return MetricResult('atenciones', data, por, valor, _periodo(_fechas(dataframe, kind)), len(dataframe))
+
+
+def atenciones_por_hora(dataframe, por=None, kind=None):
+  """
+  Function that counts attentions by hour of the day.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    por: grouping column(s), e.g. 'SECCION'
+    kind (str): same as in atenciones
+
+  Returns:
+    MetricResult with a 'HORA' column (0 to 23)
+  """
+  por = _por(por)
+  fechas = _fechas(dataframe, kind)
+  data = _conteos(dataframe, por, fechas.dt.hour.rename('HORA'))
+  return MetricResult('atenciones_por_hora', data, por, 'HORA', _periodo(fechas), len(dataframe))
+
+
+def atenciones_por_dia_semana(dataframe, por=None, kind=None):
+  """
+  Function that counts attentions by weekday.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    por: grouping column(s), e.g. 'SECCION'
+    kind (str): same as in atenciones
+
+  Returns:
+    MetricResult with 'DIA_SEMANA' (0 is Monday) and 'DIA' (its name) columns
+  """
+  por = _por(por)
+  fechas = _fechas(dataframe, kind)
+  data = _conteos(dataframe, por, fechas.dt.dayofweek.rename('DIA_SEMANA'))
+  data.insert(len(por) + 1, 'DIA', data['DIA_SEMANA'].map(dict(enumerate(DIAS_SEMANA))))
+  return MetricResult('atenciones_por_dia_semana', data, por, 'DIA', _periodo(fechas), len(dataframe))
+
+
+def atenciones_grupo_etareo(dataframe, por=None, kind=None):
+  """
+  Function that counts attentions by age group (EDAD_LABELS), including empty groups.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    por: grouping column(s), e.g. 'SECCION'
+    kind (str): same as in atenciones
+
+  Returns:
+    MetricResult with an ordered categorical 'GRUPO_ETAREO' column
+  """
+  por = _por(por)
+  grupos = pd.Series(pd.Categorical.from_codes(_grupo_etareo(dataframe['EDAD']), categories=EDAD_LABELS, ordered=True),
+                     index=dataframe.index, name='GRUPO_ETAREO')
+  data = _conteos(dataframe, por, grupos, observed=False)
+  return MetricResult('atenciones_grupo_etareo', data, por, 'GRUPO_ETAREO', _periodo(_fechas(dataframe, kind)),
+                      len(dataframe))
+
+
+def motivos_alta(dataframe, por=None, kind=None):
+  """
+  Function that counts reasons for discharge, uncoded ones (NaN) included.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    por: grouping column(s), e.g. 'SECCION'
+    kind (str): same as in atenciones
+
+  Returns:
+    MetricResult sorted by count
+  """
+  por = _por(por)
+  data = _conteos(dataframe, por, dataframe['MOTIVO_ALTA'], orden='cantidad', dropna=False)
+  return MetricResult('motivos_alta', data, por, 'MOTIVO_ALTA', _periodo(_fechas(dataframe, kind)), len(dataframe))
+
+
+def top_profesionales(dataframe, por=None, n=20, kind=None):
+  """
+  Function that ranks professionals by attentions.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    por: grouping column(s), e.g. 'SECCION'
+    n (int): professionals kept per group
+    kind (str): same as in atenciones
+
+  Returns:
+    MetricResult, '% TOTAL' over every professional of the group (not only the top n)
+  """
+  por = _por(por)
+  data = _conteos(dataframe, por, dataframe['PROFESIONAL'], orden='cantidad', dropna=False, n=n)
+  return MetricResult('top_profesionales', data, por, 'PROFESIONAL', _periodo(_fechas(dataframe, kind)),
+                      len(dataframe))
+
+
+def top_diagnosticos(dataframe, por=None, n=20, kind=None):
+  """
+  Function that ranks coded diagnostics (CIE10).
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    por: grouping column, e.g. 'SECCION'
+    n (int): diagnostics kept per group
+    kind (str): same as in atenciones
+
+  Returns:
+    MetricResult. sin_codificar is the total of rows without CIE10 and meta['codificacion'] has
+    'SIN_COD' and 'TOTAL' per group when por is given.
+  """
+  por = _por(por)
+  data = _conteos(dataframe, por, dataframe['CIE10'], orden='cantidad', n=n)
+  meta = {}
+  if len(por) == 1:
+    meta['codificacion'] = codificacion_por_grupo(dataframe, por[0])
+  return MetricResult('top_diagnosticos', data, por, 'CIE10', _periodo(_fechas(dataframe, kind)), len(dataframe),
+                      sin_codificar=int(dataframe['CIE10'].isna().sum()), meta=meta)
+
+
+def tiempos_estadia(dataframe, por='SECCION', kind=None):
+  """
+  Function that summarizes the stay times (STAY_COLUMNS): mean, median, percentiles and outliers.
+
+  Args:
+    dataframe: preprocessed pandas dataframe with stay columns (emergencias or hospitalizacion)
+    por: grouping column(s). Whole dataset only if None.
+    kind (str): same as in atenciones
+
+  Returns:
+    MetricResult with StaySketch.stats as data and the sketch in meta['sketch'], to merge months
+  """
+  por = _por(por)
+  sketch = StaySketch(dataframe, por=por)
+  return MetricResult('tiempos_estadia', sketch.stats(), por, None, _periodo(_fechas(dataframe, kind)), len(dataframe),
+                      meta={'sketch': sketch, 'histogramas': sketch.histogramas()})
+
+
+def reingresos(dataframe, por='SECCION', kind=None, ventana=None, fin=None):
+  """
+  Function that computes re-admission rates, see PatientIndex.tasa_reingreso.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    por (str): grouping column. Whole dataset if None.
+    kind (str): 'emergencias' or 'hospitalizacion', for the default window (REINGRESO_VENTANAS)
+    ventana: maximum time between visits, e.g. '72h'
+    fin (str): column the previous visit ends at, e.g. 'ALTA_ADMIN'
+
+  Returns:
+    MetricResult with 'VISITAS', 'REINGRESOS' and '% REINGRESO' per group, the window in meta and
+    the visits per patient in meta['visitas']
+  """
+  if ventana is None:
+    if kind not in REINGRESO_VENTANAS:
+      raise ValueError('Pass kind (emergencias or hospitalizacion) or ventana')
+    ventana, fin = REINGRESO_VENTANAS[kind]
+  if kind is None:
+    # Any kind with this date column, they share the patient key
+    kind = next(kind for kind, column in DATE_KEYS.items() if column in dataframe.columns)
+  indice = PatientIndex(dataframe, kind)
+  data = indice.tasa_reingreso(dataframe, ventana, fin, por).reset_index(drop=por is None)
+  return MetricResult('reingresos', data, [por] if por else [], None, _periodo(_fechas(dataframe, kind)),
+                      len(dataframe), meta={'ventana': ventana, 'fin': fin, 'visitas': indice.visitas()})
+
+
+def ocupacion(dataframe, por='SECCION', kind=None):
+  """
+  Function that computes the hourly census (occupied beds) and its peaks, see OccupancyTimeline.
+
+  Args:
+    dataframe: preprocessed pandas dataframe with FECHA_HORA_INGRESO and ALTA_ADMIN
+    por (str): grouping column
+    kind (str): same as in atenciones
+
+  Returns:
+    MetricResult with OccupancyTimeline.picos per group (and 'TOTAL') as data and the hourly census
+    in meta['censo']
+  """
+  timeline = OccupancyTimeline(dataframe, por=por)
+  censo = timeline.censo()
+  data = timeline.picos(censo).rename_axis(por).reset_index()
+  return MetricResult('ocupacion', data, [por], None, _periodo(_fechas(dataframe, kind)), len(dataframe),
+                      meta={'censo': censo, 'descartadas': timeline.descartadas})
+
+
+# Every metric and the columns it needs
+METRICS = {
+  'atenciones': (atenciones, ['SERVICIO']),
+  'atenciones_por_hora': (atenciones_por_hora, []),
+  'atenciones_por_dia_semana': (atenciones_por_dia_semana, []),
+  'atenciones_grupo_etareo': (atenciones_grupo_etareo, ['EDAD']),
+  'motivos_alta': (motivos_alta, ['MOTIVO_ALTA']),
+  'top_profesionales': (top_profesionales, ['PROFESIONAL']),
+  'top_diagnosticos': (top_diagnosticos, ['CIE10']),
+  'tiempos_estadia': (tiempos_estadia, STAY_COLUMNS + ['SECCION']),
+  'reingresos': (reingresos, ['NHC', 'ALTA_ADMIN', 'SECCION']),
+  'ocupacion': (ocupacion, ['FECHA_HORA_INGRESO', 'ALTA_ADMIN', 'SECCION']),
+}
+
+
+def compute_metrics(dataframe, kind=None, nombres=None, **params):
+  """
+  Function that computes several metrics of a dataframe, e.g. for a scheduled job.
+
+  Args:
+    dataframe: preprocessed pandas dataframe
+    kind (str): same as in atenciones
+    nombres (list): METRICS keys. Every metric the dataframe has columns for if None.
+    params: {metric name: dict of arguments}, e.g. top_diagnosticos={'por': 'SECCION'}
+
+  Returns:
+    dict {name: MetricResult}
+  """
+  if nombres is None:
+    nombres = [nombre for nombre, (_, columns) in METRICS.items()
+               if all(column in dataframe.columns for column in columns)]
+    # Re-admissions need the window of the kind
+    if kind not in REINGRESO_VENTANAS and 'reingresos' in nombres:
+      nombres.remove('reingresos')
+  return {nombre: METRICS[nombre][0](dataframe, kind=kind, **params.get(nombre, {})) for nombre in nombres}
@@ -0,0 +1,313 @@
+"""
+Headless generator of the monthly report pack.
+
+Usage:
+  python report.py --emergencias emer.csv --ambulatorio amb.csv --hospitalizacion hosp.csv -o informe/
+
+Every export is preprocessed and aggregated once, then all the figures are rendered in a process
+pool with the Agg backend. Charts whose numbers didn't change since the last run are copied from
+the render cache in the output directory. A manifest.json with the artifacts is written there too.
+
+Thumbnail first: build the pack with --formato preview (72 dpi pngs), then render full resolution
+versions of the charts that are needed only, e.g. --solo "Motivo de alta".
+"""
+import matplotlib
+# No display needed, must be set before pyplot is imported (also in spawned workers)
+matplotlib.use('Agg')
+
+import argparse
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from hmn_functions import (PREPROCESSORS, DATE_KEYS, build_cube, cube_rollup, cube_conteos_por_grupo,
+                           top_k, file_hash, OUTPUT_FORMATS, output_path, save_chart_data)
+from hmn_functions2 import plot_bar, plot_pie, render_key, restore_render, store_render, RENDER_CACHE_DIRNAME
+
+ORIGENES = {
+  'emergencias': 'EMERGENCIAS',
+  'ambulatorio': 'AMBULATORIO',
+  'hospitalizacion': 'HOSPITALIZACIÓN',
+}
+DIAS = {0: 'Lunes', 1: 'Martes', 2: 'Miércoles', 3: 'Jueves', 4: 'Viernes', 5: 'Sábado', 6: 'Domingo'}
+MANIFEST = 'manifest.json'
+
+
+def periodo(dataframe, kind):
+  """
+  Function that describes the period covered by a dataframe, for chart titles.
+
+  Args:
+    dataframe: preprocessed pandas dataframe, or a cube from build_cube
+    kind (str): one of ORIGENES keys
+
+  Returns:
+    str like '01-2023' or '01-2023 a 03-2023'
+  """
+  columna = 'FECHA' if 'CANTIDAD' in dataframe.columns else DATE_KEYS[kind]
+  fechas = dataframe[columna].dropna()
+  if fechas.empty:
+    return 'sin fechas'
+  inicio, fin = fechas.min().strftime('%m-%Y'), fechas.max().strftime('%m-%Y')
+  return inicio if inicio == fin else f'{inicio} a {fin}'
+
+
+def _barra(data, titulo, x_label, y_label='Atenciones', rotation=90):
+  return {'tipo': 'barra', 'data': data, 'titulo': titulo, 'x_label': x_label, 'y_label': y_label,
+          'rotation': rotation}
+
+
+def _torta(data, titulo, y_label=''):
+  # plot_pie plots a column of a dataframe
+  return {'tipo': 'torta', 'data': data.rename('ATENCIONES').to_frame(), 'titulo': titulo,
+          'column': 'ATENCIONES', 'y_label': y_label}
+
+
+def report_charts(dataframe, kind, aggregates=None):
+  """
+  Function that computes every aggregate of the monthly report for one export.
+
+  Args:
+    dataframe: preprocessed pandas dataframe. Not used if aggregates is given.
+    kind (str): one of ORIGENES keys
+    aggregates (dict): from partial_aggregates or IncrementalDataset.aggregates, to chart a
+      stored dataset without its rows. Top 20 by section come from the TopKSketch then.
+
+  Returns:
+    list of chart dicts ('tipo', 'data', 'titulo', ...) ready for render_chart
+  """
+  origen = ORIGENES[kind]
+  cube = build_cube(dataframe, kind) if aggregates is None else aggregates['CUBO']
+  sufijo = f'{origen} {periodo(cube, kind)}'
+  charts = []
+
+  # Attentions by service / section
+  grupo = 'SECCION' if kind == 'emergencias' else 'SERVICIO'
+  totales = cube_rollup(cube, grupo, dropna=True).sort_values(ascending=False)
+  totales = totales[totales > 0]
+  charts.append(_barra(totales, f'Atenciones por {grupo.lower()} {sufijo}', grupo.capitalize()))
+  charts.append(_torta(totales, f'Atenciones por {grupo.lower()} {sufijo}'))
+  if kind != 'emergencias':
+    for servicio, secciones in cube_conteos_por_grupo(cube, 'SERVICIO', 'SECCION').items():
+      secciones = secciones[secciones > 0].sort_values(ascending=False)
+      charts.append(_barra(secciones, f'Atenciones en {servicio} {sufijo}', 'Sección'))
+      charts.append(_torta(secciones, f'Atenciones en {servicio} {sufijo}'))
+
+  # Hour of the day and weekday
+  charts.append(_barra(cube_rollup(cube, 'HORA', dropna=True), f'Atenciones por hora {sufijo}', 'Hora',
+                       rotation=0))
+  for grupo_, horas in cube_conteos_por_grupo(cube, grupo, 'HORA').items():
+    charts.append(_barra(horas.sort_index(), f'Atenciones por hora en {grupo_} {sufijo}', 'Hora', rotation=0))
+  dias = cube_rollup(cube, 'DIA_SEMANA', dropna=True).sort_index().rename(DIAS)
+  charts.append(_barra(dias, f'Atenciones por día de la semana {sufijo}', 'Día', rotation=0))
+
+  # Age groups
+  edades = cube_rollup(cube, 'GRUPO_ETAREO', dropna=True)
+  charts.append(_barra(edades, f'Atenciones por grupo etáreo {sufijo}', 'Grupo etáreo', rotation=0))
+  charts.append(_torta(edades[edades > 0], f'Atenciones por grupo etáreo {sufijo}'))
+
+  # Top 20 professionals and diagnostics, overall and by section
+  for columna, nombre in [('PROFESIONAL', 'profesionales'), ('CIE10', 'diagnósticos codificados')]:
+    # Unassigned professionals are ranked, uncoded diagnostics are not, same as top_20_professionals
+    dropna = columna == 'CIE10'
+    if aggregates is None:
+      if columna not in dataframe.columns:
+        continue
+      top = top_k(dataframe, columna, k=20, dropna=dropna)['ATENCIONES']
+      secciones = top_k(dataframe, columna, k=20, por='SECCION', dropna=dropna)
+    else:
+      if columna not in aggregates:
+        continue
+      top = aggregates[columna]
+      top = top[top.index.notna()] if dropna else top
+      top = top.sort_values(ascending=False, kind='stable').head(20).rename('ATENCIONES')
+      secciones = aggregates[f'TOPK/SECCION/{columna}'].top(20)
+    charts.append(_barra(top, f'Top 20 {nombre} {sufijo}', columna.capitalize()))
+    for secc, conteo in secciones.items():
+      charts.append(_barra(conteo['ATENCIONES'], f'Top 20 {nombre} en {secc} {sufijo}', columna.capitalize()))
+
+  # Reason for discharge
+  if 'MOTIVO_ALTA' in cube.columns:
+    motivos = cube_rollup(cube, 'MOTIVO_ALTA', dropna=True).sort_values(ascending=False)
+    charts.append(_barra(motivos[motivos > 0], f'Motivo de alta {sufijo}', 'Motivo de alta'))
+
+  for chart in charts:
+    chart['origen'] = kind
+  return charts
+
+
+def render_chart(chart, out, dpi=300, cache_dir=None, fmt='png'):
+  """
+  Function that renders and saves one chart from report_charts, meant to run in a worker process.
+
+  Args:
+    chart (dict): chart from report_charts
+    out (str): output directory
+    dpi (int): resolution of the png
+    cache_dir (str): render cache directory. Charts already rendered with the same data and
+      options are copied from it instead of drawn. No cache if None.
+    fmt (str): one of OUTPUT_FORMATS keys
+
+  Returns:
+    dict with the manifest entry of the artifact
+  """
+  inicio = time.perf_counter()
+  base = os.path.join(out, f'{chart["titulo"].replace(" ", "_")}_{chart["tipo"]}')
+  path = output_path(base, fmt)
+  opciones = {key: value for key, value in chart.items() if key not in ('data', 'origen')}
+  # json is cheaper to write again than to look up
+  key = render_key(chart['data'], dpi=dpi, fmt=fmt, **opciones) if cache_dir and fmt != 'json' else None
+  cache = key is not None and restore_render(key, path, cache_dir)
+  if cache:
+    print(f'Sin cambios en \"{os.path.basename(path)}\", copiado a {out}')
+  elif fmt == 'json':
+    # Only the data, charted client side: matplotlib is not needed at all
+    data = chart['data'][chart['column']] if chart['tipo'] == 'torta' else chart['data']
+    save_chart_data(data, base, tipo=chart['tipo'], titulo=chart['titulo'], x_label=chart.get('x_label'),
+                    y_label=chart['y_label'])
+  else:
+    if chart['tipo'] == 'barra':
+      # Every chart of a worker is drawn on the same reusable canvas, outside pyplot
+      plot_bar(chart['data'], chart['titulo'], chart['x_label'], chart['y_label'], save_plot=True, save_path=out,
+               rotation=chart['rotation'], dpi=dpi, fmt=fmt, canvas=True)
+    else:
+      plot_pie(chart['data'], chart['column'], chart['titulo'], chart['y_label'], save_plot=True, save_path=out,
+               dpi=dpi, fmt=fmt, canvas=True)
+    if key is not None:
+      store_render(key, path, cache_dir)
+  return {
+    'archivo': os.path.basename(path),
+    'titulo': chart['titulo'],
+    'tipo': chart['tipo'],
+    'origen': chart['origen'],
+    'formato': fmt,
+    'cache': cache,
+    'segundos': round(time.perf_counter() - inicio, 3),
+  }
+
+
+def render_charts(charts, out, processes=None, dpi=300, cache_dir=None, fmt='png'):
+  """
+  Function that renders charts in a process pool.
+
+  Args:
+    charts (list): charts from report_charts
+    out (str): output directory
+    processes (int): worker processes. os.cpu_count() if None, in process if 1.
+    dpi (int): resolution of the pngs
+    cache_dir (str): same as in render_chart
+    fmt (str): same as in render_chart
+
+  Returns:
+    tuple (list of manifest entries in charts order, dict {'title (tipo)': error message})
+  """
+  artefactos, errores = [None] * len(charts), {}
+  if processes == 1:
+    for i, chart in enumerate(charts):
+      try:
+        artefactos[i] = render_chart(chart, out, dpi, cache_dir, fmt)
+      except Exception as e:
+        errores[f"{chart['titulo']} ({chart['tipo']})"] = repr(e)
+  else:
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+      futures = {executor.submit(render_chart, chart, out, dpi, cache_dir, fmt): i for i, chart in enumerate(charts)}
+      for future in as_completed(futures):
+        i = futures[future]
+        try:
+          artefactos[i] = future.result()
+        except Exception as e:
+          errores[f"{charts[i]['titulo']} ({charts[i]['tipo']})"] = repr(e)
+  return [a for a in artefactos if a is not None], errores
+
+
+def build_report(exports, out, processes=None, dpi=300, cache=True, fmt='png', solo=None):
+  """
+  Function that builds the whole report pack and its manifest.
+
+  Args:
+    exports (dict): {kind: path to csv}, kinds from ORIGENES
+    out (str): output directory, created if needed
+    processes (int): same as in render_charts
+    dpi (int): resolution of the pngs
+    cache (bool): reuse pngs of unchanged charts from RENDER_CACHE_DIRNAME in out
+    fmt (str): one of OUTPUT_FORMATS keys
+    solo (str): only render charts whose title matches this regex (case insensitive). The new
+      artifacts are added to the existing manifest.
+
+  Returns:
+    manifest (dict), also written to out/manifest.json
+  """
+  os.makedirs(out, exist_ok=True)
+  inicio = time.perf_counter()
+
+  # Aggregates are computed once, in this process; workers only get the small series
+  charts, entradas = [], {}
+  for kind, path in exports.items():
+    dataframe = PREPROCESSORS[kind](path)
+    charts += report_charts(dataframe, kind)
+    entradas[kind] = {'archivo': os.path.abspath(path), 'hash': file_hash(path), 'filas': len(dataframe)}
+  if solo:
+    charts = [chart for chart in charts if re.search(solo, chart['titulo'], flags=re.IGNORECASE)]
+  agregado = time.perf_counter()
+
+  cache_dir = os.path.join(out, RENDER_CACHE_DIRNAME) if cache else None
+  artefactos, errores = render_charts(charts, out, processes=processes, dpi=dpi, cache_dir=cache_dir, fmt=fmt)
+
+  manifest_path = os.path.join(out, MANIFEST)
+  if solo and os.path.exists(manifest_path):
+    # Keep what earlier runs rendered, e.g. the previews of the other charts
+    with open(manifest_path, encoding='utf-8') as f:
+      previos = json.load(f)['artefactos']
+    nuevos = {artefacto['archivo'] for artefacto in artefactos}
+    artefactos = [artefacto for artefacto in previos if artefacto['archivo'] not in nuevos] + artefactos
+  manifest = {
+    'generado': pd.Timestamp.now().isoformat(timespec='seconds'),
+    'entradas': entradas,
+    'dpi': dpi,
+    'formato': fmt,
+    'artefactos': artefactos,
+    'errores': errores,
+    'segundos': {
+      'agregados': round(agregado - inicio, 3),
+      'graficos': round(time.perf_counter() - agregado, 3),
+    },
+  }
+  with open(manifest_path, 'w', encoding='utf-8') as f:
+    json.dump(manifest, f, ensure_ascii=False, indent=2)
+  return manifest
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Genera los gráficos del informe mensual a partir de los csv de Pentaho.')
+  for kind in ORIGENES:
+    parser.add_argument(f'--{kind}', metavar='CSV', help=f'export de {ORIGENES[kind].lower()}')
+  parser.add_argument('-o', '--out', required=True, help='directorio de salida')
+  parser.add_argument('-j', '--procesos', type=int, default=None,
+                      help='procesos para graficar (por defecto, uno por núcleo)')
+  parser.add_argument('--dpi', type=int, default=300)
+  parser.add_argument('--sin-cache', action='store_true', help='volver a graficar todo, aunque no haya cambios')
+  parser.add_argument('--formato', choices=list(OUTPUT_FORMATS), default='png',
+                      help='png, preview (png liviano), svg o json (solo los datos)')
+  parser.add_argument('--solo', metavar='PATRON', help='graficar solo los títulos que coincidan con el patrón')
+  args = parser.parse_args(argv)
+
+  exports = {kind: getattr(args, kind) for kind in ORIGENES if getattr(args, kind)}
+  if not exports:
+    parser.error('se necesita al menos un export (--emergencias, --ambulatorio o --hospitalizacion)')
+
+  manifest = build_report(exports, args.out, processes=args.procesos, dpi=args.dpi,
+                          cache=not args.sin_cache, fmt=args.formato, solo=args.solo)
+  cacheados = sum(artefacto['cache'] for artefacto in manifest['artefactos'])
+  print(f'{len(manifest["artefactos"])} gráficos en {args.out}, {cacheados} sin cambios '
+        f'({manifest["segundos"]["agregados"]}s agregados, {manifest["segundos"]["graficos"]}s gráficos)')
+  for titulo, error in manifest['errores'].items():
+    print(f'Error en "{titulo}": {error}')
+  return 1 if manifest['errores'] else 0
+
+
+if __name__ == '__main__':
+  raise SystemExit(main())
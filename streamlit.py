@@ -2,10 +2,16 @@ import streamlit as st
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
+import io
 import numpy as np
 import datetime
 from hmn_functions import preprocess_ambulatorio
 from hmn_functions import preprocess_emergencias
+from hmn_functions import preprocess_hospitalizacion
+from hmn_functions import conteos_por_grupo, codificacion_por_grupo, top_k
+from hmn_functions import grupos_etareos
+from hmn_functions import build_cube, cube_rollup, file_hash
+from hmn_functions import FigureManager, OUTPUT_FORMATS, label_bars
 
 def motivo_alta(dataframe):
   df_display = pd.DataFrame(dataframe['MOTIVO_ALTA'].value_counts(dropna=False))
@@ -16,17 +22,16 @@ def motivo_alta(dataframe):
   ax = dataframe['MOTIVO_ALTA'].value_counts(dropna=False).plot(kind='barh', figsize=(15,10))
   ax.set_title("Motivo de alta")
 
-  for i in ax.patches:
-    if i.get_width() > 1000:
-      ax.text(i.get_width()*.9, i.get_y()*1.02, str(i.get_width()), fontsize=13, color='black')
-    else:
-      ax.text(i.get_width()*1.03, i.get_y()*1.02, str(i.get_width()), fontsize=13, color='black')
+  label_bars(ax)
   return fig, df_display
 
-def atenciones_por_dia_semana(dataframe, por_servicio=False):
-  # Df prepare
-  df_dias = dataframe['FECHA_HORA_TURNO'].dt.dayofweek.value_counts()
-  df_dias.sort_index(inplace=True)
+def atenciones_por_dia_semana(dataframe, por_servicio=False, cube=None):
+  # Df prepare, from the cube if there is one
+  if cube is not None:
+    df_dias = cube_rollup(cube, 'DIA_SEMANA', dropna=True)
+  else:
+    df_dias = dataframe['FECHA_HORA_TURNO'].dt.dayofweek.value_counts()
+  df_dias = df_dias.sort_index()
   df_dias = df_dias.rename({0:'Lunes', 1:'Martes', 2:'Miércoles', 3:'Jueves', 4:'Viernes', 5:'Sábado', 6:'Domingo'})
 
   # Plot
@@ -37,8 +42,7 @@ def atenciones_por_dia_semana(dataframe, por_servicio=False):
   plt.xticks(rotation=0)
 
   # Write totals
-  for i in ax.patches:
-    ax.text(i.get_x() + 0.1, i.get_height()*1.02, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax)
   
   # Df by seccion
   # if por_servicio:
@@ -62,31 +66,19 @@ def atenciones_por_dia_semana(dataframe, por_servicio=False):
 
   return df_dias, fig
 
-def atenciones_grupo_etareo_ambulatorio(dataframe, por_servicio=False):
+def atenciones_grupo_etareo_ambulatorio(dataframe, por_servicio=False, cube=None):
   # Get months and year of dataframe
   year = pd.DatetimeIndex(dataframe['FECHA_HORA_TURNO']).year.unique()[0]
   months = pd.DatetimeIndex(dataframe['FECHA_HORA_TURNO']).month.unique()
 
   # Group classifier
-  grupos = [0,0,0,0,0,0]
-  for i in range(len(dataframe.EDAD)):
-    if dataframe.EDAD[i] == 0:
-      grupos[0] = grupos[0] + 1
-    elif dataframe.EDAD[i] > 0 and dataframe.EDAD[i] < 14:
-      grupos[1] = grupos[1] + 1
-    elif dataframe.EDAD[i] > 14 and dataframe.EDAD[i] < 22:
-      grupos[2] = grupos[2] + 1
-    elif dataframe.EDAD[i] > 22 and dataframe.EDAD[i] < 41:
-      grupos[3] = grupos[3] + 1
-    elif dataframe.EDAD[i] > 41 and dataframe.EDAD[i] < 61:
-      grupos[4] = grupos[4] + 1
-    else:
-      grupos[5] = grupos[5] + 1
+  if cube is not None:
+    edades = cube_rollup(cube, 'GRUPO_ETAREO', dropna=True).rename('Cantidad')
+  else:
+    edades = grupos_etareos(dataframe).rename('Cantidad')
 
   # Plot  
-  labels=['0 años', '1 a 13', '14 a 21', '22 a 40', '41 a 60', '+61']
   explode=[0.1,0.1,0.1,0,0.1,0.1]
-  edades = pd.Series(grupos,index=labels, name='Cantidad')
   fig, ax = plt.subplots()
   ax = edades.plot(kind='pie', autopct='%1.2f%%', explode=explode)
   ax.set_title(f"Atenciones según grupo etáreo | AMBULATORIO | mes(es) {months[0]} a {months[-1]} de {year}");
@@ -121,12 +113,15 @@ def atenciones_grupo_etareo_ambulatorio(dataframe, por_servicio=False):
   #     plt.title(f"Atenciones según grupo etáreo | {serv.upper()} | mes(es) {months[0]} a {months[-1]} de {year}")
   return fig, edades
 
-def atenciones_por_hora_ambulatorio(dataframe, por_servicio=False):
+def atenciones_por_hora_ambulatorio(dataframe, por_servicio=False, cube=None):
   # Get year and months from dataframe
   year = pd.DatetimeIndex(dataframe['FECHA_HORA_TURNO']).year.unique()[0]
   months = pd.DatetimeIndex(dataframe['FECHA_HORA_TURNO']).month.unique()
 
-  df_horas = dataframe.FECHA_HORA_TURNO.dt.hour.value_counts()
+  if cube is not None:
+    df_horas = cube_rollup(cube, 'HORA', dropna=True)
+  else:
+    df_horas = dataframe.FECHA_HORA_TURNO.dt.hour.value_counts()
   df_horas = df_horas.sort_index()
 
   # Plot total
@@ -136,13 +131,7 @@ def atenciones_por_hora_ambulatorio(dataframe, por_servicio=False):
   ax.set_ylabel("Atenciones")
   plt.xticks(rotation=0)
 
-  for i in ax.patches:
-    if i.get_height() > 1000:
-      ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
-    elif i.get_height() < 1000 and i.get_height() > 100:
-      ax.text(i.get_x(), i.get_height()*1.1, str(int(i.get_height())), fontsize=13, color='dimgrey')
-    else:
-      ax.text(i.get_x(), i.get_height()*1.5, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax)
   # if por_servicio:
   #   servicios = dataframe['SERVICIO'].unique()
 
@@ -181,8 +170,7 @@ def top_20_cod_diagnostics_ambulatorio(dataframe, por_servicio=False, por_seccio
   plt.xticks(rotation=0)
   
   # Write totals in plot
-  for i in ax.patches:
-    ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  label_bars(ax)
   
   # if por_seccion:
   #   # By seccion
@@ -246,9 +234,10 @@ def atenciones(dataframe, por_servicio=True, por_seccion=False, torta=False, bar
     dataframe: pandas dataframe
 
   Returns:
-
+    (dataframe by servicio, pie figure, bar figure). None for what was not asked for.
   """
   ### Atenciones por sección
+  df = fig = fig2 = None
 
   if por_servicio:
     # Create dataframe with all servicios
@@ -259,8 +248,6 @@ def atenciones(dataframe, por_servicio=True, por_seccion=False, torta=False, bar
     df = df.reset_index()
     # Rename columns
     df.columns=['SERVICIO','CANTIDADES','% TOTAL']
-    st.write(f"Atenciones por servicio (Total = {df['CANTIDADES'].sum()})\n")
-    st.dataframe(df)
 
     if torta:
       # Plot pie
@@ -270,16 +257,13 @@ def atenciones(dataframe, por_servicio=True, por_seccion=False, torta=False, bar
       fig, ax = plt.subplots()
       ax = df_bar.plot(kind='pie',y='CANTIDADES', figsize=(15,10), fontsize=13, autopct="%0.2f%%", explode=explode, legend=False)
       ax.set_title(f"Atenciones por servicio (Total = {df_bar['CANTIDADES'].sum()})",fontsize=20)
-      st.pyplot(fig)
     
     if barra:
       # Plot bar
       fig2, ax2 = plt.subplots()
       ax2 = df.plot.bar('SERVICIO', 'CANTIDADES',rot=45, figsize=(20,15), fontsize=18)
       ax2.set_title(f"Atenciones por servicio (Total = {df['CANTIDADES'].sum()})", fontsize=20)
-      for i in ax2.patches:
-        ax2.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
-      st.pyplot(fig2)
+      label_bars(ax2)
 
   # if por_seccion:
   #   # Get all servicios
@@ -313,15 +297,17 @@ def atenciones(dataframe, por_servicio=True, por_seccion=False, torta=False, bar
   #       plt.title(f"Atenciones en {servicios[i]} (Total = {df['CANTIDADES'].sum()})", fontsize=20)
   #       for i in ax.patches:
   #         ax.text(i.get_x(), i.get_height()*1.01, str(int(i.get_height())), fontsize=13, color='dimgrey')
+  return df, fig, fig2
 
 
 ###------------------------------------------------------------------------------->Emergencias funciones<------------------------------------------------------------------------------------------
-def atenciones_por_seccion(dataframe):
+def atenciones_por_seccion(dataframe, cube=None):
   """
   Function that generates statistics from emergency dataframe
 
   Args:
     dataframe: pandas dataframe
+    cube: pandas dataframe from build_cube. Counts are taken from it instead of dataframe rows.
 
   Returns:
 
@@ -329,9 +315,12 @@ def atenciones_por_seccion(dataframe):
   ### Atenciones por sección
 
   # Dataframe
-  seccion = pd.DataFrame({'CANTIDADES':dataframe['SECCION'].value_counts(),
-                          '% TOTAL':np.round(dataframe['SECCION'].value_counts(normalize=True)*100,2)})
-  st.write(f"Atenciones por sección (Total = {seccion['CANTIDADES'].sum()})\n")
+  if cube is not None:
+    cantidades = cube_rollup(cube, 'SECCION', dropna=True).sort_values(ascending=False)
+  else:
+    cantidades = dataframe['SECCION'].value_counts()
+  seccion = pd.DataFrame({'CANTIDADES':cantidades,
+                          '% TOTAL':np.round(cantidades/cantidades.sum()*100,2)})
 
   # Plot pie
   #explode_values = np.arange(0,len(seccion)/10,0.1)
@@ -359,12 +348,10 @@ def atenciones_por_seccion(dataframe):
 
 def top_20_professionals(dataframe, por_seccion=False):
   # Prepare df
-  df = pd.DataFrame({'ATENCIONES':dataframe['PROFESIONAL'].value_counts(),
-                      '% TOTAL':np.round(dataframe['PROFESIONAL'].value_counts(normalize=True)*100,2)})
+  df = top_k(dataframe, 'PROFESIONAL', k=None, dropna=True).round({'% TOTAL': 2})
   #df = df.reset_index()
   #df.columns=['PROFESIONAL','ATENCIONES','% TOTAL']
   df = df.sort_values('ATENCIONES', ascending=False)
-  st.write(f'Top 20 profesionales con mayoeres atenciones en todos los servicios')
   
   # Plot bar
   fig, ax = plt.subplots()
@@ -374,8 +361,7 @@ def top_20_professionals(dataframe, por_seccion=False):
   ax.set_xlabel("Profesionales")
 
   # Write totals
-  for i in ax.patches:
-    ax.text(i.get_x(), i.get_height()*1.02, str(i.get_height()), fontsize=13, color='dimgrey')
+  label_bars(ax)
 
   # if por_seccion:
   #   secciones = dataframe['SECCION'].unique()
@@ -401,6 +387,175 @@ def top_20_professionals(dataframe, por_seccion=False):
   #       ax2.text(i.get_x(), i.get_height()*1.02, str(i.get_height()), fontsize=13, color='dimgrey')
   
   return df, fig
+###<---------------------------------------------------------- Cache -------------------------------------------------------------->###
+# Every widget interaction reruns the script, so parsed files and panels are kept between runs.
+# Paths are identified by path + (mtime, size), uploads by content hash, panels by their widget
+# parameters too. Arguments starting with '_' are not part of Streamlit's cache key.
+PREPROCESADORES = {
+  'Ambulatorio': (preprocess_ambulatorio, 'ambulatorio'),
+  'Emergencias': (preprocess_emergencias, 'emergencias'),
+  'Hospitalización': (preprocess_hospitalizacion, 'hospitalizacion'),
+}
+PANELES = {
+  'atenciones': atenciones,
+  'motivo_alta': motivo_alta,
+  'dia_semana': atenciones_por_dia_semana,
+  'grupo_etareo': atenciones_grupo_etareo_ambulatorio,
+  'por_hora': atenciones_por_hora_ambulatorio,
+  'top_20_cie10': top_20_cod_diagnostics_ambulatorio,
+  'por_seccion': atenciones_por_seccion,
+  'top_20_profesionales': top_20_professionals,
+}
+# Panels that can take their counts from the cube
+PANELES_CUBO = {'dia_semana', 'grupo_etareo', 'por_hora', 'por_seccion'}
+MAX_ARCHIVOS = 4
+MAX_PANELES = 64
+
+def clave_archivo(filename):
+  # Changes every time the file is rewritten, without reading it
+  stat = os.stat(filename)
+  return ('ruta', filename, stat.st_mtime_ns, stat.st_size)
+
+def clave_subida(archivo):
+  # Hash of the upload, computed over its buffer without copying it
+  return ('subida', file_hash(archivo.getbuffer()))
+
+def elegir_fuente(origen):
+  """
+  Function that asks for the file to analyze, uploaded or as a server path.
+
+  Args:
+    origen (str): origin of the data, keeps the widgets of every origin apart
+
+  Returns:
+    (source for preprocess_*, cache key of its content)
+  """
+  archivo = st.file_uploader('Suba el archivo .csv', type='csv', key=f'subida_{origen}')
+  if archivo is not None:
+    return archivo, clave_subida(archivo)
+
+  filename = st.text_input('O introduzca la ruta del archivo:', key=f'ruta_{origen}')
+  if not filename:
+    st.warning('Por favor suba el archivo o introduzca su ruta en la celda superior')
+    st.stop()
+  return filename, clave_archivo(filename)
+
+@st.cache_resource(max_entries=MAX_ARCHIVOS, show_spinner='Procesando archivo...')
+def cargar_datos(_fuente, clave, origen):
+  """
+  Function that preprocesses a file and builds its cube, once per file content.
+
+  Args:
+    _fuente: path or uploaded file, not hashed
+    clave (tuple): from clave_archivo or clave_subida
+    origen (str): 'Ambulatorio', 'Emergencias' or 'Hospitalización', one of PREPROCESADORES keys
+
+  Returns:
+    (preprocessed dataframe, cube)
+  """
+  preprocess, kind = PREPROCESADORES[origen]
+  # Uploads are parsed straight from their in-memory buffer
+  df = preprocess(_fuente)
+  return df, build_cube(df, kind)
+
+@st.cache_resource(max_entries=MAX_PANELES, show_spinner=False)
+def calcular_panel(panel, _fuente, clave, origen, **params):
+  """
+  Function that computes a panel of the dashboard, once per file content and parameters.
+
+  Args:
+    panel (str): one of PANELES keys
+    _fuente: path or uploaded file, not hashed
+    clave (tuple): from clave_archivo or clave_subida
+    origen (str): 'Ambulatorio', 'Emergencias' or 'Hospitalización', one of PREPROCESADORES keys
+    params: widget parameters passed to the panel function
+
+  Returns:
+    whatever the panel function returns
+  """
+  df, cube = cargar_datos(_fuente, clave, origen)
+  if panel in PANELES_CUBO:
+    params['cube'] = cube
+  # Cached figures are rendered by st.pyplot, pyplot doesn't have to keep them alive
+  with FigureManager():
+    resultado = PANELES[panel](df, **params)
+  return resultado
+
+def vaciar_cache():
+  cargar_datos.clear()
+  calcular_panel.clear()
+
+# Stay length groups, in days
+ESTADIA_BINS = [0, 1, 2, 3, 5, 7, 14, 30, 60, np.inf]
+ESTADIA_LABELS = ['< 1', '1', '2', '3 a 4', '5 a 6', '7 a 13', '14 a 29', '30 a 59', '60 o más']
+
+@st.cache_resource(max_entries=MAX_ARCHIVOS, show_spinner='Calculando estadísticas...')
+def agregados_hospitalizacion(_fuente, clave):
+  """
+  Function that precomputes every table of the Hospitalización page, once per file content.
+
+  Args:
+    _fuente: path or uploaded file, not hashed
+    clave (tuple): from clave_archivo or clave_subida
+
+  Returns:
+    dict of pandas dataframes and series
+  """
+  df, cube = cargar_datos(_fuente, clave, 'Hospitalización')
+  dias = df['ESTADIA_TOTAL'].dt.total_seconds() / 86400
+  estadia = pd.cut(dias, ESTADIA_BINS, right=False, labels=ESTADIA_LABELS)
+  return {
+    'SERVICIO/SECCION': cube_rollup(cube, ['SECCION', 'SERVICIO'], dropna=True).unstack(fill_value=0),
+    'HORA': cube_rollup(cube, 'HORA', dropna=True),
+    'HORA/SECCION': cube_rollup(cube, ['HORA', 'SECCION'], dropna=True).unstack(fill_value=0),
+    'ESTADIA': pd.crosstab(estadia, df['SECCION']),
+    'ESTADIA_RESUMEN': dias.groupby(df['SECCION']).describe(percentiles=[.25, .5, .75, .9]).round(2),
+    'PROFESIONAL': conteos_por_grupo(df, 'SERVICIO', 'PROFESIONAL'),
+    'CIE10': conteos_por_grupo(df, 'SERVICIO', 'CIE10'),
+    'CODIFICACION': codificacion_por_grupo(df, 'SERVICIO'),
+  }
+
+def top_20(conteos):
+  # Top 20 with % over the whole servicio
+  return pd.DataFrame({'ATENCIONES': conteos[:20],
+                       '% TOTAL': np.round(conteos[:20]/conteos.sum()*100, 2)})
+
+def tabla_paginada(dataframe, key, filas_por_pagina=(50, 100, 500)):
+  """
+  Function that shows one page of a dataframe, so only that page is sent to the browser.
+
+  Args:
+    dataframe: pandas dataframe
+    key (str): prefix of the widget keys, unique per table
+    filas_por_pagina (tuple): page sizes to choose from
+  """
+  col1, col2 = st.columns(2)
+  filas = col1.selectbox('Filas por página', filas_por_pagina, key=f'{key}_filas')
+  paginas = max(1, -(-len(dataframe) // filas))
+  pagina = col2.number_input(f'Página (de {paginas})', min_value=1, max_value=paginas, value=1, key=f'{key}_pagina')
+  inicio = (pagina - 1) * filas
+  st.dataframe(dataframe.iloc[inicio:inicio + filas])
+  st.caption(f'Filas {min(inicio + 1, len(dataframe))} a {min(inicio + filas, len(dataframe))} de {len(dataframe)}')
+
+# Chart formats of the page, light previews first and full resolution or vector only on request
+FORMATOS_GRAFICO = {'Vista previa': 'preview', 'Alta resolución': 'png', 'SVG': 'svg'}
+
+def mostrar_figura(fig, dpi=200):
+  """
+  Function that shows a figure in the format chosen in the sidebar.
+
+  Args:
+    fig: matplotlib figure
+    dpi (int): resolution of 'Alta resolución'
+  """
+  fmt = FORMATOS_GRAFICO[st.session_state.get('formato_grafico', 'Vista previa')]
+  if fmt == 'svg':
+    svg = io.StringIO()
+    fig.savefig(svg, format='svg', bbox_inches='tight')
+    st.image(svg.getvalue())
+  else:
+    st.pyplot(fig, dpi=OUTPUT_FORMATS[fmt][1] or dpi)
+
 ###<---------------------------------------------------------- Html title -------------------------------------------------------------->###
 
 st.title('Estadísticas Hospital Materno Neonatal')
@@ -413,121 +568,190 @@ origin_name = st.selectbox('Seleccione el origen de los datos:', ('Ambulatorio',
 if not origin_name:
   st.warning('Por favor, seleccione el origne de los datos')
   st.stop()
+st.sidebar.button('Vaciar caché', on_click=vaciar_cache)
+st.sidebar.radio('Gráficos', list(FORMATOS_GRAFICO), key='formato_grafico',
+                 help='Vista previa es la más rápida; alta resolución y SVG solo cuando se necesiten')
 
 if origin_name == 'Ambulatorio':
-  # Get filename
-  filename = st.text_input('Introduzca la ruta del archivo:')
-  if not filename:
-    st.warning('Por favor introduzca la ruta del archivo en la celda superior')
-    st.stop()
+  # Get file
+  fuente, clave = elegir_fuente(origin_name)
   st.success('Correcto, analizando...')
-  # Preprocess .csv
-  df = preprocess_ambulatorio(filename)
+  # Preprocess .csv, only if it changed since the last run
+  df, cube = cargar_datos(fuente, clave, origin_name)
 
-  year = pd.DatetimeIndex(df['FECHA_HORA_TURNO']).year.unique()[0]
-  months = pd.DatetimeIndex(df['FECHA_HORA_TURNO']).month.unique()
+  # Period from the cube, it's much smaller than df
+  fechas = pd.DatetimeIndex(cube['FECHA'])
+  year = fechas.year.unique()[0]
+  months = fechas.month.unique()
 
   # Title
   st.write(f"""ESTADÍSTICAS {origin_name.upper()}\n
-  A continuación se muestra el dataset elegido.\n
   El procesamiento de la base de datos arroja información comprendida en el período mes(es) {months[0]} a {months[-1]} del año {year}.
   """)
-  # Complete processed dataframe
-  st.dataframe(df)
-
-  # ATENCIONES
-  st.write(f'Atenciones por {origin_name}\n')
-  servicio=st.checkbox('Por Servicio', value=True)
-  seccion=st.checkbox('Por Sección', value=False)
-  torta=st.checkbox('Torta', value=False)
-  barra=st.checkbox('Barra', value=False)
-  atenciones(df, por_servicio=servicio, por_seccion=seccion, torta=torta, barra=barra)
-
-  # MOTIVO ALTA
-  st.write('Estadísticas de Motivos de Alta\n')
-  st.write('🔑**Nota:** si aparece el valor `nan` significa que los *motivos de alta* NO fueron codificados')
-  fig, df_display = motivo_alta(df)
-  st.dataframe(df_display)
-  st.pyplot(fig)
-
-  # ATENCIONES POR DÍAS DE LA SEMANA
-  st.write('Atenciones por Días de la Semana\n')
-  servicio=st.checkbox('Por servicio')
-  df_at_d_sem, fig= atenciones_por_dia_semana(df, por_servicio=servicio)
-#  st.dataframe(df_at_d_sem)
-  st.pyplot(fig)
-
-  # ATENCIONES POR DÍAS DE LA SEMANA
-  st.write('Atenciones por Días de la Semana\n')
-  fig, edades = atenciones_grupo_etareo_ambulatorio(df, por_servicio=False)
-  st.dataframe(edades)
-  st.pyplot(fig)
-
-  # ATENCIONES POR HORA
-  st.write('Atenciones por Hora')
-  fig, df_temp = atenciones_por_hora_ambulatorio(df, por_servicio=False)
-  st.dataframe(df_temp)
-  st.pyplot(fig)
-
-  # Top 20 diagnósticos codificados
-  st.write('Top 20 diagnósticos codificados')
-  fig, df_temp = top_20_cod_diagnostics_ambulatorio(df, por_servicio=False, por_seccion=False)
-  st.dataframe(df_temp)
-  st.pyplot(fig)
+
+  # Only the chosen panel is computed on every run
+  panel = st.radio('Panel', ('Atenciones', 'Motivos de alta', 'Días de la semana', 'Grupo etáreo',
+                             'Hora', 'Top 20 diagnósticos', 'Dataset'), horizontal=True)
+
+  if panel == 'Atenciones':
+    # ATENCIONES
+    st.write(f'Atenciones por {origin_name}\n')
+    servicio=st.checkbox('Por Servicio', value=True)
+    seccion=st.checkbox('Por Sección', value=False)
+    torta=st.checkbox('Torta', value=False)
+    barra=st.checkbox('Barra', value=False)
+    df_temp, fig_torta, fig_barra = calcular_panel('atenciones', fuente, clave, origin_name,
+                                                   por_servicio=servicio, por_seccion=seccion, torta=torta, barra=barra)
+    if df_temp is not None:
+      st.write(f"Atenciones por servicio (Total = {df_temp['CANTIDADES'].sum()})\n")
+      st.dataframe(df_temp)
+    if fig_torta is not None:
+      mostrar_figura(fig_torta)
+    if fig_barra is not None:
+      mostrar_figura(fig_barra)
+
+  elif panel == 'Motivos de alta':
+    # MOTIVO ALTA
+    st.write('Estadísticas de Motivos de Alta\n')
+    st.write('🔑**Nota:** si aparece el valor `nan` significa que los *motivos de alta* NO fueron codificados')
+    fig, df_display = calcular_panel('motivo_alta', fuente, clave, origin_name)
+    st.dataframe(df_display)
+    mostrar_figura(fig)
+
+  elif panel == 'Días de la semana':
+    # ATENCIONES POR DÍAS DE LA SEMANA
+    st.write('Atenciones por Días de la Semana\n')
+    servicio=st.checkbox('Por servicio')
+    df_at_d_sem, fig= calcular_panel('dia_semana', fuente, clave, origin_name, por_servicio=servicio)
+    #st.dataframe(df_at_d_sem)
+    mostrar_figura(fig)
+
+  elif panel == 'Grupo etáreo':
+    # ATENCIONES POR GRUPO ETÁREO
+    st.write('Atenciones por Grupo Etáreo\n')
+    fig, edades = calcular_panel('grupo_etareo', fuente, clave, origin_name, por_servicio=False)
+    st.dataframe(edades)
+    mostrar_figura(fig)
+
+  elif panel == 'Hora':
+    # ATENCIONES POR HORA
+    st.write('Atenciones por Hora')
+    fig, df_temp = calcular_panel('por_hora', fuente, clave, origin_name, por_servicio=False)
+    st.dataframe(df_temp)
+    mostrar_figura(fig)
+
+  elif panel == 'Top 20 diagnósticos':
+    # Top 20 diagnósticos codificados
+    st.write('Top 20 diagnósticos codificados')
+    fig, df_temp = calcular_panel('top_20_cie10', fuente, clave, origin_name, por_servicio=False, por_seccion=False)
+    mostrar_figura(fig)
+
+  else:
+    # Complete processed dataframe, one page at a time
+    st.write('A continuación se muestra el dataset elegido.')
+    tabla_paginada(df, key='ambulatorio')
 
 
 elif origin_name == 'Emergencias':
-  # Get filename
-  filename = st.text_input('Introduzca la ruta del archivo:')
-  if not filename:
-    st.warning('Por favor introduzca la ruta del archivo en la celda superior')
-    st.stop()
+  # Get file
+  fuente, clave = elegir_fuente(origin_name)
   st.success('Correcto, analizando...')  
 
-  # Preprocess .csv
-  df = preprocess_emergencias(filename) 
-  year = pd.DatetimeIndex(df['FECHA_HORA_INGRESO']).year.unique()[0]
-  months = pd.DatetimeIndex(df['FECHA_HORA_INGRESO']).month.unique()
+  # Preprocess .csv, only if it changed since the last run
+  df, cube = cargar_datos(fuente, clave, origin_name)
+  fechas = pd.DatetimeIndex(cube['FECHA'])
+  year = fechas.year.unique()[0]
+  months = fechas.month.unique()
   
   st.write(f"""ESTADÍSTICAS {origin_name.upper()}\n
-  A continuación se muestra el dataset elegido.\n
   El procesamiento de la base de datos arroja información comprendida en el período mes(es) {months[0]} a {months[-1]} del año {year}.
   """)
-  # Complete processed dataframe
-  st.dataframe(df)
 
-  # ATENCIONES POR SECCIÓN
-  df_temp, fig = atenciones_por_seccion(df)
-  st.dataframe(df_temp)
-  st.bar_chart(df_temp['CANTIDADES'], use_container_width=True)
+  # Only the chosen panel is computed on every run
+  panel = st.radio('Panel', ('Atenciones por sección', 'Top 20 profesionales', 'Dataset'), horizontal=True)
 
+  if panel == 'Atenciones por sección':
+    # ATENCIONES POR SECCIÓN
+    df_temp, fig = calcular_panel('por_seccion', fuente, clave, origin_name)
+    st.write(f"Atenciones por sección (Total = {df_temp['CANTIDADES'].sum()})\n")
+    st.dataframe(df_temp)
+    st.bar_chart(df_temp['CANTIDADES'], use_container_width=True)
 
-  # TOP 20 PROFESIONALES
-  df_temp, fig = top_20_professionals(df, por_seccion=False)
-  st.dataframe(df_temp)
-  st.bar_chart(df_temp[:20])
+  elif panel == 'Top 20 profesionales':
+    # TOP 20 PROFESIONALES
+    df_temp, fig = calcular_panel('top_20_profesionales', fuente, clave, origin_name, por_seccion=False)
+    st.write(f'Top 20 profesionales con mayoeres atenciones en todos los servicios')
+    st.dataframe(df_temp)
+    st.bar_chart(df_temp[:20])
+
+  else:
+    # Complete processed dataframe, one page at a time
+    st.write('A continuación se muestra el dataset elegido.')
+    tabla_paginada(df, key='emergencias')
 
 
 else:
-  st.write('Todavía no llegué acá')
-  seccion=st.checkbox('Por sección')
-  servicio=st.checkbox('Por servicio')
-  torta=st.checkbox('Torta')
-  barra=st.checkbox('Barra')
-  st.write(seccion, servicio, torta, barra)
-  
-  genre = st.radio("What's your favorite movie genre", ('Comedy', 'Drama', 'Documentary'))
-  if genre == 'Comedy':
-    st.write('You selected comedy.')
+  # Get file
+  fuente, clave = elegir_fuente(origin_name)
+  st.success('Correcto, analizando...')
+
+  # Preprocess .csv and every table of the page, only if it changed since the last run
+  df, cube = cargar_datos(fuente, clave, origin_name)
+  agregados = agregados_hospitalizacion(fuente, clave)
+  fechas = pd.DatetimeIndex(cube['FECHA'])
+  year = fechas.year.unique()[0]
+  months = fechas.month.unique()
+
+  st.write(f"""ESTADÍSTICAS {origin_name.upper()}\n
+  El procesamiento de la base de datos arroja información comprendida en el período mes(es) {months[0]} a {months[-1]} del año {year}.
+  """)
+
+  # Only the chosen panel is rendered on every run
+  panel = st.radio('Panel', ('Atenciones por servicio', 'Estadía', 'Ingresos por hora',
+                             'Top 20 profesionales', 'Top 20 diagnósticos', 'Dataset'), horizontal=True)
+  servicios = list(agregados['PROFESIONAL'])
+
+  if panel == 'Atenciones por servicio':
+    # ATENCIONES POR SERVICIO Y SECCIÓN
+    tabla = agregados['SERVICIO/SECCION']
+    st.write(f'Atenciones por servicio y sección (Total = {tabla.to_numpy().sum()})')
+    st.dataframe(tabla)
+    st.bar_chart(tabla)
+
+  elif panel == 'Estadía':
+    # ESTADÍA TOTAL (INGRESO A ALTA ADMINISTRATIVA)
+    st.write('Estadía total en días, desde el ingreso hasta el alta administrativa')
+    st.dataframe(agregados['ESTADIA_RESUMEN'])
+    secciones = st.multiselect('Secciones', list(agregados['ESTADIA'].columns), default=list(agregados['ESTADIA'].columns))
+    st.bar_chart(agregados['ESTADIA'][secciones])
+
+  elif panel == 'Ingresos por hora':
+    # INGRESOS POR HORA
+    st.write('Ingresos por hora')
+    if st.checkbox('Por sección'):
+      st.bar_chart(agregados['HORA/SECCION'])
+    else:
+      st.bar_chart(agregados['HORA'])
+
+  elif panel == 'Top 20 profesionales':
+    # TOP 20 PROFESIONALES
+    servicio = st.selectbox('Servicio', servicios)
+    df_temp = top_20(agregados['PROFESIONAL'][servicio])
+    st.write(f'Top 20 profesionales con más atenciones en {servicio}')
+    st.dataframe(df_temp)
+    st.bar_chart(df_temp['ATENCIONES'])
+
+  elif panel == 'Top 20 diagnósticos':
+    # TOP 20 DIAGNÓSTICOS CODIFICADOS
+    servicio = st.selectbox('Servicio', list(agregados['CIE10']))
+    sin_cod, total = agregados['CODIFICACION'].loc[servicio]
+    df_temp = top_20(agregados['CIE10'][servicio])
+    st.write(f'Top 20 diagnósticos codificados con CIE10 en {servicio}')
+    st.write(f'Diagnósticos sin codificar: {sin_cod} | Diagnósticos totales: {total}')
+    st.dataframe(df_temp)
+    st.bar_chart(df_temp['ATENCIONES'])
+
   else:
-    st.write("You didn't select comedy.")
-  
-  t = st.time_input('Set an alarm for', datetime.time(8, 45))
-  st.write('Alarm is set for', t)
-
-  uploaded_file = st.file_uploader("Choose a file")
-  if uploaded_file is not None:
-    # To read file as bytes:
-    bytes_data = uploaded_file.getvalue()
-    st.write("filename:", uploaded_file.name)
-    #st.write(bytes_data)
\ No newline at end of file
+    # Complete processed dataframe, one page at a time
+    st.write('A continuación se muestra el dataset elegido.')
+    tabla_paginada(df, key='hospitalizacion')